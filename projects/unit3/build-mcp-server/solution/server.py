@@ -4,13 +4,33 @@ Module 1: Basic MCP Server with PR Template Tools
 A minimal MCP server that provides tools for analyzing file changes and suggesting PR templates.
 """
 
+import asyncio
 import json
 import os
 import subprocess
-from typing import Optional
+import weakref
+from typing import List, Optional
 from pathlib import Path
 
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
+from mcp.server.session import ServerSession
+from mcp.types import Root, RootsListChangedNotification
+
+from git_analysis import (
+    GIT_TIMEOUT,
+    analyze_commit_range,
+    collect_change_metrics,
+    collect_file_changes,
+    exclude_patterns,
+    read_commit_page,
+    read_diff_page,
+    read_file_diffs,
+    resolve_range,
+    result_cache
+)
+from import_graph import find_affected_tests
+from ownership_index import find_reviewers
+from repo_watcher import WATCH_ENV_VAR, start_watching, stop_watching
 
 # Initialize the FastMCP server
 mcp = FastMCP("pr-agent")
@@ -47,12 +67,63 @@ TYPE_MAPPING = {
 }
 
 
+# Repositories analyzed at the same time by analyze_repositories
+REPOSITORY_CONCURRENCY = 4
+
+
+# Roots reported by each client session, dropped when a client announces a change
+_session_roots: "weakref.WeakKeyDictionary[ServerSession, list[Root]]" = weakref.WeakKeyDictionary()
+
+
+async def list_session_roots() -> list[Root]:
+    """Return the MCP roots of the current client session.
+    
+    Each roots/list request is a full round trip to the client, so the answer is
+    cached per session until the client sends notifications/roots/list_changed.
+    """
+    session = mcp.get_context().session
+    roots = _session_roots.get(session)
+    if roots is None:
+        roots = (await session.list_roots()).roots
+        _session_roots[session] = roots
+    return roots
+
+
+async def handle_roots_list_changed(notification: RootsListChangedNotification) -> None:
+    """Forget cached roots when a client reports that its roots changed."""
+    # Notification handlers are not told which session sent the notification
+    _session_roots.clear()
+
+
+mcp._mcp_server.notification_handlers[RootsListChangedNotification] = handle_roots_list_changed
+
+
+async def resolve_working_directory(working_directory: Optional[str]) -> str:
+    """Return the directory git should run in: the argument, the first MCP root, or the server CWD."""
+    if working_directory is None:
+        try:
+            # Get the first root - Claude Code sets this to the CWD
+            working_directory = (await list_session_roots())[0].uri.path
+        except Exception:
+            # If we can't get roots, fall back to current directory
+            pass
+    return working_directory if working_directory else os.getcwd()
+
+
 @mcp.tool()
 async def analyze_file_changes(
     base_branch: str = "main",
     include_diff: bool = True,
     max_diff_lines: int = 500,
-    working_directory: Optional[str] = None
+    max_tokens: Optional[int] = None,
+    packing: str = "path",
+    exclude: Optional[List[str]] = None,
+    timeout: float = GIT_TIMEOUT,
+    output: str = "text",
+    include_uncommitted: bool = False,
+    collapse_duplicates: bool = False,
+    working_directory: Optional[str] = None,
+    include_debug: bool = False
 ) -> str:
     """Get the full diff and list of changed files in the current git repository.
     
@@ -60,114 +131,403 @@ async def analyze_file_changes(
         base_branch: Base branch to compare against (default: main)
         include_diff: Include the full diff content (default: true)
         max_diff_lines: Maximum number of diff lines to include (default: 500)
+        max_tokens: Token budget for the whole response; when set, whole hunks are packed
+            into the budget instead of cutting after max_diff_lines, and the files and
+            hunks left out are listed under "omitted"; "over_budget" is set when the file
+            list and statistics alone exceed it (default: no budget)
+        packing: "path" keeps files in path order; "priority" packs source changes first,
+            then tests and docs, and generated or lock files last (default: path)
+        exclude: Path globs ("dir/" for directories, "attr:NAME" for gitattributes) that git
+            skips entirely; they are only counted under "excluded" (default: lock files,
+            dist/, minified assets and linguist-generated files, or PR_AGENT_EXCLUDE)
+        timeout: Seconds after which git is stopped and the partial result is returned
+            with "timed_out" set (default: 60)
+        output: "text" for the unified diff, or "hunks" for parsed hunks per file (ranges,
+            added and removed lines, language) limited to max_diff_lines changed lines (default: text)
+        include_uncommitted: Also report staged, unstaged, untracked and conflicted files and
+            the diff against HEAD under "uncommitted" (default: false)
+        collapse_duplicates: Write hunks whose changes repeat across files (codemods, license
+            headers) once, followed by the places they apply to (default: false)
         working_directory: Directory to run git commands in (default: current directory)
+        include_debug: Add a _debug section describing how the working directory was found (default: false)
     """
     try:
-        # Try to get working directory from roots first
-        if working_directory is None:
-            try:
-                context = mcp.get_context()
-                roots_result = await context.session.list_roots()
-                # Get the first root - Claude Code sets this to the CWD
-                root = roots_result.roots[0]
-                # FileUrl object has a .path property that gives us the path directly
-                working_directory = root.uri.path
-            except Exception:
-                # If we can't get roots, fall back to current directory
-                pass
+        # Use the provided working directory, the first MCP root or the current directory
+        cwd = await resolve_working_directory(working_directory)
         
-        # Use provided working directory or current directory
-        cwd = working_directory if working_directory else os.getcwd()
-        
-        # Debug output
-        debug_info = {
-            "provided_working_directory": working_directory,
-            "actual_cwd": cwd,
-            "server_process_cwd": os.getcwd(),
-            "server_file_location": str(Path(__file__).parent),
-            "roots_check": None
-        }
+        # Keep the results for this repository warm in the background (opt-in)
+        if os.environ.get(WATCH_ENV_VAR):
+            await start_watching(cwd, lambda: prefetch_file_changes(cwd), prefetch=False)
         
-        # Add roots debug info
-        try:
-            context = mcp.get_context()
-            roots_result = await context.session.list_roots()
-            debug_info["roots_check"] = {
-                "found": True,
-                "count": len(roots_result.roots),
-                "roots": [str(root.uri) for root in roots_result.roots]
-            }
-        except Exception as e:
-            debug_info["roots_check"] = {
-                "found": False,
-                "error": str(e)
+        # Debug output (opt-in)
+        debug_info = None
+        if include_debug:
+            debug_info = {
+                "provided_working_directory": working_directory,
+                "actual_cwd": cwd,
+                "server_process_cwd": os.getcwd(),
+                "server_file_location": str(Path(__file__).parent),
+                "roots_check": None
             }
+            
+            # Add roots debug info from the session's cached roots
+            try:
+                roots = await list_session_roots()
+                debug_info["roots_check"] = {
+                    "found": True,
+                    "count": len(roots),
+                    "roots": [str(root.uri) for root in roots]
+                }
+            except Exception as e:
+                debug_info["roots_check"] = {
+                    "found": False,
+                    "error": str(e)
+                }
         
-        # Get list of changed files
-        files_result = subprocess.run(
-            ["git", "diff", "--name-status", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            check=True,
-            cwd=cwd
-        )
+        # Results for an immutable (merge-base, HEAD) commit pair never change,
+        # so repeated calls are answered from the cache without running git diff;
+        # uncommitted changes can change at any time and are never cached
+        commit_range = await resolve_range(cwd, base_branch)
+        exclude = exclude_patterns(exclude)
+        cache_key = None
+        if commit_range and not include_uncommitted:
+            cache_key = ("analyze_file_changes", cwd, *commit_range, include_diff, max_diff_lines, max_tokens, packing, exclude, output, collapse_duplicates)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return json.dumps({**cached, "_debug": debug_info} if include_debug else cached, indent=2)
         
-        # Get diff statistics
-        stat_result = subprocess.run(
-            ["git", "diff", "--stat", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
+        # Files, statistics, commits and the (limited) diff for base...HEAD
+        analysis = await collect_file_changes(
+            cwd,
+            base_branch,
+            commit_range,
+            include_diff=include_diff,
+            max_diff_lines=max_diff_lines,
+            max_tokens=max_tokens,
+            packing=packing,
+            exclude=exclude,
+            timeout=timeout,
+            output=output,
+            include_uncommitted=include_uncommitted,
+            collapse_duplicates=collapse_duplicates
         )
+        if not analysis.get("timed_out"):
+            result_cache.put(cache_key, analysis, len(json.dumps(analysis)))
         
-        # Get the actual diff if requested
-        diff_content = ""
-        truncated = False
-        if include_diff:
-            diff_result = subprocess.run(
-                ["git", "diff", f"{base_branch}...HEAD"],
-                capture_output=True,
-                text=True,
-                cwd=cwd
-            )
-            diff_lines = diff_result.stdout.split('\n')
-            
-            # Check if we need to truncate
-            if len(diff_lines) > max_diff_lines:
-                diff_content = '\n'.join(diff_lines[:max_diff_lines])
-                diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {len(diff_lines)} lines ..."
-                diff_content += "\n... Use max_diff_lines parameter to see more ..."
-                truncated = True
-            else:
-                diff_content = diff_result.stdout
-        
-        # Get commit messages for context
-        commits_result = subprocess.run(
-            ["git", "log", "--oneline", f"{base_branch}..HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
+        return json.dumps({**analysis, "_debug": debug_info} if include_debug else analysis, indent=2)
         
-        analysis = {
-            "base_branch": base_branch,
-            "files_changed": files_result.stdout,
-            "statistics": stat_result.stdout,
-            "commits": commits_result.stdout,
-            "diff": diff_content if include_diff else "Diff not included (set include_diff=true to see full diff)",
-            "truncated": truncated,
-            "total_diff_lines": len(diff_lines) if include_diff else 0,
-            "_debug": debug_info
-        }
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_diff_page(cursor: str) -> str:
+    """Get the next page of a diff that analyze_file_changes truncated.
+    
+    Pages are sliced from a diff cached on the server, so walking a large
+    diff does not re-run git for every page.
+    
+    Args:
+        cursor: The next_cursor value from analyze_file_changes or a previous page
+    """
+    try:
+        page = await read_diff_page(cursor)
+        return json.dumps(page, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_file_diff(
+    path: str,
+    base_branch: str = "main",
+    max_diff_lines: int = 500,
+    exclude: Optional[List[str]] = None,
+    working_directory: Optional[str] = None
+) -> str:
+    """Get the diff of one changed file, or of all changed files matching a glob.
+    
+    Served from an index into the diff cached for the base/HEAD pair, so drilling
+    into a few files after analyze_file_changes does not re-run git diff.
+    
+    Args:
+        path: File path or glob pattern (e.g. 'src/*.py')
+        base_branch: Base branch to compare against (default: main)
+        max_diff_lines: Maximum number of diff lines to include across all files (default: 500)
+        exclude: Paths left out, see analyze_file_changes (default: lock files and build output)
+        working_directory: Directory to run git commands in (default: current directory)
+    """
+    try:
+        cwd = await resolve_working_directory(working_directory)
+        result = await read_file_diffs(cwd, base_branch, path, max_diff_lines, exclude_patterns(exclude))
+        return json.dumps(result, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_commit_range(
+    from_ref: Optional[str] = None,
+    to_ref: str = "HEAD",
+    include_diff: bool = True,
+    max_diff_lines: int = 200,
+    commits_per_page: int = 10,
+    cursor: Optional[str] = None,
+    exclude: Optional[List[str]] = None,
+    timeout: float = GIT_TIMEOUT,
+    working_directory: Optional[str] = None,
+    ctx: Context = None
+) -> str:
+    """Analyze any from..to range commit by commit, each with its own patch and statistics.
+    
+    The first call lists the files and statistics of the whole range plus the first page
+    of commits, oldest first. Pass next_cursor back to get the following commits. A
+    progress notification is sent as each commit is ready, and commits that do not finish
+    within the timeout are returned on the next page.
+    
+    Args:
+        from_ref: Start of the range, excluded like in `git log from..to` (required unless cursor is given)
+        to_ref: End of the range (default: HEAD)
+        include_diff: Include each commit's patch (default: true)
+        max_diff_lines: Maximum number of diff lines per commit (default: 200)
+        commits_per_page: Commits returned per call (default: 10)
+        cursor: The next_cursor value from a previous call; the other arguments are then ignored
+        exclude: Paths left out, see analyze_file_changes (default: lock files and build output)
+        timeout: Seconds allowed per call (default: 60)
+        working_directory: Directory to run git commands in (default: current directory)
+    """
+    try:
+        async def report(commit: dict, completed: int, total: int) -> None:
+            if ctx is not None:
+                await ctx.report_progress(completed, total, f"{commit['sha'][:12]} {commit['subject']}")
         
-        return json.dumps(analysis, indent=2)
+        if cursor:
+            page = await read_commit_page(cursor, timeout, on_commit=report)
+            return json.dumps(page, indent=2)
+        if not from_ref:
+            return json.dumps({"error": "from_ref is required unless cursor is given"})
         
+        cwd = await resolve_working_directory(working_directory)
+        result = await analyze_commit_range(
+            cwd,
+            from_ref,
+            to_ref,
+            include_patch=include_diff,
+            max_lines=max_diff_lines,
+            page_commits=commits_per_page,
+            exclude=exclude_patterns(exclude),
+            timeout=timeout,
+            on_commit=report
+        )
+        return json.dumps(result, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_change_metrics(
+    base_branch: str = "main",
+    directory_depth: int = 1,
+    exclude: Optional[List[str]] = None,
+    timeout: float = GIT_TIMEOUT,
+    working_directory: Optional[str] = None
+) -> str:
+    """Get aggregate statistics of the changes against a base branch, without the diff.
+    
+    Counts files and added/removed lines per extension, per directory and per category
+    (source, test, docs, generated), the per-file churn percentiles, the test-to-source
+    ratio and the largest changes. Computed from git's numstat on the server, so reports
+    can quote the numbers instead of counting them in the diff text.
+    
+    Args:
+        base_branch: Base branch to compare against (default: main)
+        directory_depth: Path components that make up a directory (default: 1, top-level)
+        exclude: Paths left out, see analyze_file_changes (default: lock files and build output)
+        timeout: Seconds after which git is stopped and partial counts are returned (default: 60)
+        working_directory: Directory to run git commands in (default: current directory)
+    """
+    try:
+        cwd = await resolve_working_directory(working_directory)
+        commit_range = await resolve_range(cwd, base_branch)
+        metrics = await collect_change_metrics(
+            cwd, base_branch, commit_range, directory_depth, exclude_patterns(exclude), timeout
+        )
+        return json.dumps(metrics, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_affected_tests(
+    base_branch: str = "main",
+    exclude: Optional[List[str]] = None,
+    timeout: float = GIT_TIMEOUT,
+    working_directory: Optional[str] = None
+) -> str:
+    """List the test files that depend on the files changed against a base branch.
+    
+    Follows Python imports from each changed file to the test modules that import it,
+    directly or through other modules, and shows the import chain for each test. The
+    import graph is stored in the git directory and updated from the tree diff to HEAD,
+    so after small changes only the changed files are parsed again. Changed files the
+    graph cannot follow (deleted or non-Python files) are listed under "unmapped_files".
+    
+    Args:
+        base_branch: Base branch to compare against (default: main)
+        exclude: Paths left out, see analyze_file_changes (default: lock files and build output)
+        timeout: Seconds allowed for each git command (default: 60)
+        working_directory: Directory to run git commands in (default: current directory)
+    """
+    try:
+        cwd = await resolve_working_directory(working_directory)
+        result = await find_affected_tests(cwd, base_branch, exclude_patterns(exclude), timeout)
+        return json.dumps(result, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def suggest_reviewers(
+    base_branch: str = "main",
+    max_reviewers: int = 5,
+    exclude: Optional[List[str]] = None,
+    timeout: float = GIT_TIMEOUT,
+    working_directory: Optional[str] = None
+) -> str:
+    """Suggest reviewers for the files changed against a base branch.
+    
+    Ranks people by how much of the recent history of each changed file they wrote,
+    falling back to the file's directory for new files, and leaves out the authors of
+    the change itself. Owners from the CODEOWNERS file are listed under "code_owners".
+    Commit history is indexed once in the git directory and only new commits are read
+    on later calls, so no git blame runs per file.
+    
+    Args:
+        base_branch: Base branch to compare against (default: main)
+        max_reviewers: Most reviewers to return (default: 5)
+        exclude: Paths left out, see analyze_file_changes (default: lock files and build output)
+        timeout: Seconds allowed for each git command (default: 60)
+        working_directory: Directory to run git commands in (default: current directory)
+    """
+    try:
+        cwd = await resolve_working_directory(working_directory)
+        result = await find_reviewers(cwd, base_branch, max_reviewers, exclude_patterns(exclude), timeout)
+        return json.dumps(result, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+async def prefetch_file_changes(cwd: str) -> None:
+    """Compute analyze_file_changes with its defaults so the next call is a cache hit."""
+    await analyze_file_changes(working_directory=cwd)
+
+
+@mcp.tool()
+async def watch_repository(enabled: bool = True, working_directory: Optional[str] = None) -> str:
+    """Start or stop precomputing analyze_file_changes in the background.
+    
+    While enabled, switching branches, committing or staging files in the repository
+    refreshes the analysis for the new HEAD, so the next analyze_file_changes call
+    is answered from the cache. Setting the PR_AGENT_WATCH environment variable
+    enables this on the first analyze_file_changes call.
+    
+    Args:
+        enabled: Start watching when true, stop when false (default: true)
+        working_directory: Repository to watch (default: current directory)
+    """
+    try:
+        cwd = await resolve_working_directory(working_directory)
+        if not enabled:
+            stopped = await stop_watching(cwd)
+            return json.dumps({"working_directory": cwd, "watching": False, "stopped": stopped}, indent=2)
+        watcher = await start_watching(cwd, lambda: prefetch_file_changes(cwd))
+        return json.dumps({"working_directory": cwd, "watching": True, "mode": watcher.mode}, indent=2)
     except subprocess.CalledProcessError as e:
         return json.dumps({"error": f"Git error: {e.stderr}"})
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
+@mcp.tool()
+async def analyze_repositories(
+    working_directories: Optional[List[str]] = None,
+    base_branch: str = "main",
+    include_diff: bool = True,
+    max_diff_lines: int = 500,
+    max_tokens: Optional[int] = None,
+    packing: str = "path",
+    exclude: Optional[List[str]] = None,
+    timeout: float = GIT_TIMEOUT,
+    output: str = "text",
+    include_uncommitted: bool = False,
+    collapse_duplicates: bool = False
+) -> str:
+    """Run analyze_file_changes for several repositories at once.
+    
+    Repositories are analyzed concurrently, at most REPOSITORY_CONCURRENCY at a time,
+    and the results are returned together with one section per repository.
+    
+    Args:
+        working_directories: Repositories to analyze (default: all MCP roots)
+        base_branch: Base branch to compare against in every repository (default: main)
+        include_diff: Include the diff content (default: true)
+        max_diff_lines: Maximum number of diff lines per repository (default: 500)
+        max_tokens: Token budget per repository (default: no budget)
+        packing: "path" or "priority", see analyze_file_changes (default: path)
+        exclude: Paths left out, see analyze_file_changes (default: lock files and build output)
+        timeout: Seconds allowed per repository before its partial result is returned (default: 60)
+        output: "text" or "hunks", see analyze_file_changes (default: text)
+        include_uncommitted: Also report uncommitted changes in each repository (default: false)
+        collapse_duplicates: Write repeated hunks once, see analyze_file_changes (default: false)
+    """
+    try:
+        if working_directories is None:
+            working_directories = [root.uri.path for root in await list_session_roots()]
+        working_directories = list(dict.fromkeys(working_directories))
+        
+        semaphore = asyncio.Semaphore(REPOSITORY_CONCURRENCY)
+        
+        async def analyze(cwd: str) -> dict:
+            async with semaphore:
+                result = await analyze_file_changes(
+                    base_branch=base_branch,
+                    include_diff=include_diff,
+                    max_diff_lines=max_diff_lines,
+                    max_tokens=max_tokens,
+                    packing=packing,
+                    exclude=exclude,
+                    timeout=timeout,
+                    output=output,
+                    include_uncommitted=include_uncommitted,
+                    collapse_duplicates=collapse_duplicates,
+                    working_directory=cwd
+                )
+            return {"working_directory": cwd, **json.loads(result)}
+        
+        repositories = await asyncio.gather(*(analyze(cwd) for cwd in working_directories))
+        return json.dumps({
+            "base_branch": base_branch,
+            "repositories": repositories,
+            "failed": sum(1 for repository in repositories if "error" in repository)
+        }, indent=2)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
 @mcp.tool()
 async def get_pr_templates() -> str:
     """List available PR templates with their content."""
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the file ownership index behind reviewer suggestions.
+These build the index for a throwaway repository.
+"""
+
+import os
+import subprocess
+from unittest.mock import patch
+import pytest
+import pytest_asyncio
+
+import ownership_index
+
+from git_analysis import close_object_pools, result_cache
+from ownership_index import (
+    OwnershipIndex,
+    codeowners_pattern,
+    find_reviewers,
+    load_ownership_index,
+    parse_codeowners
+)
+
+
+def git(cwd, *args):
+    """Run a git command synchronously for test setup."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def commit(cwd, author, message, date="2026-01-01T12:00:00"):
+    """Commit everything as author ("Name <email>") at date."""
+    name, email = author[:-1].split(" <")
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": name, "GIT_AUTHOR_EMAIL": email, "GIT_AUTHOR_DATE": date,
+        "GIT_COMMITTER_NAME": name, "GIT_COMMITTER_EMAIL": email, "GIT_COMMITTER_DATE": date
+    }
+    git(cwd, "add", "-A")
+    subprocess.run(["git", "commit", "-q", "-m", message], cwd=cwd, check=True, capture_output=True, env=env)
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def object_pools():
+    """Stop the shared cat-file workers before each test's event loop closes."""
+    yield
+    await close_object_pools()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """Old work by Ann, recent work by Bob, and a feature branch by Cat."""
+    git(tmp_path, "init", "-q", "-b", "main")
+    (tmp_path / "api").mkdir()
+    (tmp_path / "api/views.py").write_text("v1\n")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs/guide.md").write_text("guide\n")
+    (tmp_path / "CODEOWNERS").write_text("# Owners\n*.md @docs-team\n/api/ @api-team  # backend\n")
+    commit(tmp_path, "Ann <ann@example.com>", "Initial commit", "2022-01-01T12:00:00")
+    for version in range(2, 5):
+        (tmp_path / "api/views.py").write_text(f"v{version}\n")
+        commit(tmp_path, "Ann <ann@example.com>", f"Views v{version}", f"2022-02-0{version}T12:00:00")
+    (tmp_path / "api/views.py").write_text("v5\n")
+    commit(tmp_path, "Bob <bob@example.com>", "Views v5")
+    git(tmp_path, "checkout", "-q", "-b", "feature")
+    (tmp_path / "api/views.py").write_text("v6\n")
+    (tmp_path / "api/serializers.py").write_text("new\n")
+    (tmp_path / "setup.cfg").write_text("[metadata]\n")
+    commit(tmp_path, "Cat <cat@example.com>", "Add serializers")
+    return tmp_path
+
+
+class TestCodeowners:
+    """Test CODEOWNERS parsing and pattern matching."""
+
+    @pytest.mark.parametrize("pattern, path, matches", [
+        ("*", "any/file.py", True),
+        ("*.js", "web/app.js", True),
+        ("/build/", "build/out.txt", True),
+        ("/build/", "src/build/out.txt", False),
+        ("apps/", "src/apps/main.py", True),
+        ("docs/*", "docs/guide.md", True),
+        ("docs/*", "docs/api/index.md", False),
+        ("**/logs", "var/logs/today.log", True),
+        ("src/**/test_*.py", "src/a/b/test_x.py", True),
+        ("src/*.py", "lib/src/x.py", False)
+    ])
+    def test_patterns(self, pattern, path, matches):
+        assert bool(codeowners_pattern(pattern).fullmatch(path)) == matches
+
+    def test_last_matching_rule_wins(self):
+        rules = parse_codeowners("* @all\n\n# comment\n/api/ @api @lead # inline\n/api/legacy.py\n")
+        index = OwnershipIndex("c", [], 0, {}, {}, codeowners={"path": "CODEOWNERS", "sha": "s", "rules": rules})
+
+        assert index.code_owners("api/views.py") == ["@api", "@lead"]
+        assert index.code_owners("api/legacy.py") == []
+        assert index.code_owners("README.md") == ["@all"]
+
+
+class TestSuggestReviewers:
+    """Test ranking reviewers and maintaining the index."""
+
+    @pytest.mark.asyncio
+    async def test_recent_authors_rank_first(self, repo):
+        result = await find_reviewers(str(repo), "main")
+
+        assert [reviewer["email"] for reviewer in result["reviewers"]] == ["bob@example.com", "ann@example.com"]
+        assert result["reviewers"][0]["files"] == 3
+        assert result["excluded_authors"] == ["cat@example.com"]
+        assert result["code_owners"] == [{"owner": "@api-team", "files": ["api/serializers.py", "api/views.py"]}]
+        assert result["index"]["update"] == "full"
+        assert (repo / ".git" / "pr-agent" / "ownership.json").exists()
+
+    @pytest.mark.asyncio
+    async def test_index_is_updated_incrementally(self, repo):
+        await load_ownership_index(str(repo))
+        result_cache.clear()
+        (repo / "setup.cfg").write_text("[metadata]\nname = shop\n")
+        commit(repo, "Cat <cat@example.com>", "Name the package")
+
+        index, info = await load_ownership_index(str(repo))
+
+        assert info["update"] == "incremental"
+        assert info["read_commits"] == 1
+        assert info["indexed_commits"] == 7
+        assert "cat@example.com" in index.scores["setup.cfg"]
+
+    @pytest.mark.asyncio
+    async def test_switching_branches_does_not_count_commits_twice(self, repo):
+        await load_ownership_index(str(repo))
+        for branch in ("main", "feature"):
+            result_cache.clear()
+            git(repo, "checkout", "-q", branch)
+
+            _, info = await load_ownership_index(str(repo))
+
+            assert info["read_commits"] == 0
+            assert info["indexed_commits"] == 6
+
+    @pytest.mark.asyncio
+    async def test_rewritten_tip_rebuilds_the_index(self, repo):
+        await load_ownership_index(str(repo))
+        git(repo, "checkout", "-q", "main")
+        (repo / "docs/guide.md").write_text("guide v2\n")
+        commit(repo, "Bob <bob@example.com>", "Update guide")
+        result_cache.clear()
+        index, _ = await load_ownership_index(str(repo))
+        assert len(index.tips) == 2
+
+        # Force-push style rewrite of the feature tip, with the old commit pruned
+        git(repo, "checkout", "-q", "feature")
+        (repo / "setup.cfg").write_text("[metadata]\nname = shop\n")
+        git(repo, "reset", "-q", "--soft", "HEAD~1")
+        commit(repo, "Cat <cat@example.com>", "Add serializers and name the package")
+        git(repo, "reflog", "expire", "--expire=now", "--all")
+        git(repo, "gc", "-q", "--prune=now")
+        await close_object_pools()
+        result_cache.clear()
+
+        index, info = await load_ownership_index(str(repo))
+
+        assert info["update"] == "full"
+        assert info["indexed_commits"] == 6
+        assert index.tips == [git(repo, "rev-parse", "HEAD").strip()]
+
+    @pytest.mark.asyncio
+    async def test_too_many_new_commits_rebuild_the_index(self, repo):
+        await load_ownership_index(str(repo))
+        result_cache.clear()
+        for version in range(2, 4):
+            (repo / "setup.cfg").write_text(f"[metadata]\nversion = {version}\n")
+            commit(repo, "Cat <cat@example.com>", f"Version {version}")
+
+        with patch.object(ownership_index, "HISTORY_MAX_COMMITS", 2):
+            _, info = await load_ownership_index(str(repo))
+
+        assert info["update"] == "full"
+        assert info["indexed_commits"] == 2
+
+    @pytest.mark.asyncio
+    async def test_stored_index_is_reused_by_a_new_process(self, repo):
+        await load_ownership_index(str(repo))
+        result_cache.clear()
+
+        _, info = await load_ownership_index(str(repo))
+
+        assert info["update"] == "loaded"
@@ -5,10 +5,14 @@ Run these tests to validate your implementation
 """
 
 import json
+import subprocess
 import pytest
+import pytest_asyncio
 import asyncio
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from git_analysis import DiffAnalysis, FileChange, close_object_pools
 
 # Import your implemented functions
 try:
@@ -16,7 +20,13 @@ try:
         mcp,
         analyze_file_changes,
         get_pr_templates,
-        suggest_template
+        suggest_template,
+        handle_roots_list_changed,
+        resolve_working_directory,
+        watch_repository,
+        analyze_repositories,
+        get_commit_range,
+        get_file_diff
     )
     IMPORTS_SUCCESSFUL = True
 except ImportError as e:
@@ -24,6 +34,13 @@ except ImportError as e:
     IMPORT_ERROR = str(e)
 
 
+@pytest_asyncio.fixture(autouse=True)
+async def object_pools():
+    """Stop the shared cat-file workers before each test's event loop closes."""
+    yield
+    await close_object_pools()
+
+
 class TestImplementation:
     """Test that the required functions are implemented."""
     
@@ -43,8 +60,13 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_returns_json_string(self):
         """Test that analyze_file_changes returns a JSON string."""
-        with patch('subprocess.run') as mock_run:
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.return_value = DiffAnalysis()
             mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = ""
             
             result = await analyze_file_changes()
             
@@ -56,8 +78,13 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_includes_required_fields(self):
         """Test that the result includes expected fields."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(stdout="M\tfile1.py\n", stderr="")
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.return_value = DiffAnalysis(files=[FileChange(status="M", path="file1.py")])
+            mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = "abc123 Initial commit\n"
             
             result = await analyze_file_changes()
             data = json.loads(result)
@@ -68,6 +95,7 @@ class TestAnalyzeFileChanges:
                 # Check for some expected fields (flexible to allow different implementations)
                 assert any(key in data for key in ["files_changed", "files", "changes", "diff"]), \
                     "Result should include file change information"
+                assert data["commits"] == "abc123 Initial commit\n"
             else:
                 # Starter code - just verify it returns something structured
                 assert isinstance(data, dict), "Should return a JSON object even if not implemented"
@@ -75,17 +103,21 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_output_limiting(self):
         """Test that large diffs are properly truncated."""
-        with patch('subprocess.run') as mock_run:
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
             # Create a mock diff with many lines
             large_diff = "\n".join([f"+ line {i}" for i in range(1000)])
             
             # Set up mock responses
-            mock_run.side_effect = [
-                MagicMock(stdout="M\tfile1.py\n", stderr=""),  # files changed
-                MagicMock(stdout="1 file changed, 1000 insertions(+)", stderr=""),  # stats
-                MagicMock(stdout=large_diff, stderr=""),  # diff
-                MagicMock(stdout="abc123 Initial commit", stderr="")  # commits
-            ]
+            mock_diff.return_value = DiffAnalysis(
+                files=[FileChange(status="M", path="file1.py", added=1000, deleted=0)],
+                patch=large_diff,
+                total_lines=1000
+            )
+            mock_run.return_value = MagicMock(stdout="", stderr="")  # excluded files
+            mock_log.return_value = "abc123 Initial commit\n"
             
             # Test with default limit (500 lines)
             result = await analyze_file_changes(include_diff=True)
@@ -106,6 +138,229 @@ class TestAnalyzeFileChanges:
                     assert "truncated" in data["diff"].lower() or "..." in data["diff"], \
                         "Should indicate diff was truncated"
 
+    @pytest.mark.asyncio
+    async def test_truncated_diff_returns_cursor(self):
+        """Test that a truncated diff hands out a cursor for the next page."""
+        with patch('server.resolve_range', new_callable=AsyncMock) as mock_range, \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_range.return_value = ("base-sha-for-cursor-test", "head-sha-for-cursor-test")
+            mock_diff.return_value = DiffAnalysis(
+                files=[FileChange(status="M", path="file1.py", added=1000, deleted=0)],
+                patch="".join(f"+ line {i}\n" for i in range(100)),
+                total_lines=1000
+            )
+            mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = "abc123 Initial commit\n"
+            
+            data = json.loads(await analyze_file_changes(max_diff_lines=100, working_directory="/tmp"))
+            
+            assert data["truncated"] is True
+            assert data["next_cursor"], "Truncated diffs should include a cursor"
+            assert data["commits"] == "abc123 Initial commit\n"
+            assert "get_diff_page" in data["diff"]
+
+    
+    @pytest.mark.asyncio
+    async def test_repeated_calls_use_cache(self):
+        """Test that a second call for the same commit pair does not run git diff again."""
+        with patch('server.resolve_range', new_callable=AsyncMock) as mock_range, \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_range.return_value = ("base-sha-for-cache-test", "head-sha-for-cache-test")
+            mock_diff.return_value = DiffAnalysis(files=[FileChange(status="M", path="file1.py")])
+            mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = "abc123 Initial commit\n"
+            
+            first = json.loads(await analyze_file_changes(working_directory="/tmp"))
+            second = json.loads(await analyze_file_changes(working_directory="/tmp"))
+            
+            assert mock_diff.await_count == 1, "Second call should be served from the cache"
+            assert first["files_changed"] == second["files_changed"]
+            assert mock_log.await_count == 1
+            assert second["commits"] == "abc123 Initial commit\n"
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestGetFileDiff:
+    """Test the get_file_diff tool."""
+    
+    @pytest.mark.asyncio
+    async def test_shares_snapshot_with_analyze_file_changes(self, tmp_path):
+        """Test that drilling into a file after a packed analysis does not run git diff again."""
+        def git(*args):
+            subprocess.run(["git", *args], cwd=tmp_path, check=True, capture_output=True)
+        git("init", "-q", "-b", "main")
+        git("config", "user.email", "dev@example.com")
+        git("config", "user.name", "Dev")
+        (tmp_path / "app.py").write_text("a\n")
+        git("add", ".")
+        git("commit", "-q", "-m", "Initial commit")
+        git("checkout", "-q", "-b", "feature")
+        (tmp_path / "app.py").write_text("a\nb\n")
+        git("commit", "-q", "-am", "Extend app")
+        
+        import git_analysis
+        original = git_analysis._stream_diff
+        calls = []
+        
+        async def counting_stream_diff(*args, **kwargs):
+            calls.append(args)
+            return await original(*args, **kwargs)
+        
+        with patch('git_analysis._stream_diff', counting_stream_diff):
+            await analyze_file_changes(max_tokens=2000, working_directory=str(tmp_path))
+            data = json.loads(await get_file_diff("app.py", working_directory=str(tmp_path)))
+        
+        assert "+b" in data["files"][0]["diff"]
+        assert len(calls) == 1, "get_file_diff should reuse the snapshot analyze_file_changes built"
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestRootsCache:
+    """Test that MCP roots are fetched once per session."""
+    
+    class FakeSession:
+        def __init__(self, path):
+            root = MagicMock()
+            root.uri.path = path
+            self.list_roots = AsyncMock(return_value=MagicMock(roots=[root]))
+    
+    @pytest.mark.asyncio
+    async def test_roots_cached_until_list_changed(self):
+        """Test that roots are requested once and again after roots/list_changed."""
+        session = self.FakeSession("/work/repo")
+        with patch('server.mcp.get_context', return_value=MagicMock(session=session)):
+            assert await resolve_working_directory(None) == "/work/repo"
+            assert await resolve_working_directory(None) == "/work/repo"
+            assert session.list_roots.await_count == 1, "Roots should be cached per session"
+            
+            await handle_roots_list_changed(MagicMock())
+            await resolve_working_directory(None)
+            assert session.list_roots.await_count == 2, "Cache should be dropped on list_changed"
+    
+    @pytest.mark.asyncio
+    async def test_debug_is_opt_in(self):
+        """Test that _debug is only returned when requested."""
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.return_value = DiffAnalysis()
+            mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = ""
+            
+            plain = json.loads(await analyze_file_changes())
+            debug = json.loads(await analyze_file_changes(include_debug=True))
+            
+            assert "_debug" not in plain
+            assert "roots_check" in debug["_debug"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestAnalyzeRepositories:
+    """Test the batch multi-repository tool."""
+    
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency_and_sections(self):
+        """Test that every repository gets a section and at most REPOSITORY_CONCURRENCY run at once."""
+        active = 0
+        peak = 0
+        
+        async def fake_analyze(**kwargs):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            if kwargs["working_directory"] == "/repos/broken":
+                return json.dumps({"error": "Git error: not a git repository"})
+            return json.dumps({"files_changed": f"M\t{kwargs['working_directory']}.py\n"})
+        
+        directories = [f"/repos/service-{i}" for i in range(9)] + ["/repos/broken"]
+        with patch('server.analyze_file_changes', side_effect=fake_analyze), \
+             patch('server.REPOSITORY_CONCURRENCY', 3):
+            data = json.loads(await analyze_repositories(working_directories=directories))
+        
+        assert [repo["working_directory"] for repo in data["repositories"]] == directories
+        assert data["repositories"][0]["files_changed"] == "M\t/repos/service-0.py\n"
+        assert data["failed"] == 1
+        assert peak == 3
+    
+    @pytest.mark.asyncio
+    async def test_defaults_to_all_roots(self):
+        """Test that all MCP roots are analyzed when no directories are given."""
+        roots = [MagicMock(), MagicMock()]
+        roots[0].uri.path, roots[1].uri.path = "/repos/a", "/repos/b"
+        with patch('server.list_session_roots', new_callable=AsyncMock, return_value=roots), \
+             patch('server.analyze_file_changes', new_callable=AsyncMock, return_value="{}"):
+            data = json.loads(await analyze_repositories())
+        
+        assert [repo["working_directory"] for repo in data["repositories"]] == ["/repos/a", "/repos/b"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestWatchRepository:
+    """Test the background prefetch watcher tool."""
+    
+    @pytest.mark.asyncio
+    async def test_watcher_prefetches_analysis(self):
+        """Test that the watcher callback warms analyze_file_changes for the repository."""
+        with patch('server.start_watching', new_callable=AsyncMock) as mock_start, \
+             patch('server.analyze_file_changes', new_callable=AsyncMock) as mock_analyze:
+            mock_start.return_value = MagicMock(mode="polling")
+            
+            data = json.loads(await watch_repository(working_directory="/tmp"))
+            callback = mock_start.await_args.args[1]
+            await callback()
+            
+            assert data == {"working_directory": "/tmp", "watching": True, "mode": "polling"}
+            mock_analyze.assert_awaited_once_with(working_directory="/tmp")
+    
+    @pytest.mark.asyncio
+    async def test_disable_without_watcher(self):
+        """Test that stopping a repository that is not watched is reported."""
+        data = json.loads(await watch_repository(enabled=False, working_directory="/tmp"))
+        
+        assert data["watching"] is False
+        assert data["stopped"] is False
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestGetCommitRange:
+    """Test the per-commit range tool."""
+    
+    @pytest.mark.asyncio
+    async def test_reports_progress_per_commit(self):
+        """Test that each finished commit is sent as a progress notification."""
+        async def fake_range(cwd, from_ref, to_ref, **kwargs):
+            for completed, sha in enumerate(["a" * 40, "b" * 40], start=1):
+                await kwargs["on_commit"]({"sha": sha, "subject": f"Commit {completed}"}, completed, 2)
+            return {"commits": [], "next_cursor": None}
+        
+        ctx = MagicMock()
+        ctx.report_progress = AsyncMock()
+        with patch('server.analyze_commit_range', side_effect=fake_range):
+            data = json.loads(await get_commit_range(from_ref="v1.0", working_directory="/tmp", ctx=ctx))
+        
+        assert data == {"commits": [], "next_cursor": None}
+        assert ctx.report_progress.await_args_list[1].args == (2, 2, "bbbbbbbbbbbb Commit 2")
+    
+    @pytest.mark.asyncio
+    async def test_requires_from_ref_or_cursor(self):
+        """Test that a call without a range or cursor returns an error."""
+        data = json.loads(await get_commit_range())
+        
+        assert "error" in data
+    
+    def test_context_is_not_a_tool_parameter(self):
+        """Test that the MCP context is injected rather than exposed to clients."""
+        tool = mcp._tool_manager.get_tool("get_commit_range")
+        
+        assert "ctx" not in tool.parameters["properties"]
+
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestGetPRTemplates:
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Check that the git helper modules copied into the other unit 3 projects
+match the ones in this directory. Each project runs on its own, so the
+modules are copied rather than imported; edit them here and copy them over.
+"""
+
+import hashlib
+from pathlib import Path
+import pytest
+
+HERE = Path(__file__).resolve().parent
+UNIT_DIR = HERE.parents[1]
+
+# Modules kept identical across projects, with their tests
+SHARED_MODULES = (
+    "git_analysis.py", "test_git_analysis.py",
+    "repo_watcher.py", "test_repo_watcher.py",
+    "import_graph.py", "test_import_graph.py",
+    "ownership_index.py", "test_ownership_index.py"
+)
+
+
+def digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+@pytest.mark.parametrize("name", SHARED_MODULES)
+def test_copies_match(name):
+    copies = [path for path in sorted(UNIT_DIR.glob(f"*/*/{name}")) if path.parent != HERE]
+    assert copies, f"{name} is not used by any other project"
+
+    drifted = [str(path.relative_to(UNIT_DIR)) for path in copies if digest(path) != digest(HERE / name)]
+
+    assert not drifted, f"Copies of {name} differ from build-mcp-server/solution: {', '.join(drifted)}"
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Commit message classifier for analyze_commit_messages.
+A Conventional Commits prefix ("fix(api)!: ...") decides the type on its own;
+other subjects are scanned once with a single prefix-factored regex over
+the TYPE_MAPPING keywords, and the type with the highest weighted score wins.
+"""
+
+import re
+from pathlib import Path
+
+# Keywords that identify a kind of change, and the PR template used for it
+TYPE_MAPPING = {
+    "bug": "bug.md",
+    "fix": "bug.md",
+    "feature": "feature.md",
+    "enhancement": "feature.md",
+    "docs": "docs.md",
+    "documentation": "docs.md",
+    "refactor": "refactor.md",
+    "cleanup": "refactor.md",
+    "test": "test.md",
+    "testing": "test.md",
+    "performance": "performance.md",
+    "optimization": "performance.md",
+    "security": "security.md"
+}
+
+# Commit types, in the order they are reported and preferred on a tied score
+COMMIT_TYPES = ("feature", "bug", "docs", "refactor", "test", "performance", "security")
+
+# Conventional Commits types and the commit type they stand for; types such as
+# chore or ci are not listed, so their descriptions are classified by keyword
+CONVENTIONAL_TYPES = {
+    "feat": "feature",
+    "feature": "feature",
+    "fix": "bug",
+    "bugfix": "bug",
+    "hotfix": "bug",
+    "docs": "docs",
+    "doc": "docs",
+    "refactor": "refactor",
+    "style": "refactor",
+    "test": "test",
+    "tests": "test",
+    "perf": "performance",
+    "security": "security",
+    "sec": "security"
+}
+
+# A keyword at the start of the subject names what the commit does ("Fix ...",
+# "Refactor ..."); later keywords usually describe what it touches
+LEADING_WEIGHT = 2
+KEYWORD_WEIGHT = 1
+
+# Inflections that still count as the keyword ("fixes", "refactored", "tests")
+KEYWORD_SUFFIXES = ("", "s", "es", "d", "ed", "ing")
+
+_CONVENTIONAL = re.compile(r"\s*([a-z]+)(?:\([^)]*\))?!?:\s")
+
+
+def _trie_pattern(words) -> str:
+    """Build a regex alternation for the words with shared prefixes factored out.
+
+    "fix" and "feature" become "f(?:eature|ix)", so the engine tests each
+    position against one branch per distinct first letter instead of every word.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 and "" not in node else "(?:" + "|".join(branches) + ")"
+        return body + "?" if "" in node else body
+
+    return build(trie)
+
+
+_KEYWORD_TYPES = {keyword: Path(template).stem for keyword, template in TYPE_MAPPING.items()}
+_KEYWORDS = re.compile(
+    rf"\b{_trie_pattern(_KEYWORD_TYPES)}(?:{'|'.join(suffix for suffix in KEYWORD_SUFFIXES if suffix)})?\b"
+)
+# Every spelling the pattern can match, so a match is typed with one dict lookup
+_FORM_TYPES = {
+    keyword + suffix: commit_type
+    for keyword, commit_type in _KEYWORD_TYPES.items()
+    for suffix in KEYWORD_SUFFIXES
+}
+
+
+def classify_commit(subject: str) -> str:
+    """Return the commit type of a subject line, or "other".
+
+    "feat(api): ..." is a feature whatever the description says. Otherwise
+    every keyword scores KEYWORD_WEIGHT, or LEADING_WEIGHT when it is the
+    first word, and ties go to the type listed first in COMMIT_TYPES.
+    """
+    text = subject.lower()
+    prefix = _CONVENTIONAL.match(text) if ":" in text else None
+    if prefix:
+        commit_type = CONVENTIONAL_TYPES.get(prefix.group(1))
+        if commit_type:
+            return commit_type
+        text = text[prefix.end():]
+
+    words = _KEYWORDS.findall(text)
+    if not words:
+        return "other"
+    if len(words) == 1:
+        return _FORM_TYPES[words[0]]
+
+    # Dict order follows COMMIT_TYPES, so max() breaks ties by priority
+    scores = dict.fromkeys(COMMIT_TYPES, 0)
+    for word in words:
+        scores[_FORM_TYPES[word]] += KEYWORD_WEIGHT
+    if _KEYWORDS.match(text.lstrip()):
+        scores[_FORM_TYPES[words[0]]] += LEADING_WEIGHT - KEYWORD_WEIGHT
+    return max(scores, key=scores.get)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+SQLite index of commit metadata for analyze_commit_messages.
+Every commit is read from git and classified once; later calls over the same
+or an overlapping range only fetch the commits that are not indexed yet and
+aggregate the rest with SQL.
+"""
+
+import asyncio
+import os
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from commit_classifier import COMMIT_TYPES, classify_commit
+from git_analysis import LogRecord, run_git, stream_log
+
+# Location of the database, relative to the git directory
+INDEX_PATH = "pr-agent/commits.sqlite"
+
+# Stored with the index; when it changes, every indexed subject is classified again
+CLASSIFIER_VERSION = "weighted-keywords-1"
+
+# Commits requested from git per `git log --no-walk` call
+FETCH_BATCH_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS commits (
+    sha TEXT PRIMARY KEY,
+    subject TEXT NOT NULL,
+    author TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    files TEXT NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS commits_type ON commits (type);
+"""
+
+def index_row(record: LogRecord) -> Tuple[str, str, str, int, str]:
+    """Turn a streamed commit into a (sha, subject, author, date, files) row."""
+    date = int(datetime.fromisoformat(record.author_date).timestamp())
+    files = "\n".join(record.files)
+    return record.sha, record.subject, record.author, date, files
+
+
+class CommitIndex:
+    """The commit database of one repository.
+
+    Methods are synchronous and open their own connection, so they can run
+    in an executor thread without sharing sqlite objects between threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        version = connection.execute("SELECT value FROM meta WHERE key = 'classifier'").fetchone()
+        if version is None or version[0] != CLASSIFIER_VERSION:
+            with connection:
+                subjects = connection.execute("SELECT sha, subject FROM commits").fetchall()
+                connection.executemany(
+                    "UPDATE commits SET type = ? WHERE sha = ?",
+                    [(classify_commit(subject), sha) for sha, subject in subjects]
+                )
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('classifier', ?)", (CLASSIFIER_VERSION,)
+                )
+        return connection
+
+    def missing(self, shas: List[str]) -> List[str]:
+        """Return the SHAs that are not indexed yet, in the given order."""
+        connection = self._connect()
+        try:
+            self._load_range(connection, shas)
+            known = {row[0] for row in connection.execute(
+                "SELECT sha FROM commits WHERE sha IN (SELECT sha FROM range)"
+            )}
+        finally:
+            connection.close()
+        return [sha for sha in shas if sha not in known]
+
+    def add(self, rows: List[Tuple[str, str, str, int, str]]) -> None:
+        """Index (sha, subject, author, date, files) rows, classifying each subject."""
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO commits (sha, subject, author, date, files, type) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(*row, classify_commit(row[1])) for row in rows]
+                )
+        finally:
+            connection.close()
+
+    def summarize(self, shas: List[str]) -> Tuple[Dict[str, int], List[str]]:
+        """Count the commit types of a range and return its subjects in the given order."""
+        connection = self._connect()
+        try:
+            self._load_range(connection, shas)
+            counts = dict(connection.execute(
+                "SELECT type, COUNT(*) FROM commits WHERE sha IN (SELECT sha FROM range) GROUP BY type"
+            ).fetchall())
+            subjects = [row[0] for row in connection.execute(
+                "SELECT commits.subject FROM range JOIN commits USING (sha) ORDER BY range.position"
+            )]
+        finally:
+            connection.close()
+        return counts, subjects
+
+    @staticmethod
+    def _load_range(connection: sqlite3.Connection, shas: List[str]) -> None:
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS range (position INTEGER PRIMARY KEY, sha TEXT NOT NULL)")
+        connection.execute("DELETE FROM range")
+        connection.executemany("INSERT INTO range (position, sha) VALUES (?, ?)", enumerate(shas))
+
+
+async def open_commit_index(cwd: str, timeout: Optional[float] = None) -> CommitIndex:
+    """Return the commit index stored in the repository's git directory."""
+    result = await run_git(["git", "rev-parse", "--git-path", INDEX_PATH], cwd, check=True, timeout=timeout)
+    return CommitIndex(os.path.join(cwd, result.stdout.strip()))
+
+
+async def summarize_range(cwd: str, revision_range: str, timeout: Optional[float] = None) -> dict:
+    """Count commit types and list subjects for a revision range such as "main..HEAD".
+
+    Only the SHAs of the range come from git on every call (`git rev-list`);
+    commits missing from the index are read in batches and classified once.
+    Returns {"total_commits", "commit_types", "commit_messages", "indexed"},
+    where indexed is the number of commits added by this call.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    revisions, index = await asyncio.gather(
+        run_git(["git", "rev-list", revision_range], cwd, check=True, timeout=timeout),
+        open_commit_index(cwd, timeout)
+    )
+    shas = revisions.stdout.split()
+
+    missing = await loop.run_in_executor(None, index.missing, shas)
+    for start in range(0, len(missing), FETCH_BATCH_SIZE):
+        batch = missing[start:start + FETCH_BATCH_SIZE]
+        rows = [
+            index_row(record)
+            async for record in stream_log(cwd, ["--no-walk=unsorted", *batch], name_only=True, deadline=deadline)
+        ]
+        await loop.run_in_executor(None, index.add, rows)
+
+    counts, subjects = await loop.run_in_executor(None, index.summarize, shas)
+    return {
+        "total_commits": len(shas),
+        "commit_types": {commit_type: counts.get(commit_type, 0) for commit_type in (*COMMIT_TYPES, "other")},
+        "commit_messages": subjects,
+        "indexed": len(missing)
+    }
@@ -3,6 +3,7 @@
 Module 1: Basic MCP Server - Starter Code
 TODO: Implement tools for analyzing git changes and suggesting PR templates
 """
+import asyncio
 import os
 import json
 import subprocess
@@ -10,6 +11,19 @@ from pathlib import Path
 from typing import Optional
 
 from mcp.server.fastmcp import FastMCP
+
+from commit_classifier import TYPE_MAPPING
+from commit_index import summarize_range
+from git_analysis import (
+    GIT_TIMEOUT,
+    collect_file_changes,
+    exclude_patterns,
+    resolve_head,
+    resolve_range,
+    result_cache,
+    run_git
+)
+from repo_watcher import WATCH_ENV_VAR, start_watching, stop_watching
 import logging
 
 # Set up logging
@@ -64,27 +78,15 @@ DEFAULT_TEMPLATES= {
 # Minimal stub implementations so the server runs
 # TODO: Replace these with your actual implementations
 
-TYPE_MAPPING ={
-    "bug": "bug.md",
-    "fix" : "bug.md",
-    "feature": "feature.md",
-    "enhancment": "feature.md",
-    "docs": "docs.md",
-    "documentation":"docs.md",
-    "refractor": "refactor.md",
-    "cleanup": "refractor.md",
-    "test": "test.md",
-    "testing":"test.md",
-    "performance": "performance.md",
-    "optimization" : "performance.md",
-    "security": "security.md"
-}
-
 @mcp.tool()
 async def analyze_file_changes(base_branch: str = "main", include_diff: bool = True,max_diff_lines: int = 500,
                                working_directory :Optional[str]= None) -> str:
     """Get the full diff and list of changed files in the current git repository.
     
+    Lock files and build output are left out and only counted (see PR_AGENT_EXCLUDE). If git
+    does not finish within GIT_TIMEOUT seconds, the parts that did are returned with
+    "timed_out" set.
+    
     Args:
         base_branch: Base branch to compare against (default: main)
         include_diff: Include the full diff content (default: true)
@@ -136,59 +138,23 @@ async def analyze_file_changes(base_branch: str = "main", include_diff: bool = T
                 "error": str(e)
             }
 
-        logger.info("Running git diff --name-status")
-        files_result = subprocess.run(
-            ["git", "diff", "--name-status", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            check=True,
-            cwd=cwd
+        # One streamed git diff of base_branch...HEAD (the merge base, like a PR)
+        # yields the files, statistics and first max_diff_lines lines, with the
+        # log next to it. git is stopped if the call is cancelled or runs past
+        # GIT_TIMEOUT, and what finished is returned with "timed_out" set.
+        # No commit range is passed: the starter has no get_diff_page tool to
+        # hand a cursor to.
+        logger.info("Running git diff and git log")
+        analysis = await collect_file_changes(
+            cwd,
+            base_branch,
+            None,
+            include_diff=include_diff,
+            max_diff_lines=max_diff_lines,
+            exclude=exclude_patterns(),
+            timeout=GIT_TIMEOUT
         )
-        logger.info("Running git diff --stat")
-        stat_result = subprocess.run(
-            ["git", "diff", "--stat", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-        diff_content = ""
-        truncated = False
-        if include_diff:
-            logger.info("Running git diff for full diff")
-            diff_result = subprocess.run(
-                ["git", "diff", f"{base_branch}..HEAD"],
-                capture_output=True,
-                text=True,
-                cwd=cwd
-            )
-            diff_lines = diff_result.stdout.split('\n')
-            logger.debug(f"Total diff lines: {len(diff_lines)}")
-            if len(diff_lines) > max_diff_lines:
-                logger.info("Diff is too large, truncating output")
-                diff_content = '\n'.join(diff_lines[:max_diff_lines])
-                diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {len(diff_lines)} lines ..."
-                diff_content += "\n... Use max_diff_lines parameter to see more ..."
-                truncated = True
-            else:
-                diff_content = diff_result.stdout
-
-        logger.info("Running git log --oneline")
-        commits_result = subprocess.run(
-            ["git", "log", "--oneline", f"{base_branch}..HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-        analysis = {
-            "base_branch": base_branch,
-            "files_changed": files_result.stdout,
-            "statistics": stat_result.stdout,
-            "commits": commits_result.stdout,
-            "diff": diff_content if include_diff else "Diff not included (set include_diff=true to see full diff)",
-            "truncated": truncated,
-            "total_diff_lines": len(diff_lines) if include_diff else 0,
-            "_debug": debug_info
-        }
+        analysis["_debug"] = debug_info
         logger.info("Analysis complete, returning result")
         return json.dumps(analysis, indent=2)
     except subprocess.CalledProcessError as e:
@@ -259,28 +225,20 @@ async def get_repository_info(working_directory: Optional[str] = None) -> str:
     try:
         cwd = working_directory if working_directory else os.getcwd()
         
-        # Get repository name
-        remote_result = subprocess.run(
-            ["git", "remote", "get-url", "origin"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-        
-        # Get current branch
-        branch_result = subprocess.run(
-            ["git", "branch", "--show-current"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
+        # HEAD, branch and config mtime identify the answer, so reuse it while they are unchanged
+        head_state = await resolve_head(cwd)
+        cache_key = ("get_repository_info", cwd, *head_state) if head_state else None
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Serving repository info from cache")
+            return cached
         
-        # Get last commit info
-        commit_result = subprocess.run(
-            ["git", "log", "-1", "--pretty=format:%H|%s|%an|%ad", "--date=short"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
+        # Get repository name, current branch and last commit info; git is
+        # stopped if the call is cancelled or runs past GIT_TIMEOUT
+        remote_result, branch_result, commit_result = await asyncio.gather(
+            run_git(["git", "remote", "get-url", "origin"], cwd, timeout=GIT_TIMEOUT),
+            run_git(["git", "branch", "--show-current"], cwd, timeout=GIT_TIMEOUT),
+            run_git(["git", "log", "-1", "--pretty=format:%H|%s|%an|%ad", "--date=short"], cwd, timeout=GIT_TIMEOUT)
         )
         
         info = {
@@ -290,7 +248,9 @@ async def get_repository_info(working_directory: Optional[str] = None) -> str:
             "working_directory": cwd
         }
         
-        return json.dumps(info, indent=2)
+        result = json.dumps(info, indent=2)
+        result_cache.put(cache_key, result, len(result))
+        return result
     except Exception as e:
         return json.dumps({"error": str(e)})
 
@@ -338,43 +298,24 @@ async def analyze_commit_messages(base_branch: str = "main", working_directory:
     try:
         cwd = working_directory if working_directory else os.getcwd()
         
-        # Get commit messages
-        commits_result = subprocess.run(
-            ["git", "log", "--pretty=format:%s", f"{base_branch}..HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-        
-        if commits_result.returncode != 0:
-            return json.dumps({"error": "Failed to get commit messages"})
+        # Keep the results for this repository warm in the background (opt-in)
+        if os.environ.get(WATCH_ENV_VAR):
+            await start_watching(cwd, lambda: prefetch_repository_state(cwd), prefetch=False)
         
-        commit_messages = commits_result.stdout.strip().split('\n') if commits_result.stdout.strip() else []
-        
-        # Analyze commit types
-        commit_types = {
-            "feature": 0,
-            "bug": 0,
-            "docs": 0,
-            "refactor": 0,
-            "test": 0,
-            "performance": 0,
-            "security": 0,
-            "other": 0
-        }
+        # The commits between an immutable (merge-base, HEAD) pair never change
+        commit_range = await resolve_range(cwd, base_branch)
+        cache_key = ("analyze_commit_messages", cwd, *commit_range) if commit_range else None
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Serving commit analysis from cache")
+            return cached
         
-        for message in commit_messages:
-            message_lower = message.lower()
-            categorized = False
-            
-            for commit_type in commit_types.keys():
-                if commit_type in message_lower:
-                    commit_types[commit_type] += 1
-                    categorized = True
-                    break
-            
-            if not categorized:
-                commit_types["other"] += 1
+        # Commits are read from git and classified once, then kept in an index in the
+        # git directory; only commits that are new since the last call are fetched.
+        # git is stopped if the call is cancelled or runs past GIT_TIMEOUT.
+        summary = await summarize_range(cwd, f"{base_branch}..HEAD", timeout=GIT_TIMEOUT)
+        commit_messages = summary["commit_messages"]
+        commit_types = summary["commit_types"]
         
         # Find the most common commit type
         suggested_template = "feature"  # default
@@ -392,7 +333,43 @@ async def analyze_commit_messages(base_branch: str = "main", working_directory:
             "suggested_template": suggested_template
         }
         
-        return json.dumps(analysis, indent=2)
+        result = json.dumps(analysis, indent=2)
+        result_cache.put(cache_key, result, len(result))
+        return result
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+async def prefetch_repository_state(cwd: str) -> None:
+    """Compute the commit analysis and repository info so the next calls are cache hits."""
+    logger.info(f"Repository state changed, prefetching results for {cwd}")
+    await analyze_commit_messages(working_directory=cwd)
+    await get_repository_info(working_directory=cwd)
+
+# Example: Tool that manages a background task
+@mcp.tool()
+async def watch_repository(enabled: bool = True, working_directory: Optional[str] = None) -> str:
+    """Start or stop precomputing analyze_commit_messages and get_repository_info in the background.
+    
+    While enabled, switching branches, committing or staging files refreshes both results,
+    so the next call is answered from the cache. Setting the PR_AGENT_WATCH environment
+    variable enables this on the first analyze_commit_messages call.
+    
+    Args:
+        enabled: Start watching when true, stop when false (default: true)
+        working_directory: Repository to watch (optional)
+    """
+    try:
+        cwd = working_directory if working_directory else os.getcwd()
+        if not enabled:
+            stopped = await stop_watching(cwd)
+            return json.dumps({"working_directory": cwd, "watching": False, "stopped": stopped}, indent=2)
+        watcher = await start_watching(cwd, lambda: prefetch_repository_state(cwd))
+        logger.info(f"Watching {cwd} using {watcher.mode}")
+        return json.dumps({"working_directory": cwd, "watching": True, "mode": watcher.mode}, indent=2)
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
     except Exception as e:
         return json.dumps({"error": str(e)})
 
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the commit message classifier.
+"""
+
+import os
+import time
+import pytest
+
+from commit_classifier import TYPE_MAPPING, classify_commit
+
+
+class TestClassifyCommit:
+    """Test Conventional Commits prefixes and weighted keyword scoring."""
+
+    def test_conventional_prefix_decides(self):
+        assert classify_commit("feat(api)!: fix docs for the new endpoint") == "feature"
+        assert classify_commit("perf: cache the template list") == "performance"
+        assert classify_commit("chore: update docs") == "docs"
+        assert classify_commit("chore: bump version") == "other"
+
+    def test_leading_keyword_outweighs_later_ones(self):
+        assert classify_commit("refactor bug test") == "refactor"
+        assert classify_commit("Fix bug in docs") == "bug"
+        assert classify_commit("Add Feature flag") == "feature"
+        assert classify_commit("Update docs for the test setup") == "docs"
+
+    def test_keywords_match_whole_words(self):
+        assert classify_commit("Fixes crash on empty diff") == "bug"
+        assert classify_commit("Refactored parser") == "refactor"
+        assert classify_commit("Use the latest fixture") == "other"
+        assert classify_commit("") == "other"
+
+    def test_every_mapping_keyword_is_recognised(self):
+        for keyword, template in TYPE_MAPPING.items():
+            assert classify_commit(f"Some {keyword} change") == template[:-len(".md")]
+
+    @pytest.mark.skipif(not os.environ.get("PR_AGENT_BENCHMARK"), reason="Set PR_AGENT_BENCHMARK=1 to run")
+    def test_classifier_throughput(self):
+        subjects = [
+            "feat(api): add pagination to the commit range tool",
+            "Fix bug in docs",
+            "refactor bug test",
+            "Bump dependencies",
+            "Improve performance of the diff parser by caching blob lookups"
+        ] * 200_000
+
+        start = time.perf_counter()
+        for subject in subjects:
+            classify_commit(subject)
+        elapsed = time.perf_counter() - start
+
+        throughput = len(subjects) / elapsed
+        print(f"\nclassify_commit: {len(subjects)} subjects in {elapsed:.2f}s ({throughput:,.0f}/s)")
+        assert throughput > 200_000
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the SQLite commit index behind analyze_commit_messages.
+These index the commits of a throwaway repository.
+"""
+
+import sqlite3
+import subprocess
+import pytest
+import pytest_asyncio
+
+import commit_index
+from commit_index import index_row, open_commit_index, summarize_range
+from git_analysis import LogRecord, close_object_pools
+
+
+def git(cwd, *args):
+    """Run a git command synchronously for test setup."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def object_pools():
+    """Stop the shared cat-file workers before each test's event loop closes."""
+    yield
+    await close_object_pools()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A feature branch with three commits on top of main."""
+    git(tmp_path, "init", "-q", "-b", "main")
+    git(tmp_path, "config", "user.email", "dev@example.com")
+    git(tmp_path, "config", "user.name", "Dev")
+    (tmp_path / "app.py").write_text("a\n")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "Initial commit")
+    git(tmp_path, "checkout", "-q", "-b", "feature")
+    for name, message in (("app.py", "Add feature flag"), ("test_app.py", "Add test"), ("README.md", "Fix bug in docs")):
+        (tmp_path / name).write_text(message)
+        git(tmp_path, "add", ".")
+        git(tmp_path, "commit", "-q", "-m", message)
+    return tmp_path
+
+
+class TestParsing:
+    """Test turning streamed commits into index rows."""
+
+    def test_index_row(self):
+        record = LogRecord(
+            "aaa", "aa", [], "Dev", "dev@example.com", "1970-01-01T01:01:40+01:00", "1970-01-01T00:01:40+00:00",
+            "First", "", ["src/a.py", "b c.py"]
+        )
+
+        assert index_row(record) == ("aaa", "First", "Dev", 100, "src/a.py\nb c.py")
+
+
+class TestCommitIndex:
+    """Test building and updating the index."""
+
+    @pytest.mark.asyncio
+    async def test_summary_matches_git_log(self, repo):
+        summary = await summarize_range(str(repo), "main..HEAD")
+
+        assert summary["commit_messages"] == git(repo, "log", "--pretty=format:%s", "main..HEAD").split("\n")
+        assert summary["commit_types"]["feature"] == 1
+        assert summary["commit_types"]["bug"] == 1
+        assert summary["commit_types"]["test"] == 1
+        assert summary["indexed"] == 3
+
+    @pytest.mark.asyncio
+    async def test_only_new_commits_are_indexed(self, repo):
+        await summarize_range(str(repo), "main..HEAD")
+        (repo / "app.py").write_text("b\n")
+        git(repo, "commit", "-q", "-am", "Improve performance")
+
+        summary = await summarize_range(str(repo), "main..HEAD")
+
+        assert summary["indexed"] == 1
+        assert summary["total_commits"] == 4
+        assert summary["commit_types"]["performance"] == 1
+        index = await open_commit_index(str(repo))
+        with sqlite3.connect(index.path) as connection:
+            files = connection.execute("SELECT files FROM commits WHERE subject = 'Add test'").fetchone()[0]
+        assert files == "test_app.py"
+
+    @pytest.mark.asyncio
+    async def test_classifier_change_reclassifies_index(self, repo, monkeypatch):
+        await summarize_range(str(repo), "main..HEAD")
+        monkeypatch.setattr(commit_index, "CLASSIFIER_VERSION", "everything-is-docs")
+        monkeypatch.setattr(commit_index, "classify_commit", lambda subject: "docs")
+
+        summary = await summarize_range(str(repo), "main..HEAD")
+
+        assert summary["indexed"] == 0
+        assert summary["commit_types"]["docs"] == 3
+
+    @pytest.mark.asyncio
+    async def test_unknown_base_raises(self, repo):
+        with pytest.raises(subprocess.CalledProcessError):
+            await summarize_range(str(repo), "no-such-branch..HEAD")
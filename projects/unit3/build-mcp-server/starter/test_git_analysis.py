@@ -0,0 +1,1024 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the git helpers used by the PR agent tools.
+These run real git commands against a throwaway repository.
+"""
+
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import subprocess
+import time
+from unittest.mock import patch
+import pytest
+import pytest_asyncio
+
+import git_analysis
+
+from git_analysis import (
+    OMITTED_LIST_LIMIT,
+    FileChange,
+    GitObjectPool,
+    ResultCache,
+    analyze_commit_range,
+    analyze_diff,
+    change_metrics,
+    close_object_pools,
+    collect_change_metrics,
+    collect_file_changes,
+    encode_cursor,
+    estimate_tokens,
+    exclude_patterns,
+    file_priority,
+    first_page_cursor,
+    load_diff_snapshot,
+    parse_hunks,
+    parse_porcelain_v2,
+    read_commit_page,
+    read_diff_page,
+    read_file_diffs,
+    read_oneline_log,
+    resolve_head,
+    resolve_range,
+    result_cache,
+    run_git,
+    stream_log,
+    working_tree_status
+)
+
+
+def git(cwd, *args):
+    """Run a git command synchronously for test setup."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def object_pools():
+    """Stop the shared cat-file workers before each test's event loop closes."""
+    yield
+    await close_object_pools()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A repository with a main branch and a feature branch on top of it."""
+    git(tmp_path, "init", "-q", "-b", "main")
+    git(tmp_path, "config", "user.email", "dev@example.com")
+    git(tmp_path, "config", "user.name", "Dev")
+    (tmp_path / "app.py").write_text("a\nb\n")
+    (tmp_path / "notes.txt").write_text("old\n")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "Initial commit")
+    git(tmp_path, "checkout", "-q", "-b", "feature")
+    (tmp_path / "app.py").write_text("a\nB\nc\n")
+    (tmp_path / "README.md").write_text("hello\n")
+    git(tmp_path, "mv", "notes.txt", "notes-renamed.txt")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "feat: update app")
+    return tmp_path
+
+
+class TestRunGit:
+    """Test the non-blocking git runner."""
+
+    @pytest.mark.asyncio
+    async def test_returns_completed_process(self, repo):
+        result = await run_git(["git", "diff", "--name-status", "main...HEAD"], str(repo))
+
+        assert result.returncode == 0
+        assert "M\tapp.py" in result.stdout
+        assert "A\tREADME.md" in result.stdout
+
+    @pytest.mark.asyncio
+    async def test_check_raises_called_process_error(self, repo):
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
+            await run_git(["git", "diff", "missing-branch...HEAD"], str(repo), check=True)
+
+        assert "missing-branch" in exc_info.value.stderr
+
+    @pytest.mark.asyncio
+    async def test_commands_run_concurrently(self, repo):
+        results = await asyncio.gather(
+            run_git(["git", "log", "--oneline", "main..HEAD"], str(repo)),
+            run_git(["git", "diff", "--stat", "main...HEAD"], str(repo))
+        )
+
+        assert "feat: update app" in results[0].stdout
+        assert "3 files changed" in results[1].stdout
+
+
+class TestLogStream:
+    """Test the streaming git log parser."""
+
+    @pytest.fixture
+    def history(self, repo):
+        """The feature branch plus a commit with a multi-line body and a binary file."""
+        (repo / "logo.png").write_bytes(b"\x89PNG\0\1")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add logo\n\nFirst line\n\tindented\n\nLast paragraph\n")
+        return repo
+
+    @pytest.mark.asyncio
+    async def test_records_match_git_log(self, history):
+        records = [record async for record in stream_log(str(history), ["main..HEAD"], numstat=True)]
+
+        assert [record.sha for record in records] == git(history, "rev-list", "main..HEAD").split()
+        logo, update = records
+        assert logo.subject == "Add logo"
+        assert logo.body == "First line\n\tindented\n\nLast paragraph"
+        assert logo.parents == [update.sha]
+        assert logo.numstat == [("logo.png", None, None)]
+        assert (update.author, update.email) == ("Dev", "dev@example.com")
+        assert update.author_date == git(history, "log", "-1", "--format=%aI", update.sha).strip()
+        assert sorted(update.numstat) == [("README.md", 1, 0), ("app.py", 2, 1), ("notes-renamed.txt", 0, 0)]
+
+    @pytest.mark.asyncio
+    async def test_name_only_lists_files(self, history):
+        records = [record async for record in stream_log(str(history), ["main..HEAD"], name_only=True)]
+
+        assert [sorted(record.files) for record in records] == [
+            ["logo.png"], ["README.md", "app.py", "notes-renamed.txt"]
+        ]
+        assert all(not record.numstat for record in records)
+
+    def test_parser_handles_any_chunking(self, history):
+        output = subprocess.run(
+            ["git", "log", "-z", "--numstat", f"--format={git_analysis._LOG_FORMAT}"],
+            cwd=history, check=True, capture_output=True
+        ).stdout
+        whole = git_analysis._LogStreamParser(numstat=True)
+        whole.feed(output)
+        whole.finish()
+        bytewise = git_analysis._LogStreamParser(numstat=True)
+        for index in range(len(output)):
+            bytewise.feed(output[index:index + 1])
+        bytewise.finish()
+
+        assert bytewise.take() == whole.records
+        assert len(whole.records) == 3
+
+    @pytest.mark.asyncio
+    async def test_oneline_matches_git(self, history):
+        assert await read_oneline_log(str(history), ["main..HEAD"]) == git(history, "log", "--oneline", "main..HEAD")
+
+    @pytest.mark.asyncio
+    async def test_stopping_early_kills_git(self, history):
+        with patch.object(git_analysis, "kill_git", wraps=git_analysis.kill_git) as kill:
+            async with contextlib.aclosing(stream_log(str(history), ["HEAD"])) as records:
+                async for record in records:
+                    break
+
+        assert record.subject == "Add logo"
+        kill.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_unknown_revision_raises(self, repo):
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
+            await read_oneline_log(str(repo), ["missing-branch..HEAD"])
+
+        assert "missing-branch" in exc_info.value.stderr
+
+
+class TestAnalyzeDiff:
+    """Test the single-pass diff engine."""
+
+    @pytest.mark.asyncio
+    async def test_name_status_matches_git(self, repo):
+        expected = git(repo, "diff", "--name-status", "main...HEAD")
+
+        analysis = await analyze_diff(str(repo), "main")
+
+        assert analysis.name_status() == expected
+
+    @pytest.mark.asyncio
+    async def test_patch_matches_git(self, repo):
+        expected = git(repo, "diff", "main...HEAD")
+
+        analysis = await analyze_diff(str(repo), "main")
+
+        assert analysis.patch == expected
+        assert analysis.total_lines == expected.count("\n")
+
+    @pytest.mark.asyncio
+    async def test_numstat_counts(self, repo):
+        analysis = await analyze_diff(str(repo), "main", include_patch=False)
+        changes = {change.path: change for change in analysis.files}
+
+        assert (changes["app.py"].added, changes["app.py"].deleted) == (2, 1)
+        assert changes["notes-renamed.txt"].old_path == "notes.txt"
+        assert analysis.patch == ""
+        assert analysis.stat().endswith(" 3 files changed, 3 insertions(+), 1 deletion(-)\n")
+
+    @pytest.mark.asyncio
+    async def test_unknown_base_raises(self, repo):
+        with pytest.raises(subprocess.CalledProcessError):
+            await analyze_diff(str(repo), "missing-branch")
+
+    @pytest.mark.asyncio
+    async def test_max_lines_keeps_prefix_and_counts_rest(self, repo):
+        expected = git(repo, "diff", "main...HEAD")
+
+        analysis = await analyze_diff(str(repo), "main", max_lines=3)
+
+        assert analysis.patch == "".join(expected.splitlines(keepends=True)[:3])
+        assert analysis.total_lines == expected.count("\n")
+
+
+class TestResultCache:
+    """Test the size-bounded LRU result cache."""
+
+    def test_evicts_least_recently_used_by_size(self):
+        cache = ResultCache(max_bytes=10)
+        cache.put("a", "aaaa", 4)
+        cache.put("b", "bbbb", 4)
+        cache.get("a")
+        cache.put("c", "cccc", 4)
+
+        assert cache.get("a") == "aaaa"
+        assert cache.get("b") is None
+        assert cache.get("c") == "cccc"
+        assert cache.size == 8
+
+    def test_ignores_missing_key_and_oversized_values(self):
+        cache = ResultCache(max_bytes=10)
+        cache.put(None, "value", 5)
+        cache.put("big", "x" * 20, 20)
+
+        assert len(cache) == 0
+        assert cache.get(None) is None
+
+    @pytest.mark.asyncio
+    async def test_resolve_range_returns_merge_base_and_head(self, repo):
+        merge_base = git(repo, "rev-parse", "main").strip()
+        head = git(repo, "rev-parse", "HEAD").strip()
+
+        assert await resolve_range(str(repo), "main") == (merge_base, head)
+        assert await resolve_range(str(repo), "missing-branch") is None
+
+    @pytest.mark.asyncio
+    async def test_resolve_head_tracks_branch(self, repo):
+        head_sha, branch, _ = await resolve_head(str(repo))
+
+        assert head_sha == git(repo, "rev-parse", "HEAD").strip()
+        assert branch == "feature"
+
+
+class TestDiffPaging:
+    """Test cursor-based paging over a cached diff."""
+
+    @pytest.mark.asyncio
+    async def test_pages_cover_whole_diff(self, repo):
+        expected = git(repo, "diff", "main...HEAD")
+        commit_range = await resolve_range(str(repo), "main")
+
+        pages = [expected.splitlines(keepends=True)[0]]
+        cursor = first_page_cursor(str(repo), commit_range, 1)
+        while cursor:
+            page = await read_diff_page(cursor)
+            pages.append(page["diff"])
+            cursor = page["next_cursor"]
+
+        assert "".join(pages) == expected
+        assert page["total_diff_lines"] == expected.count("\n")
+        assert ("diff-snapshot", str(repo), *commit_range, ()) in result_cache._entries
+
+    @pytest.mark.asyncio
+    async def test_pages_past_byte_cap_are_streamed(self, repo):
+        expected = git(repo, "diff", "main...HEAD")
+        commit_range = await resolve_range(str(repo), "main")
+
+        pages = []
+        cursor = first_page_cursor(str(repo), commit_range, 2)
+        with patch.object(git_analysis, "DIFF_SNAPSHOT_MAX_BYTES", 120):
+            snapshot = await load_diff_snapshot(str(repo), *commit_range)
+            while cursor:
+                page = await read_diff_page(cursor)
+                pages.append(page["diff"])
+                cursor = page["next_cursor"]
+
+        assert len(snapshot.blob) <= 120 and snapshot.available_lines < snapshot.total_lines
+        # A file section cut by the cap is not served as if it were whole
+        assert all(snapshot.file_diff(change.path) in (None, git(repo, "diff", "main...HEAD", "--", change.path))
+                   for change in snapshot.files)
+        assert "".join(expected.splitlines(keepends=True)[:2]) + "".join(pages) == expected
+
+    @pytest.mark.asyncio
+    async def test_line_longer_than_byte_cap_is_left_out(self, repo):
+        (repo / "data.json").write_text("x" * 500 + "\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add data")
+        expected = git(repo, "diff", "main...HEAD").splitlines(keepends=True)
+        long_line = expected.index("+" + "x" * 500 + "\n")
+        commit_range = await resolve_range(str(repo), "main")
+
+        cursor = first_page_cursor(str(repo), commit_range, long_line)
+        with patch.object(git_analysis, "DIFF_SNAPSHOT_MAX_BYTES", 200):
+            page = await read_diff_page(cursor)
+            following = await read_diff_page(page["next_cursor"])
+
+        assert "left out" in page["diff"] and page["end_line"] == long_line + 1
+        assert following["diff"] == "".join(expected[long_line + 1:long_line * 2 + 1])
+
+    @pytest.mark.asyncio
+    async def test_text_diff_does_not_build_snapshot(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+
+        result = await collect_file_changes(str(repo), "main", commit_range, max_diff_lines=2)
+
+        assert result["truncated"] and result["next_cursor"]
+        assert ("diff-snapshot", str(repo), *commit_range, ()) not in result_cache._entries
+
+    @pytest.mark.asyncio
+    async def test_invalid_cursor(self):
+        with pytest.raises(ValueError):
+            await read_diff_page("not a cursor")
+
+    @pytest.mark.asyncio
+    async def test_altered_cursor_is_rejected(self, repo):
+        cursor = first_page_cursor(str(repo), await resolve_range(str(repo), "main"), 1)
+        payload, signature = cursor.split(".")
+        forged = base64.urlsafe_b64encode(
+            base64.urlsafe_b64decode(payload).replace(str(repo).encode(), b"/etc")
+        ).decode()
+
+        with pytest.raises(ValueError, match="signature"):
+            await read_diff_page(f"{forged}.{signature}")
+
+    @pytest.mark.asyncio
+    async def test_cursor_revisions_must_be_object_names(self, repo):
+        cursor = encode_cursor(cwd=str(repo), base="--output=/tmp/pwned", head="HEAD", offset=1, limit=1)
+
+        with pytest.raises(ValueError, match="object name"):
+            await read_diff_page(cursor)
+
+
+class TestFileDiffIndex:
+    """Test single-file retrieval from the diff snapshot index."""
+
+    @pytest.mark.asyncio
+    async def test_file_sections_match_git(self, repo):
+        snapshot = await load_diff_snapshot(str(repo), *await resolve_range(str(repo), "main"))
+
+        pathspecs = {"app.py": ["app.py"], "README.md": ["README.md"], "notes-renamed.txt": ["notes.txt", "notes-renamed.txt"]}
+        for path, pathspec in pathspecs.items():
+            assert snapshot.file_diff(path) == git(repo, "diff", "main...HEAD", "--", *pathspec)
+
+    @pytest.mark.asyncio
+    async def test_glob_and_old_path_matching(self, repo):
+        by_glob = await read_file_diffs(str(repo), "main", "*.py", max_lines=500)
+        by_old_path = await read_file_diffs(str(repo), "main", "notes.txt", max_lines=500)
+
+        assert [entry["path"] for entry in by_glob["files"]] == ["app.py"]
+        assert by_glob["files"][0]["diff"].startswith("diff --git a/app.py b/app.py")
+        assert [entry["path"] for entry in by_old_path["files"]] == ["notes-renamed.txt"]
+
+    @pytest.mark.asyncio
+    async def test_max_lines_truncates(self, repo):
+        result = await read_file_diffs(str(repo), "main", "*", max_lines=2)
+
+        assert result["truncated"]
+        assert "Output truncated" in result["files"][0]["diff"]
+
+
+class TestGitObjectPool:
+    """Test the persistent cat-file worker pool."""
+
+    @pytest.mark.asyncio
+    async def test_rev_parse_and_object_reads(self, repo):
+        pool = GitObjectPool(str(repo))
+        try:
+            head = await pool.rev_parse("HEAD")
+            sha, object_type, content = await pool.lookup("HEAD:app.py")
+
+            assert head == git(repo, "rev-parse", "HEAD").strip()
+            assert object_type == "blob"
+            assert content == b"a\nB\nc\n"
+            assert await pool.rev_parse("missing-branch") is None
+        finally:
+            await pool.aclose()
+
+    @pytest.mark.asyncio
+    async def test_reuses_worker_and_recovers_from_crash(self, repo):
+        pool = GitObjectPool(str(repo), max_workers=1)
+        try:
+            await pool.rev_parse("HEAD")
+            worker = pool._idle[0]
+            await pool.rev_parse("main")
+            assert pool._idle == [worker], "The worker should be reused"
+
+            worker.kill()
+            await worker.process.wait()
+            assert await pool.rev_parse("main") == git(repo, "rev-parse", "main").strip()
+            assert pool._idle[0] is not worker
+        finally:
+            await pool.aclose()
+
+    @pytest.mark.asyncio
+    async def test_idle_workers_are_stopped(self, repo):
+        pool = GitObjectPool(str(repo), idle_timeout=0.05)
+        await pool.rev_parse("HEAD")
+        worker = pool._idle[0]
+
+        await asyncio.sleep(0.2)
+
+        assert pool._idle == []
+        assert await asyncio.wait_for(worker.process.wait(), 5) != 0
+
+
+class TestTokenBudget:
+    """Test token-budgeted packing of the diff."""
+
+    def test_estimate_tokens_charges_punctuation(self):
+        prose = b"the quick brown fox jumps over the lazy dog"
+        minified = b"a.b(c,d);e[f]={g:h};i&&j||k;l=m?n:o;p+=q"
+
+        assert estimate_tokens(b"") == 0
+        assert estimate_tokens(minified) > estimate_tokens(prose)
+
+    @pytest.mark.asyncio
+    async def test_large_budget_keeps_whole_diff(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+
+        analysis = await collect_file_changes(str(repo), "main", commit_range, max_tokens=100000)
+
+        assert analysis["diff"] == git(repo, "diff", "main...HEAD")
+        assert not analysis["truncated"]
+        assert "omitted" not in analysis
+        assert analysis["estimated_tokens"] <= 100000
+
+    @pytest.mark.asyncio
+    async def test_small_budget_reports_omitted_content(self, repo):
+        (repo / "app.py").write_text("".join(f"line {i}\n" for i in range(2000)))
+        git(repo, "commit", "-q", "-am", "Grow app")
+        commit_range = await resolve_range(str(repo), "main")
+
+        analysis = await collect_file_changes(str(repo), "main", commit_range, max_tokens=400)
+
+        assert analysis["truncated"]
+        assert "app.py" in analysis["omitted"]["files"]
+        assert "README.md" in analysis["diff"]
+        assert analysis["estimated_tokens"] <= 400
+
+    @pytest.mark.asyncio
+    async def test_budget_covers_indented_response(self, repo):
+        for i in range(40):
+            (repo / f"mod{i}.py").write_text("".join(f'\tprint("line {j}")\n' for j in range(50)))
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add modules")
+        commit_range = await resolve_range(str(repo), "main")
+
+        analysis = await collect_file_changes(str(repo), "main", commit_range, max_tokens=3000)
+
+        assert analysis["truncated"]
+        assert "over_budget" not in analysis
+        assert analysis["estimated_tokens"] == estimate_tokens(json.dumps(analysis, indent=2).encode())
+        assert analysis["estimated_tokens"] <= 3000
+
+    @pytest.mark.asyncio
+    async def test_file_list_over_budget_is_flagged(self, repo):
+        for i in range(OMITTED_LIST_LIMIT + 30):
+            (repo / f"mod{i}.py").write_text("x = 1\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add modules")
+        commit_range = await resolve_range(str(repo), "main")
+
+        analysis = await collect_file_changes(str(repo), "main", commit_range, max_tokens=200)
+
+        assert analysis["over_budget"]
+        assert analysis["diff"] == ""
+        assert len(analysis["omitted"]["files"]) == OMITTED_LIST_LIMIT
+        assert analysis["omitted"]["more_files"] == 33
+        assert analysis["estimated_tokens"] == estimate_tokens(json.dumps(analysis, indent=2).encode())
+
+
+class TestPriorityPacking:
+    """Test priority-ordered packing of the diff."""
+
+    def test_file_priority_ranks_by_type_then_size(self):
+        changes = [
+            FileChange("M", "uv.lock", added=1, deleted=0),
+            FileChange("M", "tests/test_app.py", added=1, deleted=0),
+            FileChange("M", "README.md", added=1, deleted=0),
+            FileChange("M", "src/big.py", added=50, deleted=10),
+            FileChange("M", "src/small.py", added=2, deleted=1)
+        ]
+
+        ordered = [change.path for change in sorted(changes, key=file_priority)]
+
+        assert ordered == ["src/small.py", "src/big.py", "tests/test_app.py", "README.md", "uv.lock"]
+
+    @pytest.mark.asyncio
+    async def test_priority_keeps_source_over_lock_file(self, repo):
+        (repo / "a.lock").write_text("".join(f"pin {i}\n" for i in range(20)))
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add lock file")
+        commit_range = await resolve_range(str(repo), "main")
+
+        by_path = await collect_file_changes(str(repo), "main", commit_range, max_diff_lines=20)
+        by_priority = await collect_file_changes(str(repo), "main", commit_range, max_diff_lines=20, packing="priority")
+
+        assert by_path["diff"].startswith("diff --git a/README.md")
+        assert "+B" in by_priority["diff"]
+        assert by_priority["diff"].count("\n") <= 20
+        assert by_priority["omitted"]["files"] == ["a.lock"]
+
+    @pytest.mark.asyncio
+    async def test_unknown_packing_raises(self, repo):
+        with pytest.raises(ValueError):
+            await collect_file_changes(str(repo), "main", None, packing="size")
+
+
+class TestPathExclusion:
+    """Test leaving generated and vendored paths out at the git level."""
+
+    @pytest.fixture
+    def vendored_repo(self, repo):
+        (repo / "dist").mkdir()
+        (repo / "dist" / "bundle.js").write_text("x\n")
+        (repo / "pkg").mkdir()
+        (repo / "pkg" / "uv.lock").write_text("pin\n")
+        (repo / "pkg" / "schema.py").write_text("generated\n")
+        (repo / ".gitattributes").write_text("pkg/schema.py linguist-generated\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add build output")
+        return repo
+
+    def test_patterns_from_argument_environment_or_defaults(self, monkeypatch):
+        monkeypatch.delenv("PR_AGENT_EXCLUDE", raising=False)
+        assert "*.lock" in exclude_patterns()
+        assert exclude_patterns(["*.snap", " "]) == ("*.snap",)
+
+        monkeypatch.setenv("PR_AGENT_EXCLUDE", "dist/, *.map")
+        assert exclude_patterns() == ("dist/", "*.map")
+        monkeypatch.setenv("PR_AGENT_EXCLUDE", "")
+        assert exclude_patterns() == ()
+
+    @pytest.mark.asyncio
+    async def test_excluded_files_are_only_counted(self, vendored_repo, monkeypatch):
+        monkeypatch.delenv("PR_AGENT_EXCLUDE", raising=False)
+        exclude = exclude_patterns()
+
+        analysis = await collect_file_changes(str(vendored_repo), "main", None, exclude=exclude)
+
+        for path in ("dist/bundle.js", "pkg/uv.lock", "pkg/schema.py"):
+            assert path not in analysis["files_changed"]
+            assert f"diff --git a/{path}" not in analysis["diff"]
+        assert "app.py" in analysis["files_changed"]
+        assert analysis["excluded"]["files"] == 3
+
+    @pytest.mark.asyncio
+    async def test_cursor_pages_the_excluded_diff(self, vendored_repo):
+        exclude = ("dist/",)
+        commit_range = await resolve_range(str(vendored_repo), "main")
+
+        analysis = await collect_file_changes(str(vendored_repo), "main", commit_range, max_diff_lines=1, exclude=exclude)
+        page = await read_diff_page(analysis["next_cursor"])
+
+        assert analysis["excluded"] == {"files": 1, "patterns": ["dist/"]}
+        assert "pkg/uv.lock" in analysis["files_changed"]
+        assert page["total_diff_lines"] == analysis["total_diff_lines"]
+        assert "bundle.js" not in page["diff"]
+
+
+class TestIncrementalSnapshot:
+    """Test updating a cached diff snapshot when HEAD moves forward."""
+
+    async def assert_matches_full_diff(self, repo):
+        merge_base, head = await resolve_range(str(repo), "main")
+        updated = await load_diff_snapshot(str(repo), merge_base, head)
+        result_cache.clear()
+        full = await load_diff_snapshot(str(repo), merge_base, head)
+
+        assert updated.blob == full.blob
+        assert updated.files == full.files
+        assert updated.total_lines == full.total_lines
+        return updated
+
+    @pytest.mark.asyncio
+    async def test_only_new_paths_are_diffed(self, repo):
+        (repo / "zeta.py").write_text("z\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add zeta")
+        previous = await load_diff_snapshot(str(repo), *await resolve_range(str(repo), "main"))
+        (repo / "zeta.py").write_text("z\nzz\n")
+        (repo / "app.py").write_text("a\nB\nc\nd\n")
+        git(repo, "commit", "-q", "-am", "Touch zeta and app")
+
+        calls = []
+        original = git_analysis._stream_diff
+
+        async def recording_stream_diff(*args, **kwargs):
+            calls.append(kwargs.get("paths"))
+            return await original(*args, **kwargs)
+
+        with patch.object(git_analysis, "_stream_diff", recording_stream_diff):
+            updated = await load_diff_snapshot(str(repo), *await resolve_range(str(repo), "main"))
+
+        assert calls == [["app.py", "zeta.py"]]
+        assert updated.file_diff("README.md") == previous.file_diff("README.md")
+        await self.assert_matches_full_diff(repo)
+
+    @pytest.mark.asyncio
+    async def test_additions_deletions_and_renames_match_full_diff(self, repo):
+        await load_diff_snapshot(str(repo), *await resolve_range(str(repo), "main"))
+        git(repo, "mv", "README.md", "docs.md")
+        git(repo, "rm", "-q", "notes-renamed.txt")
+        (repo / "new.txt").write_text("old\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Shuffle files")
+
+        updated = await self.assert_matches_full_diff(repo)
+
+        assert [change.path for change in updated.files] == ["app.py", "docs.md", "new.txt"]
+
+    @pytest.mark.asyncio
+    async def test_rewritten_history_recomputes(self, repo):
+        await load_diff_snapshot(str(repo), *await resolve_range(str(repo), "main"))
+        (repo / "app.py").write_text("rewritten\n")
+        git(repo, "commit", "-q", "--amend", "-am", "Amended")
+
+        await self.assert_matches_full_diff(repo)
+
+
+class TestTimeouts:
+    """Test deadlines and cancellation of git processes."""
+
+    @staticmethod
+    def slow_git(pid_file):
+        """A git command whose shell alias starts a long-running grandchild process."""
+        return ["git", "-c", f"alias.slow=!sh -c 'echo $$ > {pid_file}; exec sleep 30'", "slow"]
+
+    @staticmethod
+    async def wait_for_exit(pid):
+        for _ in range(100):
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    # A killed orphan can stay a zombie until init reaps it
+                    if stat.read().rsplit(")", 1)[1].split()[0] == "Z":
+                        return True
+            except OSError:
+                pass
+            await asyncio.sleep(0.05)
+        return False
+
+    @staticmethod
+    async def read_pid(pid_file):
+        for _ in range(100):
+            if pid_file.exists() and pid_file.read_text().strip():
+                return int(pid_file.read_text())
+            await asyncio.sleep(0.05)
+        raise AssertionError("The slow command did not start")
+
+    @pytest.mark.asyncio
+    async def test_timeout_kills_process_group(self, repo, tmp_path_factory):
+        pid_file = tmp_path_factory.mktemp("pids") / "pid"
+
+        with pytest.raises(subprocess.TimeoutExpired):
+            await run_git(self.slow_git(pid_file), str(repo), timeout=0.5)
+
+        assert await self.wait_for_exit(await self.read_pid(pid_file))
+
+    @pytest.mark.asyncio
+    async def test_cancellation_kills_process_group(self, repo, tmp_path_factory):
+        pid_file = tmp_path_factory.mktemp("pids") / "pid"
+        task = asyncio.create_task(run_git(self.slow_git(pid_file), str(repo)))
+        pid = await self.read_pid(pid_file)
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert await self.wait_for_exit(pid)
+
+    @pytest.mark.asyncio
+    async def test_expired_deadline_returns_partial_result(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+
+        for current_range in (None, commit_range):
+            analysis = await collect_file_changes(str(repo), "main", current_range, timeout=0)
+
+            assert analysis["timed_out"]
+            assert analysis["truncated"]
+            assert "result is partial" in analysis["diff"]
+        assert ("diff-snapshot", str(repo), *commit_range, ()) not in result_cache._entries
+
+
+class TestStructuredHunks:
+    """Test the parsed hunk output mode."""
+
+    def test_parse_hunks_ranges_and_lines(self):
+        section = (
+            "diff --git a/app.py b/app.py\n--- a/app.py\n+++ b/app.py\n"
+            "@@ -1,2 +1,3 @@ def main():\n a\n-b\n+B\n+c\n"
+            "@@ -10 +11,0 @@\n--- not a header\n\\ No newline at end of file\n"
+        )
+
+        hunks = parse_hunks(section)
+
+        assert hunks[0] == {
+            "old_start": 1, "old_lines": 2, "new_start": 1, "new_lines": 3,
+            "context": "def main():", "added": ["B", "c"], "removed": ["b"]
+        }
+        assert (hunks[1]["old_lines"], hunks[1]["new_lines"]) == (1, 0)
+        assert hunks[1]["removed"] == ["-- not a header"]
+
+    @pytest.mark.asyncio
+    async def test_hunks_output(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+
+        for current_range in (None, commit_range):
+            analysis = await collect_file_changes(str(repo), "main", current_range, output="hunks")
+            files = {entry["path"]: entry for entry in analysis["hunks"]}
+
+            assert files["app.py"]["language"] == "python"
+            assert files["app.py"]["hunks"][0]["added"] == ["B", "c"]
+            assert files["app.py"]["hunks"][0]["removed"] == ["b"]
+            assert files["README.md"]["language"] == "markdown"
+            assert files["notes-renamed.txt"]["old_path"] == "notes.txt"
+            assert not analysis["truncated"]
+
+    @pytest.mark.asyncio
+    async def test_hunks_limited_by_changed_lines(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+
+        analysis = await collect_file_changes(str(repo), "main", commit_range, max_diff_lines=1, output="hunks")
+        files = {entry["path"]: entry for entry in analysis["hunks"]}
+
+        assert analysis["truncated"]
+        assert files["README.md"]["hunks"][0]["added"] == ["hello"]
+        assert files["app.py"]["omitted_hunks"] == 1
+
+    @pytest.mark.asyncio
+    async def test_unknown_output_raises(self, repo):
+        with pytest.raises(ValueError):
+            await collect_file_changes(str(repo), "main", None, output="html")
+
+    @pytest.mark.skipif(not os.environ.get("PR_AGENT_BENCHMARK"), reason="Set PR_AGENT_BENCHMARK=1 to run")
+    def test_parser_throughput_on_100mb_diff(self):
+        hunk = (
+            "@@ -10,7 +10,8 @@ def handler(request):\n"
+            + "".join(f" context line {i}\n" for i in range(3))
+            + "-    old = compute(value)\n+    new = compute(value, cache=True)\n+    log(new)\n"
+            + "".join(f" trailing line {i}\n" for i in range(3))
+        )
+        section = "diff --git a/app.py b/app.py\n--- a/app.py\n+++ b/app.py\n" + hunk * 20
+        diff = section * (100 * 1024 * 1024 // len(section))
+
+        start = time.perf_counter()
+        hunks = parse_hunks(diff)
+        elapsed = time.perf_counter() - start
+
+        throughput = len(diff) / elapsed / 1024 / 1024
+        print(f"\nparse_hunks: {len(diff) / 1024 / 1024:.0f} MiB, {len(hunks)} hunks in {elapsed:.2f}s ({throughput:.1f} MiB/s)")
+        assert throughput > 10
+
+
+class TestUncommittedChanges:
+    """Test the working tree mode built on git status --porcelain=v2."""
+
+    def test_parse_porcelain_v2(self):
+        output = "\0".join([
+            "1 M. N... 100644 100644 100644 aaa bbb app.py",
+            "1 .M N... 100644 100644 100644 aaa aaa notes with spaces.txt",
+            "2 RM N... 100644 100644 100644 aaa aaa R100 new.py",
+            "old.py",
+            "u UU N... 100644 100644 100644 100644 aaa bbb ccc conflict.py",
+            "? scratch/",
+            ""
+        ])
+
+        status = parse_porcelain_v2(output)
+
+        assert [change.name_status() for change in status.staged] == ["M\tapp.py", "R\told.py\tnew.py"]
+        assert [change.name_status() for change in status.unstaged] == ["M\tnotes with spaces.txt", "M\tnew.py"]
+        assert status.conflicted == ["conflict.py"]
+        assert status.untracked == ["scratch/"]
+
+    @pytest.mark.asyncio
+    async def test_status_enables_untracked_cache(self, repo):
+        (repo / "README.md").write_text("staged\n")
+        git(repo, "add", "README.md")
+        (repo / "app.py").write_text("unstaged\n")
+        (repo / "scratch.txt").write_text("untracked\n")
+
+        status = await working_tree_status(str(repo))
+
+        assert [change.path for change in status.staged] == ["README.md"]
+        assert [change.path for change in status.unstaged] == ["app.py"]
+        assert status.untracked == ["scratch.txt"]
+        assert b"UNTR" in (repo / ".git" / "index").read_bytes()
+
+    @pytest.mark.asyncio
+    async def test_untracked_cache_left_off_when_disabled(self, repo):
+        git(repo, "config", "core.untrackedCache", "false")
+
+        await working_tree_status(str(repo))
+
+        assert b"UNTR" not in (repo / ".git" / "index").read_bytes()
+
+    @pytest.mark.asyncio
+    async def test_collect_includes_uncommitted_diff(self, repo):
+        (repo / "app.py").write_text("a\nB\nc\nworking tree\n")
+        commit_range = await resolve_range(str(repo), "main")
+
+        clean = await collect_file_changes(str(repo), "main", commit_range)
+        analysis = await collect_file_changes(str(repo), "main", commit_range, include_uncommitted=True)
+
+        assert "uncommitted" not in clean
+        assert analysis["uncommitted"]["unstaged"] == "M\tapp.py\n"
+        assert "+working tree" in analysis["uncommitted"]["diff"]
+        assert "+working tree" not in analysis["diff"]
+
+
+class TestDuplicateHunks:
+    """Test writing changes that repeat across files once."""
+
+    @pytest.fixture
+    def codemod_repo(self, repo):
+        """The feature branch also renames one call in three modules, at different lines."""
+        def module(name, padding, call):
+            return f"# {name}\n" + "y = 2\n" * padding + f"x = {name}\n" + f"{call}()\n"
+
+        git(repo, "checkout", "-q", "main")
+        for name, padding in (("one", 0), ("two", 3), ("three", 6)):
+            (repo / f"{name}.py").write_text(module(name, padding, "old_call"))
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Add modules")
+        git(repo, "checkout", "-q", "feature")
+        git(repo, "merge", "-q", "--no-edit", "main")
+        for name, padding in (("one", 0), ("two", 3), ("three", 6)):
+            (repo / f"{name}.py").write_text(module(name, padding, "new_call"))
+        git(repo, "commit", "-q", "-am", "Rename call")
+        return repo
+
+    @pytest.mark.asyncio
+    async def test_repeated_changes_written_once(self, codemod_repo):
+        commit_range = await resolve_range(str(codemod_repo), "main")
+
+        analysis = await collect_file_changes(
+            str(codemod_repo), "main", commit_range, max_diff_lines=1000, collapse_duplicates=True
+        )
+
+        diff = analysis["diff"]
+        assert diff.count("+new_call()") == 1
+        assert "\\ Same change in 2 more places: three.py:" in diff
+        assert "diff --git a/three.py" not in diff
+        assert "+B" in diff
+        assert analysis["collapsed_hunks"] == 2
+        assert not analysis["truncated"]
+
+    @pytest.mark.asyncio
+    async def test_default_output_is_unchanged(self, codemod_repo):
+        commit_range = await resolve_range(str(codemod_repo), "main")
+
+        analysis = await collect_file_changes(str(codemod_repo), "main", commit_range, max_diff_lines=1000)
+
+        assert analysis["diff"] == git(codemod_repo, "diff", "main...HEAD")
+        assert "collapsed_hunks" not in analysis
+
+
+class TestCommitRange:
+    """Test per-commit analysis of arbitrary ranges."""
+
+    @pytest.fixture
+    def history(self, repo):
+        """The feature branch with four more commits, one of them a merge."""
+        for index in range(3):
+            (repo / "app.py").write_text(f"a\nB\nc\n{index}\n")
+            git(repo, "commit", "-q", "-am", f"Step {index}")
+        git(repo, "checkout", "-q", "main")
+        (repo / "main.txt").write_text("main\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Main change")
+        git(repo, "checkout", "-q", "feature")
+        git(repo, "merge", "-q", "--no-edit", "main")
+        return repo
+
+    @pytest.mark.asyncio
+    async def test_pages_cover_range_oldest_first(self, history):
+        progress = []
+
+        async def on_commit(commit, completed, total):
+            progress.append((completed, total))
+
+        first = await analyze_commit_range(str(history), "main~1", "feature", page_commits=3, on_commit=on_commit)
+        second = await read_commit_page(first["next_cursor"])
+
+        expected = git(history, "rev-list", "--reverse", "--topo-order", "main~1..feature").split()
+        commits = first["commits"] + second["commits"]
+        assert [commit["sha"] for commit in commits] == expected
+        assert first["total_commits"] == len(expected) == 6
+        assert sorted(progress) == [(1, 6), (2, 6), (3, 6)]
+        assert second["start_commit"] == 4 and second["end_commit"] == 6
+        assert second["next_cursor"] is None
+        assert first["files_changed"] == git(history, "diff", "--name-status", "main~1", "feature")
+
+    @pytest.mark.asyncio
+    async def test_each_commit_has_its_own_patch(self, history):
+        result = await analyze_commit_range(str(history), "main~1", "feature", page_commits=10)
+
+        by_subject = {commit["subject"]: commit for commit in result["commits"]}
+        step = by_subject["Step 1"]
+        assert step["diff"] == git(history, "diff", f"{step['sha']}^", step["sha"])
+        assert step["files_changed"] == "M\tapp.py\n"
+        merge = by_subject["Merge branch 'main' into feature"]
+        assert len(merge["parents"]) == 2
+        assert merge["files_changed"] == "A\tmain.txt\n"
+
+    @pytest.mark.asyncio
+    async def test_root_commit_diffed_against_empty_tree(self, repo):
+        git(repo, "checkout", "-q", "--orphan", "other")
+        git(repo, "commit", "-q", "-m", "Unrelated root")
+
+        result = await analyze_commit_range(str(repo), "main", "other")
+
+        [root] = result["commits"]
+        assert root["parents"] == []
+        assert root["files_changed"] == "A\tREADME.md\nA\tapp.py\nA\tnotes-renamed.txt\n"
+
+    @pytest.mark.asyncio
+    async def test_deadline_leaves_commits_for_next_page(self, history):
+        # The commit list is cached, the per-commit patches are not
+        await analyze_commit_range(str(history), "main", "feature", include_patch=False)
+        result = await analyze_commit_range(str(history), "main", "feature", timeout=0)
+
+        assert result["timed_out"]
+        assert result["end_commit"] == 0
+        assert result["next_cursor"] is not None
+
+    @pytest.mark.asyncio
+    async def test_cursor_revisions_must_be_object_names(self, repo):
+        cursor = encode_cursor(cwd=str(repo), **{"from": "main", "to": "--output=/tmp/pwned"}, offset=0, limit=1, lines=10)
+
+        with pytest.raises(ValueError, match="object name"):
+            await read_commit_page(cursor)
+
+    @pytest.mark.asyncio
+    async def test_unknown_revision_raises(self, repo):
+        with pytest.raises(ValueError):
+            await analyze_commit_range(str(repo), "no-such-branch")
+
+
+class TestChangeMetrics:
+    """Test the aggregate statistics computed from numstat."""
+
+    def test_aggregates_by_extension_directory_and_category(self):
+        files = [
+            FileChange("M", "src/app.py", added=10, deleted=2),
+            FileChange("M", "src/util/io.py", added=3, deleted=0),
+            FileChange("A", "tests/test_app.py", added=6, deleted=0),
+            FileChange("M", "README.md", added=1, deleted=1),
+            FileChange("M", "Makefile", added=0, deleted=1),
+            FileChange("A", "logo.png")
+        ]
+
+        metrics = change_metrics(files)
+
+        assert metrics["totals"] == {"files": 6, "added": 20, "deleted": 4, "binary": 1}
+        assert list(metrics["by_extension"]) == [".py", ".md", ".png", "Makefile"]
+        assert metrics["by_extension"][".py"] == {"files": 3, "added": 19, "deleted": 2}
+        assert metrics["by_directory"]["src"] == {"files": 2, "added": 13, "deleted": 2}
+        assert metrics["by_directory"]["."]["files"] == 3
+        assert change_metrics(files, directory_depth=2)["by_directory"]["src/util"]["files"] == 1
+        assert metrics["by_category"]["test"] == {"files": 1, "added": 6, "deleted": 0}
+        assert metrics["test_to_source"] == {"files": 0.25, "lines": 0.38}
+        assert metrics["churn"] == {"p50": 2, "p90": 12, "p99": 12, "max": 12}
+        assert metrics["largest_files"][0] == {"path": "src/app.py", "lines": 12}
+
+    def test_empty_change_set(self):
+        metrics = change_metrics([])
+
+        assert metrics["churn"]["p90"] == 0
+        assert metrics["test_to_source"] == {"files": None, "lines": None}
+
+    @pytest.mark.asyncio
+    async def test_collect_matches_numstat(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+
+        metrics = await collect_change_metrics(str(repo), "main", commit_range)
+
+        numstat = git(repo, "diff", "--numstat", "main...HEAD").splitlines()
+        assert metrics["totals"]["files"] == len(numstat)
+        assert metrics["totals"]["added"] == sum(int(line.split()[0]) for line in numstat)
+        assert result_cache.get(("change-metrics", str(repo), *commit_range, 1, ())) == metrics
+
+    @pytest.mark.asyncio
+    async def test_resolved_pair_is_diffed_when_head_moves(self, repo):
+        commit_range = await resolve_range(str(repo), "main")
+        numstat = git(repo, "diff", "--numstat", "main...HEAD").splitlines()
+        (repo / "later.py").write_text("x\n")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Commit after the range was resolved")
+
+        metrics = await collect_change_metrics(str(repo), "main", commit_range)
+        analysis = await collect_file_changes(str(repo), "main", commit_range)
+
+        assert metrics["totals"]["files"] == len(numstat)
+        assert "later.py" not in analysis["files_changed"]
+        assert "Commit after" not in analysis["commits"]
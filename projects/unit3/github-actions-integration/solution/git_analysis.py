@@ -0,0 +1,2175 @@
+#!/usr/bin/env python3
+"""
+Git helpers for the PR agent MCP server.
+Runs git as non-blocking asyncio subprocesses so a slow repository never stalls
+the FastMCP event loop while other tool calls are waiting to be served.
+"""
+
+import asyncio
+import base64
+import fnmatch
+import hashlib
+import hmac
+import json
+import os
+import re
+import signal
+import subprocess
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+# Size of the reads from git's stdout while streaming its output
+READ_CHUNK_SIZE = 64 * 1024
+
+# Default deadline, in seconds, for the git work behind one tool call
+GIT_TIMEOUT = 60.0
+
+# Widest +/- graph drawn in the --stat style summary
+STAT_GRAPH_WIDTH = 40
+
+# Upper bound for the total size of all cached tool results
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Persistent `git cat-file --batch` workers per repository, and how long an
+# unused worker is kept alive
+OBJECT_POOL_MAX_WORKERS = 2
+OBJECT_POOL_IDLE_TIMEOUT = 60.0
+OBJECT_POOL_MAX_REPOSITORIES = 16
+
+# Most patch lines and bytes kept in a server-side diff snapshot used for
+# paging; pages past either cap are streamed from git again
+DIFF_SNAPSHOT_MAX_LINES = 200_000
+DIFF_SNAPSHOT_MAX_BYTES = 16 * 1024 * 1024
+
+# Key that signs paging cursors, so a cursor is only accepted by the server
+# process that issued it and its fields cannot be edited
+CURSOR_KEY = os.urandom(32)
+
+# Most paths re-diffed when a snapshot is updated for new commits; beyond
+# this a full diff is cheaper
+INCREMENTAL_MAX_PATHS = 1000
+
+# Generated and vendored paths left out of analyze_file_changes. Entries are
+# gitignore-style globs, with a trailing "/" for directories, or "attr:NAME"
+# for files that have a gitattribute set. PR_AGENT_EXCLUDE replaces the list
+# with comma-separated entries; an empty value excludes nothing.
+DEFAULT_EXCLUDE_PATTERNS = (
+    "*.lock", "uv.lock", "package-lock.json", "pnpm-lock.yaml", "go.sum",
+    "dist/", "*.min.js", "*.min.css", "attr:linguist-generated"
+)
+EXCLUDE_ENV_VAR = "PR_AGENT_EXCLUDE"
+
+# Byte classes used by the token estimator
+_ALNUM_BYTES = bytes(range(48, 58)) + bytes(range(65, 91)) + bytes(range(97, 123)) + b"_"
+_PUNCTUATION_BYTES = bytes(b for b in range(33, 127) if b not in _ALNUM_BYTES)
+_NON_ASCII_BYTES = bytes(range(128, 256))
+
+
+async def start_git(args: List[str], cwd: str, **kwargs) -> asyncio.subprocess.Process:
+    """Start a git process in its own process group.
+
+    Git may run helpers, hooks or external diff drivers; a separate group lets
+    kill_git stop all of them at once.
+    """
+    return await asyncio.create_subprocess_exec(*args, cwd=cwd, start_new_session=True, **kwargs)
+
+
+def kill_git(process: asyncio.subprocess.Process) -> None:
+    """Kill a process started by start_git together with everything it spawned."""
+    if process.returncode is not None:
+        return
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def remaining_time(deadline: Optional[float]) -> Optional[float]:
+    """Seconds left until a deadline on the event loop clock, or None for no deadline."""
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_running_loop().time(), 0)
+
+
+async def run_git(
+    args: List[str], cwd: str, check: bool = False, timeout: Optional[float] = None
+) -> subprocess.CompletedProcess:
+    """Run a git command without blocking the event loop.
+
+    When the timeout expires or the calling task is cancelled, the git process
+    group is killed so an abandoned command stops using CPU.
+
+    Args:
+        args: Full command line, starting with "git"
+        cwd: Directory to run the command in
+        check: Raise subprocess.CalledProcessError on a non-zero exit code
+        timeout: Raise subprocess.TimeoutExpired after this many seconds (default: no limit)
+    """
+    process = await start_git(args, cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_git(process)
+        await process.wait()
+        raise subprocess.TimeoutExpired(args, timeout) from None
+    except BaseException:
+        kill_git(process)
+        raise
+
+    result = subprocess.CompletedProcess(
+        args,
+        process.returncode,
+        stdout.decode("utf-8", errors="replace"),
+        stderr.decode("utf-8", errors="replace")
+    )
+    if check:
+        result.check_returncode()
+    return result
+
+
+def exclude_patterns(exclude: Optional[List[str]] = None) -> Tuple[str, ...]:
+    """Return the exclusion list to use: the given one, PR_AGENT_EXCLUDE, or the defaults."""
+    if exclude is None:
+        configured = os.environ.get(EXCLUDE_ENV_VAR)
+        if configured is None:
+            return DEFAULT_EXCLUDE_PATTERNS
+        exclude = configured.split(",")
+    return tuple(pattern.strip() for pattern in exclude if pattern.strip())
+
+
+def pathspecs(patterns: Tuple[str, ...], exclude: bool = True) -> List[str]:
+    """Turn exclusion patterns into git pathspecs.
+
+    Patterns without a slash match at any depth, like in .gitignore. With
+    exclude=False the pathspecs select the matching files instead, which is
+    used to count what was left out.
+    """
+    magic = "top,exclude," if exclude else "top,"
+    specs = []
+    for pattern in patterns:
+        if pattern.startswith("attr:"):
+            specs.append(f":({magic}{pattern})")
+            continue
+        if pattern.endswith("/"):
+            pattern += "**"
+        if pattern.startswith("/"):
+            pattern = pattern[1:]
+        elif "/" not in pattern.rstrip("*").rstrip("/"):
+            pattern = "**/" + pattern
+        specs.append(f":({magic}glob){pattern}")
+    return specs
+
+
+class ResultCache:
+    """LRU cache whose entries are evicted by their total size in bytes.
+
+    Keys are built from immutable commit SHAs, so an entry never goes stale;
+    it only has to make room for newer results.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value for key, or None."""
+        if key is None or key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        """Store value, evicting least recently used entries to stay in budget."""
+        if key is None or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+
+# Shared by all tools of the server process
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES)
+
+
+class _CatFileWorker:
+    """One long-lived `git cat-file --batch` process."""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.last_used = time.monotonic()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    async def query(self, name: str) -> Optional[Tuple[str, str, bytes]]:
+        """Look up one object name; returns (sha, type, content) or None if missing."""
+        self.process.stdin.write(name.encode() + b"\n")
+        await self.process.stdin.drain()
+        header = await self.process.stdout.readline()
+        if not header:
+            raise ConnectionResetError("git cat-file exited")
+        fields = header.decode().split()
+        if len(fields) != 3:
+            # "<name> missing" or "<name> ambiguous"
+            return None
+        sha, object_type, size = fields
+        content = await self.process.stdout.readexactly(int(size) + 1)
+        return sha, object_type, content[:-1]
+
+    def kill(self) -> None:
+        if self.alive:
+            self.process.kill()
+
+
+class GitObjectPool:
+    """Bounded pool of persistent `git cat-file --batch` workers for one repository.
+
+    Object reads and revision lookups are written to an already running git
+    process instead of forking a new one per call. Workers idle for longer than
+    idle_timeout are stopped, and a worker that dies is replaced transparently.
+    """
+
+    def __init__(self, cwd: str, max_workers: int = OBJECT_POOL_MAX_WORKERS,
+                 idle_timeout: float = OBJECT_POOL_IDLE_TIMEOUT):
+        self.cwd = cwd
+        self.idle_timeout = idle_timeout
+        self.loop = asyncio.get_running_loop()
+        self._idle: List[_CatFileWorker] = []
+        self._slots = asyncio.Semaphore(max_workers)
+        self._reaper: Optional[asyncio.TimerHandle] = None
+
+    async def _spawn(self) -> _CatFileWorker:
+        process = await asyncio.create_subprocess_exec(
+            "git", "cat-file", "--batch",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=self.cwd
+        )
+        return _CatFileWorker(process)
+
+    async def lookup(self, name: str) -> Optional[Tuple[str, str, bytes]]:
+        """Return (sha, type, content) for an object name or revision, or None if missing."""
+        if "\n" in name:
+            raise ValueError("Object names cannot contain newlines")
+        async with self._slots:
+            worker = self._idle.pop() if self._idle else await self._spawn()
+            try:
+                try:
+                    result = await worker.query(name)
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                    # The worker crashed or was killed: retry once on a fresh process
+                    worker.kill()
+                    worker = await self._spawn()
+                    result = await worker.query(name)
+            except BaseException:
+                # A half-answered query leaves the protocol out of sync
+                worker.kill()
+                raise
+            worker.last_used = time.monotonic()
+            self._idle.append(worker)
+            self._schedule_reap()
+            return result
+
+    async def rev_parse(self, revision: str) -> Optional[str]:
+        """Resolve a revision to its SHA, like `git rev-parse --verify`."""
+        result = await self.lookup(revision)
+        return result[0] if result else None
+
+    def _schedule_reap(self) -> None:
+        if self._reaper is None:
+            self._reaper = self.loop.call_later(self.idle_timeout, self._reap)
+
+    def _reap(self) -> None:
+        self._reaper = None
+        cutoff = time.monotonic() - self.idle_timeout
+        for worker in [worker for worker in self._idle if worker.last_used <= cutoff or not worker.alive]:
+            self._idle.remove(worker)
+            worker.kill()
+        if self._idle:
+            self._schedule_reap()
+
+    def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for worker in self._idle:
+            worker.kill()
+        self._idle.clear()
+
+    async def aclose(self) -> None:
+        """Stop all workers and wait for them to exit."""
+        workers = list(self._idle)
+        self.close()
+        for worker in workers:
+            await worker.process.wait()
+
+
+_object_pools: "OrderedDict[str, GitObjectPool]" = OrderedDict()
+
+
+def get_object_pool(cwd: str) -> GitObjectPool:
+    """Return the object pool for a repository, creating it on first use."""
+    pool = _object_pools.get(cwd)
+    if pool is not None and pool.loop is not asyncio.get_running_loop():
+        # Pools are tied to the event loop their processes were started on
+        pool.close()
+        pool = None
+    if pool is None:
+        pool = GitObjectPool(cwd)
+        _object_pools[cwd] = pool
+        while len(_object_pools) > OBJECT_POOL_MAX_REPOSITORIES:
+            _object_pools.popitem(last=False)[1].close()
+    _object_pools.move_to_end(cwd)
+    return pool
+
+
+async def close_object_pools() -> None:
+    """Stop the workers of every repository pool, e.g. on server shutdown."""
+    while _object_pools:
+        _, pool = _object_pools.popitem()
+        if pool.loop is asyncio.get_running_loop():
+            await pool.aclose()
+        else:
+            pool.close()
+
+
+async def resolve_range(cwd: str, base_branch: str) -> Optional[Tuple[str, str]]:
+    """Resolve base_branch...HEAD to its (merge-base SHA, HEAD SHA) pair.
+
+    The two revisions are looked up through the persistent object pool, and the
+    merge base of a SHA pair never changes, so it is computed once and then
+    served from the result cache. Returns None when the range cannot be resolved.
+    """
+    pool = get_object_pool(cwd)
+    try:
+        base_sha = await pool.rev_parse(f"{base_branch}^{{commit}}")
+        head_sha = await pool.rev_parse("HEAD^{commit}")
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        # Not a repository, or git is not available
+        return None
+    if base_sha is None or head_sha is None:
+        return None
+
+    key = ("merge-base", base_sha, head_sha)
+    merge_base = result_cache.get(key)
+    if merge_base is None:
+        merge_base_result = await run_git(["git", "merge-base", base_sha, head_sha], cwd)
+        if merge_base_result.returncode != 0:
+            return None
+        merge_base = merge_base_result.stdout.strip()
+        result_cache.put(key, merge_base, len(merge_base))
+    return merge_base, head_sha
+
+
+async def resolve_head(cwd: str) -> Optional[Tuple[str, str, float]]:
+    """Resolve the HEAD commit, the current branch and the repository config mtime.
+
+    Together these identify everything get_repository_info reports.
+    Returns None when HEAD cannot be resolved (e.g. an empty repository).
+    """
+    result = await run_git(["git", "rev-parse", "--absolute-git-dir", "HEAD", "--abbrev-ref", "HEAD"], cwd)
+    values = result.stdout.split("\n")
+    if result.returncode != 0 or len(values) < 3:
+        return None
+    git_dir, head_sha, branch = values[:3]
+    try:
+        config_mtime = os.stat(os.path.join(git_dir, "config")).st_mtime
+    except OSError:
+        config_mtime = 0.0
+    return head_sha, branch, config_mtime
+
+
+@dataclass
+class FileChange:
+    """One entry of a tree diff, combining --raw and --numstat information."""
+    status: str
+    path: str
+    old_path: Optional[str] = None
+    added: Optional[int] = None
+    deleted: Optional[int] = None
+
+    @property
+    def binary(self) -> bool:
+        return self.added is None
+
+    @property
+    def display_path(self) -> str:
+        if self.old_path:
+            return f"{self.old_path} => {self.path}"
+        return self.path
+
+    def name_status(self) -> str:
+        """Format the entry the way `git diff --name-status` does."""
+        if self.old_path:
+            return f"{self.status}\t{self.old_path}\t{self.path}"
+        return f"{self.status}\t{self.path}"
+
+
+@dataclass
+class DiffAnalysis:
+    """Everything analyze_file_changes needs from a single `git diff` run."""
+    files: List[FileChange] = field(default_factory=list)
+    patch: str = ""
+    total_lines: int = 0
+    # True when git was stopped because the deadline passed
+    timed_out: bool = False
+
+    def name_status(self) -> str:
+        return "".join(f"{change.name_status()}\n" for change in self.files)
+
+    def stat(self) -> str:
+        """Render a `git diff --stat` style summary from the numstat counts."""
+        if not self.files:
+            return ""
+
+        counts = [(change.added or 0) + (change.deleted or 0) for change in self.files]
+        name_width = max(len(change.display_path) for change in self.files)
+        count_width = len(str(max(counts)))
+        scale = min(1.0, STAT_GRAPH_WIDTH / max(max(counts), 1))
+
+        lines = []
+        for change, count in zip(self.files, counts):
+            name = change.display_path.ljust(name_width)
+            if change.binary:
+                lines.append(f" {name} | Bin")
+                continue
+            plus = int(change.added * scale) or (1 if change.added else 0)
+            minus = int(change.deleted * scale) or (1 if change.deleted else 0)
+            lines.append(f" {name} | {count:>{count_width}} {'+' * plus}{'-' * minus}".rstrip())
+
+        insertions = sum(change.added or 0 for change in self.files)
+        deletions = sum(change.deleted or 0 for change in self.files)
+        summary = f" {len(self.files)} file{'s' if len(self.files) != 1 else ''} changed"
+        if insertions or not deletions:
+            summary += f", {insertions} insertion{'s' if insertions != 1 else ''}(+)"
+        if deletions or not insertions:
+            summary += f", {deletions} deletion{'s' if deletions != 1 else ''}(-)"
+        lines.append(summary)
+        return "\n".join(lines) + "\n"
+
+
+def _nth_newline(data: bytes, n: int) -> int:
+    """Return the index of the n-th newline in data (n >= 1)."""
+    end = -1
+    for _ in range(n):
+        end = data.index(b"\n", end + 1)
+    return end
+
+
+class _DiffStreamParser:
+    """Incremental parser for `git diff --raw --numstat --patch -z` output.
+
+    The NUL separated raw and numstat records come first, followed by an empty
+    field and then the patch text, so the whole output is consumed in one pass.
+    Only the first max_lines lines of the patch, and only whole lines within
+    max_bytes, are kept after skipping skip_lines lines; the rest are just
+    counted so memory stays flat however large the diff is.
+    """
+
+    def __init__(self, max_lines: Optional[int] = None, max_bytes: Optional[int] = None, skip_lines: int = 0):
+        self.files: List[FileChange] = []
+        self._by_path = {}
+        self._header = b""
+        self._in_patch = False
+        self._pending: Optional[List[str]] = None
+        self._paths_needed = 0
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self._skip_lines = skip_lines
+        self.patch_chunks: List[bytes] = []
+        self.kept_lines = 0
+        self.kept_bytes = 0
+        self._bytes_full = False
+        self.total_lines = 0
+        self.timed_out = False
+        self._ends_with_newline = True
+
+    @property
+    def limit_reached(self) -> bool:
+        return self._bytes_full or (self.max_lines is not None and self.kept_lines >= self.max_lines)
+
+    def feed(self, chunk: bytes) -> None:
+        if self._in_patch:
+            self._feed_patch(chunk)
+            return
+
+        self._header += chunk
+        *fields, self._header = self._header.split(b"\0")
+        for index, raw_field in enumerate(fields):
+            if raw_field == b"" and self._paths_needed == 0:
+                # Empty field: end of the records, the patch text follows
+                self._in_patch = True
+                rest = b"\0".join(fields[index + 1:] + [self._header])
+                self._header = b""
+                if rest:
+                    self._feed_patch(rest)
+                return
+            self._consume(raw_field.decode("utf-8", errors="replace"))
+
+    def _feed_patch(self, chunk: bytes) -> None:
+        newlines = chunk.count(b"\n")
+        self.total_lines += newlines
+        self._ends_with_newline = chunk.endswith(b"\n")
+
+        if self.limit_reached:
+            return
+        if self._skip_lines:
+            if newlines < self._skip_lines:
+                self._skip_lines -= newlines
+                return
+            chunk = chunk[_nth_newline(chunk, self._skip_lines) + 1:]
+            newlines -= self._skip_lines
+            self._skip_lines = 0
+
+        if self.max_lines is not None and self.kept_lines + newlines >= self.max_lines:
+            # Keep everything up to and including the newline ending the last wanted line
+            newlines = self.max_lines - self.kept_lines
+            chunk = chunk[:_nth_newline(chunk, newlines) + 1]
+        if self.max_bytes is not None and self.kept_bytes + len(chunk) > self.max_bytes:
+            # Keep the whole lines that fit and drop the start of the one that does not
+            self._bytes_full = True
+            chunk = chunk[:chunk.rfind(b"\n", 0, self.max_bytes - self.kept_bytes) + 1]
+            newlines = chunk.count(b"\n")
+            if not chunk:
+                self._drop_partial_line()
+        if chunk:
+            self.patch_chunks.append(chunk)
+        self.kept_lines += newlines
+        self.kept_bytes += len(chunk)
+
+    def _drop_partial_line(self) -> None:
+        while self.patch_chunks and not self.patch_chunks[-1].endswith(b"\n"):
+            last = self.patch_chunks.pop()
+            end = last.rfind(b"\n")
+            if end != -1:
+                self.patch_chunks.append(last[:end + 1])
+
+    def finish(self) -> None:
+        """Account for a final patch line that has no trailing newline."""
+        if not self._ends_with_newline:
+            self.total_lines += 1
+            if not self.limit_reached and not self._skip_lines:
+                self.kept_lines += 1
+
+    def _consume(self, token: str) -> None:
+        if self._paths_needed:
+            self._pending.append(token)
+            self._paths_needed -= 1
+            if self._paths_needed == 0:
+                self._finish_record()
+            return
+
+        if token.startswith(":"):
+            # :old_mode new_mode old_sha new_sha status
+            status = token.split()[-1]
+            self._pending = ["raw", status]
+            self._paths_needed = 2 if status[0] in "RC" else 1
+        else:
+            added, deleted, path = token.split("\t", 2)
+            self._pending = ["numstat", added, deleted]
+            if path:
+                self._pending.append(path)
+                self._finish_record()
+            else:
+                # Renames and copies carry the old and new path as two fields
+                self._paths_needed = 2
+
+    def _finish_record(self) -> None:
+        kind, *values = self._pending
+        self._pending = None
+        if kind == "raw":
+            status, *paths = values
+            change = FileChange(status=status, path=paths[-1], old_path=paths[0] if len(paths) == 2 else None)
+            self.files.append(change)
+            self._by_path[change.path] = change
+        else:
+            added, deleted, *paths = values
+            change = self._by_path.get(paths[-1])
+            if change is not None and added != "-":
+                change.added = int(added)
+                change.deleted = int(deleted)
+
+
+async def _stream_diff(
+    cwd: str,
+    revisions: List[str],
+    include_patch: bool,
+    max_lines: Optional[int],
+    exclude: Tuple[str, ...] = (),
+    paths: Optional[List[str]] = None,
+    deadline: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    skip_lines: int = 0
+) -> _DiffStreamParser:
+    """Run `git diff --raw --numstat -z` over revisions and parse it as it streams.
+
+    Paths matching exclude are dropped by git itself, so no patch is ever
+    computed for them. When paths is given, only those files are diffed.
+    Git always runs to the end so total_lines counts the whole patch, even
+    past max_lines and max_bytes. At the deadline git is killed and the parser keeps what
+    arrived so far, with timed_out set.
+    """
+    args = ["git", "diff", "--raw", "--numstat", "-z"]
+    if include_patch:
+        args.append("--patch")
+    args.extend(revisions)
+    if exclude or paths:
+        args.append("--")
+        args.extend(f":(top,literal){path}" for path in paths or [])
+        args.extend(pathspecs(exclude))
+
+    process = await start_git(args, cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    parser = _DiffStreamParser(max_lines=max_lines, max_bytes=max_bytes, skip_lines=skip_lines)
+
+    async def read_stdout():
+        while True:
+            chunk = await process.stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+
+    try:
+        _, stderr = await asyncio.wait_for(
+            asyncio.gather(read_stdout(), process.stderr.read()), remaining_time(deadline)
+        )
+    except asyncio.TimeoutError:
+        kill_git(process)
+        parser.timed_out = True
+    except BaseException:
+        kill_git(process)
+        raise
+    await process.wait()
+    if parser.timed_out:
+        return parser
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, args, stderr=stderr.decode("utf-8", errors="replace")
+        )
+    parser.finish()
+    return parser
+
+
+async def analyze_diff(
+    cwd: str,
+    base_branch: str,
+    include_patch: bool = True,
+    max_lines: Optional[int] = None,
+    exclude: Tuple[str, ...] = (),
+    deadline: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    commit_range: Optional[Tuple[str, str]] = None
+) -> DiffAnalysis:
+    """Collect changed files, statistics and patch text with one `git diff` run.
+
+    Git computes the merge base and the tree diff only once, and the output is
+    parsed as it streams in instead of being buffered by three separate calls.
+
+    Args:
+        cwd: Directory to run git in
+        base_branch: Base branch to compare HEAD against
+        include_patch: Also produce the patch text
+        max_lines: Keep at most this many patch lines; the rest are still
+            counted in total_lines (default: no limit)
+        exclude: Patterns of paths to leave out (see DEFAULT_EXCLUDE_PATTERNS)
+        deadline: Event loop time at which git is stopped and the partial
+            result is returned (default: no deadline)
+        max_bytes: Keep only the whole patch lines that fit in this many
+            bytes (default: no limit)
+        commit_range: The resolved (merge-base, HEAD) pair to diff instead of
+            base_branch...HEAD, so a result cached under those SHAs describes
+            them even if HEAD moves meanwhile (default: resolved by git)
+    """
+    revisions = list(commit_range) if commit_range else [f"{base_branch}...HEAD"]
+    parser = await _stream_diff(
+        cwd, revisions, include_patch, max_lines, exclude, deadline=deadline,
+        max_bytes=max_bytes
+    )
+    return DiffAnalysis(
+        files=parser.files,
+        patch=b"".join(parser.patch_chunks).decode("utf-8", errors="replace"),
+        total_lines=parser.total_lines,
+        timed_out=parser.timed_out
+    )
+
+
+async def count_excluded(
+    cwd: str, revisions: List[str], exclude: Tuple[str, ...], timeout: Optional[float] = None
+) -> int:
+    """Count the changed files that exclude leaves out.
+
+    Only names are listed and rename detection is off, so git does not read
+    the contents of the excluded files.
+    """
+    if not exclude:
+        return 0
+    result = await run_git(
+        ["git", "diff", "--name-only", "--no-renames", "-z", *revisions, "--", *pathspecs(exclude, exclude=False)],
+        cwd,
+        check=True,
+        timeout=timeout
+    )
+    return result.stdout.count("\0")
+
+
+# Fields of one commit as stream_log reads them, in format order
+LOG_FIELDS = ("sha", "short_sha", "parents", "author", "email", "author_date", "commit_date", "subject", "body")
+
+# Each record starts with a record separator, which tells it apart from the
+# numstat entries of the commit before it, and every field is NUL-terminated,
+# so subjects and multi-line bodies never need escaping
+_LOG_FORMAT = "%x1e" + "".join(f"{placeholder}%x00" for placeholder in (
+    "%H", "%h", "%P", "%an", "%ae", "%aI", "%cI", "%s", "%b"
+))
+
+
+@dataclass
+class LogRecord:
+    """One commit read by stream_log.
+
+    files lists the paths the commit changed, when numstat or name_only was
+    requested; numstat holds (path, added, deleted) per file, with None
+    counts for binary files.
+    """
+    sha: str
+    short_sha: str
+    parents: List[str]
+    author: str
+    email: str
+    author_date: str
+    commit_date: str
+    subject: str
+    body: str
+    files: List[str] = field(default_factory=list)
+    numstat: List[Tuple[str, Optional[int], Optional[int]]] = field(default_factory=list)
+
+    def oneline(self) -> str:
+        """Format the commit the way `git log --oneline` does."""
+        return f"{self.short_sha} {self.subject}"
+
+
+class _LogStreamParser:
+    """Incremental parser for `git log -z --format=_LOG_FORMAT [--numstat | --name-only]` output.
+
+    Output can be fed in arbitrary chunks; finished commits collect in records
+    until take() hands them out. Without a file list a commit is finished as
+    soon as its last field arrives, otherwise when the next commit starts.
+    """
+
+    def __init__(self, numstat: bool = False, name_only: bool = False):
+        self.numstat = numstat
+        self.with_files = numstat or name_only
+        self.records: List[LogRecord] = []
+        self._buffer = b""
+        # Complete tokens of a header or rename that is still arriving
+        self._pending: List[str] = []
+        self._record: Optional[LogRecord] = None
+
+    def feed(self, chunk: bytes) -> None:
+        data = self._buffer + chunk
+        end = data.rfind(b"\0") + 1
+        self._buffer = data[end:]
+        if end:
+            # NUL never occurs inside a UTF-8 sequence, so everything up to
+            # the last NUL decodes on its own
+            self._parse(self._pending + data[:end - 1].decode("utf-8", errors="replace").split("\0"))
+
+    def finish(self) -> None:
+        if self._buffer:
+            self._parse(self._pending + [self._buffer.decode("utf-8", errors="replace")])
+            self._buffer = b""
+        self._end_record()
+
+    def take(self) -> List[LogRecord]:
+        records, self.records = self.records, []
+        return records
+
+    def _parse(self, tokens: List[str]) -> None:
+        width = len(LOG_FIELDS)
+        index, count = 0, len(tokens)
+        while index < count:
+            token = tokens[index]
+            if token.startswith("\x1e"):
+                # Fields are counted rather than split on the separator, so
+                # any text a body contains stays in the body
+                if index + width > count:
+                    break
+                self._end_record()
+                self._start_record([token[1:], *tokens[index + 1:index + width]])
+                index += width
+                continue
+            # The file list starts on a new line; with --numstat each entry is
+            # "added\tdeleted\tpath", or an empty path followed by the old and
+            # new path of a rename, and "-" counts mean binary
+            token = token.lstrip("\n")
+            if not token or self._record is None:
+                index += 1
+            elif not self.numstat:
+                self._record.files.append(token)
+                index += 1
+            else:
+                added, deleted, path = token.split("\t", 2)
+                if not path:
+                    if index + 3 > count:
+                        break
+                    path = tokens[index + 2]
+                    index += 2
+                index += 1
+                self._record.files.append(path)
+                self._record.numstat.append((
+                    path, None if added == "-" else int(added), None if deleted == "-" else int(deleted)
+                ))
+        self._pending = tokens[index:]
+
+    def _start_record(self, fields: List[str]) -> None:
+        sha, short_sha, parents, author, email, author_date, commit_date, subject, body = fields
+        self._record = LogRecord(
+            sha, short_sha, parents.split(), author, email, author_date, commit_date, subject, body.rstrip("\n")
+        )
+        if not self.with_files:
+            self._end_record()
+
+    def _end_record(self) -> None:
+        if self._record is not None:
+            self.records.append(self._record)
+            self._record = None
+
+
+async def stream_log(
+    cwd: str,
+    options: List[str],
+    numstat: bool = False,
+    name_only: bool = False,
+    check: bool = True,
+    deadline: Optional[float] = None
+) -> AsyncIterator[LogRecord]:
+    """Run `git log -z` and yield each commit as soon as it has been parsed.
+
+    Only one read chunk of output is held at a time, so memory stays flat
+    however long the range is. Leaving the loop early kills git; wrap the
+    stream in contextlib.aclosing to have that happen right away rather than
+    when the generator is collected.
+
+    Args:
+        cwd: Directory to run the command in
+        options: Revision range and any other `git log` options
+        numstat: Read the changed files with their added and deleted lines
+        name_only: Read only the names of the changed files, which saves
+            git from diffing their contents
+        check: Raise subprocess.CalledProcessError when git fails
+        deadline: Event loop time at which git is killed and
+            subprocess.TimeoutExpired raised (default: no deadline)
+    """
+    args = ["git", "log", "-z", f"--format={_LOG_FORMAT}"]
+    if numstat:
+        args.append("--numstat")
+    elif name_only:
+        args.append("--name-only")
+    args.extend(options)
+
+    timeout = remaining_time(deadline)
+    process = await start_git(args, cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stderr = asyncio.ensure_future(process.stderr.read())
+    parser = _LogStreamParser(numstat, name_only)
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(READ_CHUNK_SIZE), remaining_time(deadline))
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(args, timeout) from None
+            if not chunk:
+                break
+            parser.feed(chunk)
+            for record in parser.take():
+                yield record
+        await process.wait()
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode, args, stderr=(await stderr).decode("utf-8", errors="replace")
+            )
+        parser.finish()
+        for record in parser.take():
+            yield record
+    finally:
+        # Reading stderr to its end lets the pipes close with the process
+        kill_git(process)
+        await asyncio.gather(process.wait(), stderr)
+
+
+async def read_oneline_log(
+    cwd: str, options: List[str], check: bool = True, deadline: Optional[float] = None
+) -> str:
+    """Return what `git log --oneline` prints for options, read through stream_log."""
+    records = stream_log(cwd, options, check=check, deadline=deadline)
+    return "".join([f"{record.oneline()}\n" async for record in records])
+
+
+class DiffSnapshot:
+    """The patch for one immutable commit pair, kept server-side for paging.
+
+    Holds the raw patch bytes plus the byte offset of every line start and of
+    every file section, so a page of lines or the diff of a single file is one
+    slice of the blob.
+    """
+
+    def __init__(self, blob: bytes, total_lines: int, files: Optional[List[FileChange]] = None,
+                 timed_out: bool = False):
+        self.blob = blob
+        self.total_lines = total_lines
+        self.files = files or []
+        # A snapshot cut short by a deadline is partial and never cached
+        self.timed_out = timed_out
+        self.line_offsets = array("Q", [0])
+        position = blob.find(b"\n")
+        while position != -1:
+            self.line_offsets.append(position + 1)
+            position = blob.find(b"\n", position + 1)
+        if self.line_offsets[-1] != len(blob):
+            self.line_offsets.append(len(blob))
+
+        # Git writes the file sections in the same order as the raw records,
+        # so the n-th "diff --git" header belongs to the n-th changed file
+        section_starts = [0] if blob.startswith(b"diff --git ") else []
+        position = blob.find(b"\ndiff --git ")
+        while position != -1:
+            section_starts.append(position + 1)
+            position = blob.find(b"\ndiff --git ", position + 1)
+        section_ends = section_starts[1:] + [len(blob)]
+        if self.available_lines < total_lines:
+            # The section a cap cut through is left out as a whole
+            del section_starts[-1:], section_ends[-1:]
+        self.file_offsets: Dict[str, Tuple[int, int]] = {
+            change.path: (start, end)
+            for change, start, end in zip(self.files, section_starts, section_ends)
+        }
+
+    @property
+    def available_lines(self) -> int:
+        """Lines held in the blob; less than total_lines if the diff hit the cap."""
+        return len(self.line_offsets) - 1
+
+    @property
+    def size(self) -> int:
+        return len(self.blob) + self.line_offsets.itemsize * len(self.line_offsets)
+
+    def lines(self, start: int, count: int) -> str:
+        """Return count lines starting at line index start."""
+        start = min(start, self.available_lines)
+        end = min(start + count, self.available_lines)
+        return self.blob[self.line_offsets[start]:self.line_offsets[end]].decode("utf-8", errors="replace")
+
+    def file_diff(self, path: str) -> Optional[str]:
+        """Return the diff section of one file, or None if it is not in the snapshot."""
+        offsets = self.file_offsets.get(path)
+        if offsets is None:
+            return None
+        start, end = offsets
+        return str(memoryview(self.blob)[start:end], "utf-8", "replace")
+
+    def file_hunks(self, path: str) -> Tuple[Tuple[int, int], List[Tuple[int, int]]]:
+        """Split a file section into its header and hunk byte ranges."""
+        start, end = self.file_offsets[path]
+        hunk_starts = []
+        position = self.blob.find(b"\n@@ ", start, end)
+        while position != -1:
+            hunk_starts.append(position + 1)
+            position = self.blob.find(b"\n@@ ", position + 1, end)
+        header = (start, hunk_starts[0] if hunk_starts else end)
+        return header, list(zip(hunk_starts, hunk_starts[1:] + [end]))
+
+    def match_files(self, pattern: str) -> List[FileChange]:
+        """Return the changed files whose new or old path matches a path or glob."""
+        if not any(char in pattern for char in "*?["):
+            return [change for change in self.files if pattern in (change.path, change.old_path)]
+        return [
+            change for change in self.files
+            if fnmatch.fnmatchcase(change.path, pattern)
+            or (change.old_path and fnmatch.fnmatchcase(change.old_path, pattern))
+        ]
+
+
+async def load_diff_snapshot(
+    cwd: str, merge_base: str, head: str, exclude: Tuple[str, ...] = (), deadline: Optional[float] = None
+) -> DiffSnapshot:
+    """Return the cached patch for merge_base..head.
+
+    On a miss, the snapshot of the last head seen for this merge base is
+    brought up to date when head descends from it, so only the files touched
+    by the new commits are diffed again. Otherwise git diff runs once. If the
+    deadline passes first, a partial snapshot with timed_out set is returned.
+    """
+    key = ("diff-snapshot", cwd, merge_base, head, exclude)
+    snapshot = result_cache.get(key)
+    if snapshot is not None:
+        return snapshot
+
+    head_key = ("diff-snapshot-head", cwd, merge_base, exclude)
+    previous_head = result_cache.get(head_key)
+    previous = result_cache.get(("diff-snapshot", cwd, merge_base, previous_head, exclude))
+    if previous is not None and previous.available_lines == previous.total_lines:
+        snapshot = await _update_diff_snapshot(cwd, previous, previous_head, merge_base, head, exclude, deadline)
+    if snapshot is None:
+        parser = await _stream_diff(
+            cwd, [merge_base, head], True, DIFF_SNAPSHOT_MAX_LINES, exclude, deadline=deadline,
+            max_bytes=DIFF_SNAPSHOT_MAX_BYTES
+        )
+        snapshot = DiffSnapshot(b"".join(parser.patch_chunks), parser.total_lines, parser.files, parser.timed_out)
+        if snapshot.timed_out:
+            return snapshot
+    result_cache.put(key, snapshot, snapshot.size)
+    result_cache.put(head_key, head, len(head))
+    return snapshot
+
+
+async def _update_diff_snapshot(
+    cwd: str,
+    previous: DiffSnapshot,
+    previous_head: str,
+    merge_base: str,
+    head: str,
+    exclude: Tuple[str, ...],
+    deadline: Optional[float] = None
+) -> Optional[DiffSnapshot]:
+    """Derive the snapshot for merge_base..head from the one for merge_base..previous_head.
+
+    Only the paths changed in previous_head..head are diffed against the merge
+    base, and their sections replace the old ones. Returns None when head does
+    not descend from previous_head, the result would exceed a snapshot cap or
+    the deadline passes.
+    """
+    try:
+        ancestor = await run_git(
+            ["git", "merge-base", "--is-ancestor", previous_head, head], cwd, timeout=remaining_time(deadline)
+        )
+        if ancestor.returncode != 0:
+            return None
+        changed = await run_git(
+            ["git", "diff", "--name-status", "--no-renames", "-z", previous_head, head],
+            cwd,
+            check=True,
+            timeout=remaining_time(deadline)
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    fields = changed.stdout.split("\0")
+    statuses = dict(zip(fields[1::2], fields[0::2]))
+    if not statuses:
+        return previous
+
+    paths = set(statuses)
+    if any(status in ("A", "D") for status in statuses.values()):
+        # New additions or deletions can pair up with older ones as renames,
+        # so every earlier addition, deletion and rename is diffed again
+        for change in previous.files:
+            if change.status[0] in "ADR":
+                paths.add(change.path)
+                if change.old_path:
+                    paths.add(change.old_path)
+    for change in previous.files:
+        if change.old_path and (change.path in paths or change.old_path in paths):
+            paths.update((change.path, change.old_path))
+    if len(paths) > INCREMENTAL_MAX_PATHS:
+        return None
+
+    parser = await _stream_diff(
+        cwd, [merge_base, head], True, DIFF_SNAPSHOT_MAX_LINES, exclude,
+        paths=sorted(paths), deadline=deadline, max_bytes=DIFF_SNAPSHOT_MAX_BYTES
+    )
+    if parser.limit_reached or parser.timed_out:
+        return None
+    update = DiffSnapshot(b"".join(parser.patch_chunks), parser.total_lines, parser.files)
+
+    # Git lists files in byte order of their (new) path
+    sections = [
+        (change, previous, change.path) for change in previous.files
+        if change.path not in paths and change.old_path not in paths
+    ]
+    sections.extend((change, update, change.path) for change in update.files)
+    sections.sort(key=lambda section: section[0].path)
+
+    blob = b"".join(
+        source.blob[slice(*source.file_offsets[path])] for _, source, path in sections
+    )
+    total_lines = blob.count(b"\n")
+    if total_lines > DIFF_SNAPSHOT_MAX_LINES or len(blob) > DIFF_SNAPSHOT_MAX_BYTES:
+        return None
+    return DiffSnapshot(blob, total_lines, [change for change, _, _ in sections])
+
+
+def _cursor_signature(payload: bytes) -> bytes:
+    return base64.urlsafe_b64encode(hmac.new(CURSOR_KEY, payload, hashlib.sha256).digest())
+
+
+def encode_cursor(**fields) -> str:
+    """Pack paging state into an opaque cursor string, signed with CURSOR_KEY."""
+    payload = base64.urlsafe_b64encode(json.dumps(fields, separators=(",", ":")).encode())
+    return (payload + b"." + _cursor_signature(payload)).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Unpack a cursor created by encode_cursor, raising ValueError if it is malformed or was altered.
+
+    The fields end up in git command lines, so a cursor this process did not
+    sign is rejected before anything is decoded.
+    """
+    try:
+        payload, _, signature = cursor.encode().rpartition(b".")
+        if not hmac.compare_digest(signature, _cursor_signature(payload)):
+            raise ValueError("bad signature")
+        fields = json.loads(base64.urlsafe_b64decode(payload))
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    if not isinstance(fields, dict):
+        raise ValueError("Invalid cursor")
+    return fields
+
+
+_OBJECT_ID = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
+
+
+def _cursor_object_id(value: Any) -> str:
+    """Return a full hex object name from a cursor, raising ValueError for anything else."""
+    if not isinstance(value, str) or not _OBJECT_ID.fullmatch(value):
+        raise ValueError(f"Invalid cursor: {value!r} is not a full object name")
+    return value
+
+
+def first_page_cursor(
+    cwd: str, commit_range: Tuple[str, str], page_lines: int, exclude: Tuple[str, ...] = ()
+) -> str:
+    """Cursor for the page that follows the first page_lines lines of a diff."""
+    merge_base, head = commit_range
+    return encode_cursor(
+        cwd=cwd, base=merge_base, head=head, offset=page_lines, limit=page_lines, exclude=list(exclude)
+    )
+
+
+async def read_diff_page(cursor: str, timeout: Optional[float] = GIT_TIMEOUT) -> dict:
+    """Return one page of a cached diff together with the cursor for the next one.
+
+    The snapshot is built on the first page request. Pages past its line or
+    byte cap are streamed from git again, keeping only the page in memory.
+    Raises subprocess.TimeoutExpired if the diff has to be recomputed and git
+    does not finish within timeout seconds.
+    """
+    page = decode_cursor(cursor)
+    try:
+        cwd, merge_base, head = str(page["cwd"]), _cursor_object_id(page["base"]), _cursor_object_id(page["head"])
+        offset, limit = int(page["offset"]), int(page["limit"])
+        exclude = tuple(str(pattern) for pattern in page.get("exclude", []))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    if offset < 0 or limit <= 0:
+        raise ValueError("Invalid cursor: bad page bounds")
+
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    snapshot = await load_diff_snapshot(cwd, merge_base, head, exclude, deadline)
+    if snapshot.timed_out:
+        # Line numbers of a partial diff would not match the next attempt
+        raise subprocess.TimeoutExpired(["git", "diff", f"{merge_base}..{head}"], timeout)
+    if offset + limit <= snapshot.available_lines or snapshot.available_lines == snapshot.total_lines:
+        end = min(offset + limit, snapshot.available_lines)
+        diff = snapshot.lines(offset, limit)
+    else:
+        parser = await _stream_diff(
+            cwd, [merge_base, head], True, limit, exclude, deadline=deadline,
+            max_bytes=DIFF_SNAPSHOT_MAX_BYTES, skip_lines=offset
+        )
+        if parser.timed_out:
+            raise subprocess.TimeoutExpired(["git", "diff", f"{merge_base}..{head}"], timeout)
+        end = offset + parser.kept_lines
+        diff = b"".join(parser.patch_chunks).decode("utf-8", errors="replace")
+        if end == offset and offset < snapshot.total_lines:
+            # A single line larger than the byte cap is skipped, not held in memory
+            end += 1
+            diff = f"... Line {end} is longer than {DIFF_SNAPSHOT_MAX_BYTES} bytes and is left out ...\n"
+    return {
+        "diff": diff,
+        "start_line": offset + 1,
+        "end_line": end,
+        "total_diff_lines": snapshot.total_lines,
+        "next_cursor": encode_cursor(**{**page, "offset": end}) if end < snapshot.total_lines else None
+    }
+
+
+async def read_file_diffs(
+    cwd: str,
+    base_branch: str,
+    pattern: str,
+    max_lines: int,
+    exclude: Tuple[str, ...] = (),
+    timeout: Optional[float] = GIT_TIMEOUT
+) -> dict:
+    """Return the diffs of the files matching a path or glob, served from the snapshot index.
+
+    At most max_lines diff lines are returned across all matching files. With
+    the exclude patterns analyze_file_changes used, both read one snapshot.
+    When git does not finish within timeout seconds, the files diffed so far
+    are returned with timed_out set.
+    """
+    commit_range = await resolve_range(cwd, base_branch)
+    if commit_range is None:
+        raise ValueError(f"Cannot resolve {base_branch}...HEAD in {cwd}")
+
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    snapshot = await load_diff_snapshot(cwd, *commit_range, exclude, deadline)
+    files = []
+    remaining = max_lines
+    truncated = False
+    for change in snapshot.match_files(pattern):
+        diff = snapshot.file_diff(change.path)
+        if diff is None:
+            diff = "... Diff not available: beyond the paging limit ..."
+        else:
+            lines = diff.splitlines(keepends=True)
+            if len(lines) > remaining:
+                diff = "".join(lines[:remaining]) + f"... Output truncated. Showing {remaining} of {len(lines)} lines ...\n"
+                truncated = True
+            remaining = max(remaining - len(lines), 0)
+        files.append({
+            "path": change.path,
+            "old_path": change.old_path,
+            "status": change.status,
+            "added": change.added,
+            "deleted": change.deleted,
+            "diff": diff
+        })
+    result = {"base_branch": base_branch, "pattern": pattern, "files": files, "truncated": truncated}
+    if snapshot.timed_out:
+        result["timed_out"] = True
+    return result
+
+
+def estimate_tokens(data: bytes) -> int:
+    """Estimate how many LLM tokens a piece of text costs.
+
+    Words cost about one token per four characters, while every punctuation
+    character and newline tends to be a token of its own, which is what makes
+    minified code so expensive. The byte classes are counted with
+    bytes.translate, so the whole estimate runs at C speed without a tokenizer.
+    """
+    if not data:
+        return 0
+    length = len(data)
+    alnum = length - len(data.translate(None, _ALNUM_BYTES))
+    punctuation = length - len(data.translate(None, _PUNCTUATION_BYTES))
+    non_ascii = length - len(data.translate(None, _NON_ASCII_BYTES))
+    return punctuation + data.count(b"\n") + (alnum + 3) // 4 + (non_ascii + 1) // 2
+
+
+# Path patterns for the priority packing order, lowest value first
+GENERATED_FILE_PATTERNS = [
+    "*.lock", "*-lock.json", "*.lock.json", "go.sum", "*.min.js", "*.min.css", "*.map",
+    "*.snap", "*/__snapshots__/*", "dist/*", "build/*", "vendor/*", "node_modules/*",
+    "*/dist/*", "*/vendor/*", "*/node_modules/*", "*_pb2.py", "*.pb.go", "*.generated.*"
+]
+TEST_FILE_PATTERNS = [
+    "test_*", "*/test_*", "*_test.*", "*.test.*", "*.spec.*", "tests/*", "*/tests/*",
+    "test/*", "*/test/*", "conftest.py", "*/conftest.py"
+]
+DOC_FILE_PATTERNS = ["*.md", "*.rst", "*.txt", "docs/*", "*/docs/*"]
+
+PACKING_ORDERS = ("path", "priority")
+
+
+def file_priority(change: FileChange) -> Tuple[int, int]:
+    """Sort key putting source before tests, docs and generated or lock files.
+
+    Within a class smaller changes come first, so more files fit in a budget.
+    """
+    path = change.path
+    if any(fnmatch.fnmatchcase(path, pattern) for pattern in GENERATED_FILE_PATTERNS):
+        rank = 3
+    elif any(fnmatch.fnmatchcase(path, pattern) for pattern in TEST_FILE_PATTERNS):
+        rank = 1
+    elif any(fnmatch.fnmatchcase(path, pattern) for pattern in DOC_FILE_PATTERNS):
+        rank = 2
+    else:
+        rank = 0
+    return rank, (change.added or 0) + (change.deleted or 0)
+
+
+def count_lines(data: bytes) -> int:
+    return data.count(b"\n")
+
+
+def hunk_key(blob: bytes, start: int, end: int) -> bytes:
+    """Hash the added and removed lines of a hunk.
+
+    The @@ header and the context lines differ between files that received
+    the same edit (a license header, a renamed call), so they are left out.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for line in blob[start:end].split(b"\n")[1:]:
+        if line[:1] in (b"+", b"-"):
+            digest.update(line)
+            digest.update(b"\n")
+    return digest.digest()
+
+
+def hunk_location(path: str, header: bytes) -> str:
+    """Name a hunk as path:line, using the old line for hunks that only delete."""
+    match = _HUNK_HEADER.match(header.decode("utf-8", errors="replace"))
+    if match is None:
+        return path
+    line = int(match.group(3)) or int(match.group(1))
+    return f"{path}:{line}"
+
+
+def pack_diff(
+    snapshot: DiffSnapshot,
+    budget: int,
+    order: str = "path",
+    cost: Callable[[bytes], int] = estimate_tokens,
+    collapse: bool = False
+) -> dict:
+    """Fill a budget with whole hunks of the snapshot.
+
+    Files are visited in path order or, with order="priority", by
+    file_priority. Hunks that do not fit are skipped and later, smaller ones
+    are still tried, so the budget is used as fully as possible. Everything
+    left out is listed.
+
+    With collapse, a hunk whose added and removed lines repeat elsewhere in
+    the diff is written once, followed by a "\\ Same change in" line naming
+    the other places it applies to. Files whose hunks are all covered that
+    way are left out of the patch text; they are still listed in
+    files_changed.
+
+    Args:
+        snapshot: The cached diff to pack
+        budget: Total cost allowed, in the unit of cost
+        order: "path" or "priority"
+        cost: Cost of a piece of patch text (default: estimated tokens)
+        collapse: Write repeated changes once (default: false)
+    """
+    if order not in PACKING_ORDERS:
+        raise ValueError(f"Unknown packing order '{order}', expected one of {', '.join(PACKING_ORDERS)}")
+    files = sorted(snapshot.files, key=file_priority) if order == "priority" else snapshot.files
+
+    blob = snapshot.blob
+    parts = []
+    used = 0
+    omitted_files = []
+    omitted_hunks = {}
+    collapsed = 0
+
+    # Every place each distinct hunk occurs, in packing order
+    sections = {}
+    occurrences: Dict[bytes, List[Tuple[str, int, int]]] = {}
+    for change in files:
+        if change.path not in snapshot.file_offsets:
+            continue
+        header, hunks = snapshot.file_hunks(change.path)
+        keys = [None] * len(hunks)
+        if collapse:
+            keys = [hunk_key(blob, start, end) for start, end in hunks]
+            for (start, end), key in zip(hunks, keys):
+                occurrences.setdefault(key, []).append((change.path, start, end))
+        sections[change.path] = header, hunks, keys
+    written = set()
+
+    for change in files:
+        if change.path not in sections:
+            # Beyond the snapshot line cap
+            omitted_files.append(change.path)
+            continue
+        (header_start, header_end), hunks, keys = sections[change.path]
+        if hunks and written.issuperset(keys):
+            # Every hunk was already written under another file
+            continue
+        header = blob[header_start:header_end]
+        header_cost = cost(header)
+        if used + header_cost > budget:
+            omitted_files.append(change.path)
+            continue
+
+        kept = [header]
+        file_cost = header_cost
+        skipped = []
+        covered = 0
+        for (hunk_start, hunk_end), key in zip(hunks, keys):
+            hunk = blob[hunk_start:hunk_end]
+            places = None
+            if collapse:
+                if key in written:
+                    covered += 1
+                    continue
+                places = occurrences[key]
+                if len(places) > 1:
+                    others = ", ".join(
+                        hunk_location(path, blob[start:blob.find(b"\n", start, end)])
+                        for path, start, end in places if start != hunk_start
+                    )
+                    count = len(places) - 1
+                    hunk += f"\\ Same change in {count} more place{'s' if count > 1 else ''}: {others}\n".encode()
+            hunk_cost = cost(hunk)
+            if used + file_cost + hunk_cost <= budget:
+                kept.append(hunk)
+                file_cost += hunk_cost
+                if places is not None and len(places) > 1:
+                    written.add(key)
+                    collapsed += len(places) - 1
+            else:
+                skipped.append(hunk[:hunk.find(b"\n")].decode("utf-8", errors="replace"))
+
+        if hunks and len(skipped) + covered == len(hunks):
+            omitted_files.append(change.path)
+            continue
+        parts.extend(kept)
+        used += file_cost
+        if skipped:
+            omitted_hunks[change.path] = skipped
+
+    return {
+        "diff": b"".join(parts).decode("utf-8", errors="replace"),
+        "used": used,
+        "omitted_files": omitted_files,
+        "omitted_hunks": omitted_hunks,
+        "collapsed_hunks": collapsed
+    }
+
+
+def json_tokens(data: bytes) -> int:
+    """Estimate the tokens a piece of text costs once escaped into a JSON string.
+
+    Newlines, tabs, quotes and non-ASCII characters take more characters in
+    JSON than in the raw text, so packed patch text is charged what the
+    response will actually contain.
+    """
+    return estimate_tokens(json.dumps(data.decode("utf-8", errors="replace")).encode()) - 2
+
+
+def response_tokens(result: dict) -> int:
+    """Estimate the tokens of a result serialized the way the servers send it."""
+    return estimate_tokens(json.dumps(result, indent=2).encode())
+
+
+# Files and hunk headers listed under "omitted"; the rest are only counted
+OMITTED_LIST_LIMIT = 50
+# Times the diff is packed again when the measured response overshoots
+BUDGET_PASSES = 3
+
+
+def omitted_listing(files: List[str], hunks: Dict[str, List[str]], limit: int = OMITTED_LIST_LIMIT) -> dict:
+    """List what packing left out, up to limit files and limit hunk headers.
+
+    Past the limit only counts are kept, so squeezing a large diff into a
+    small budget does not produce a listing bigger than the budget.
+    """
+    listing = {"files": files[:limit], "hunks": {}}
+    remaining = limit
+    more_hunks = 0
+    for path, headers in hunks.items():
+        if remaining:
+            listing["hunks"][path] = headers[:remaining]
+        more_hunks += max(len(headers) - remaining, 0)
+        remaining = max(remaining - len(headers), 0)
+    if len(files) > limit:
+        listing["more_files"] = len(files) - limit
+    if more_hunks:
+        listing["more_hunks"] = more_hunks
+    return listing
+
+
+# Languages reported with structured hunks, by file extension or file name
+LANGUAGES = {
+    ".py": "python", ".pyi": "python", ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript",
+    ".jsx": "javascript", ".ts": "typescript", ".tsx": "typescript", ".go": "go", ".rs": "rust",
+    ".java": "java", ".kt": "kotlin", ".rb": "ruby", ".php": "php", ".c": "c", ".h": "c",
+    ".cc": "cpp", ".cpp": "cpp", ".hpp": "cpp", ".cs": "csharp", ".swift": "swift", ".scala": "scala",
+    ".sh": "shell", ".bash": "shell", ".sql": "sql", ".html": "html", ".css": "css", ".scss": "scss",
+    ".md": "markdown", ".rst": "restructuredtext", ".json": "json", ".yaml": "yaml", ".yml": "yaml",
+    ".toml": "toml", ".xml": "xml", "Dockerfile": "dockerfile", "Makefile": "makefile"
+}
+
+OUTPUT_FORMATS = ("text", "hunks")
+
+_HUNK_HEADER = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?(.*)")
+
+
+def detect_language(path: str) -> Optional[str]:
+    """Guess a file's language from its name, or None if it is not known."""
+    name = os.path.basename(path)
+    return LANGUAGES.get(name) or LANGUAGES.get(os.path.splitext(name)[1].lower())
+
+
+def parse_hunks(section: str) -> List[dict]:
+    """Parse the diff of one file into hunks in a single pass over its lines.
+
+    Each hunk has its old and new line ranges, the function context git put
+    after the @@ header, and the added and removed lines without their +/-
+    prefix. Context lines are only counted through the ranges.
+    """
+    hunks = []
+    added = removed = None
+    for line in section.split("\n"):
+        marker = line[:1]
+        if marker == "+" and added is not None:
+            added.append(line[1:])
+        elif marker == "-" and removed is not None:
+            removed.append(line[1:])
+        elif marker == "@":
+            header = _HUNK_HEADER.match(line)
+            if header is None:
+                continue
+            old_start, old_lines, new_start, new_lines, context = header.groups()
+            added, removed = [], []
+            hunks.append({
+                "old_start": int(old_start),
+                "old_lines": 1 if old_lines is None else int(old_lines),
+                "new_start": int(new_start),
+                "new_lines": 1 if new_lines is None else int(new_lines),
+                "context": context,
+                "added": added,
+                "removed": removed
+            })
+    return hunks
+
+
+def structured_diff(snapshot: DiffSnapshot, max_lines: int) -> Tuple[List[dict], bool]:
+    """Return the snapshot's files with parsed hunks, and whether hunks were left out.
+
+    Hunks are added in file order until they hold max_lines added and removed
+    lines; every file is listed, with the count of hunks that did not fit.
+    Files beyond the snapshot line cap have hunks set to None.
+    """
+    files = []
+    remaining = max_lines
+    truncated = False
+    for change in snapshot.files:
+        kept = []
+        omitted = 0
+        if change.path not in snapshot.file_offsets:
+            kept = None
+        elif remaining:
+            hunks = parse_hunks(snapshot.file_diff(change.path))
+            for hunk in hunks:
+                size = len(hunk["added"]) + len(hunk["removed"])
+                if size > remaining:
+                    remaining = 0
+                    break
+                kept.append(hunk)
+                remaining -= size
+            omitted = len(hunks) - len(kept)
+        else:
+            # Once the budget is spent the rest are only counted by their @@ headers
+            omitted = len(snapshot.file_hunks(change.path)[1])
+        entry = {
+            "path": change.path,
+            "old_path": change.old_path,
+            "status": change.status,
+            "language": detect_language(change.path),
+            "binary": change.binary,
+            "hunks": kept
+        }
+        if omitted:
+            entry["omitted_hunks"] = omitted
+        truncated = truncated or kept is None or bool(omitted)
+        files.append(entry)
+    return files, truncated
+
+
+@dataclass
+class WorkingTreeStatus:
+    """Uncommitted changes as reported by `git status --porcelain=v2`."""
+    staged: List[FileChange] = field(default_factory=list)
+    unstaged: List[FileChange] = field(default_factory=list)
+    untracked: List[str] = field(default_factory=list)
+    conflicted: List[str] = field(default_factory=list)
+
+
+def parse_porcelain_v2(output: str) -> WorkingTreeStatus:
+    """Parse `git status --porcelain=v2 -z` output."""
+    status = WorkingTreeStatus()
+    records = iter(output.split("\0"))
+    for record in records:
+        kind = record[:1]
+        if kind in ("1", "2"):
+            # "1 XY sub mH mI mW hH hI path" or "2 ... Xscore path" followed by "origPath"
+            fields = record.split(" ", 8 if kind == "1" else 9)
+            (index_status, worktree_status), path = fields[1], fields[-1]
+            old_path = next(records, None) if kind == "2" else None
+            if index_status != ".":
+                status.staged.append(FileChange(index_status, path, old_path if index_status in "RC" else None))
+            if worktree_status != ".":
+                status.unstaged.append(FileChange(worktree_status, path, old_path if worktree_status in "RC" else None))
+        elif kind == "u":
+            status.conflicted.append(record.split(" ", 10)[-1])
+        elif kind == "?":
+            status.untracked.append(record[2:])
+    return status
+
+
+async def working_tree_status(
+    cwd: str, exclude: Tuple[str, ...] = (), timeout: Optional[float] = None
+) -> WorkingTreeStatus:
+    """Collect staged, unstaged, untracked and conflicted paths with one `git status`.
+
+    The untracked cache is switched on unless the repository disables it, so
+    git only rescans directories whose mtime changed. An fsmonitor configured
+    through core.fsmonitor is used by git automatically; none is started here.
+    """
+    configured = await run_git(["git", "config", "--get", "core.untrackedCache"], cwd, timeout=timeout)
+    options = [] if configured.stdout.strip() else ["-c", "core.untrackedCache=true"]
+    args = ["git", *options, "status", "--porcelain=v2", "-z"]
+    if exclude:
+        args.extend(["--", *pathspecs(exclude)])
+    result = await run_git(args, cwd, check=True, timeout=timeout)
+    return parse_porcelain_v2(result.stdout)
+
+
+async def collect_uncommitted(
+    cwd: str,
+    include_diff: bool,
+    max_diff_lines: int,
+    exclude: Tuple[str, ...] = (),
+    deadline: Optional[float] = None
+) -> dict:
+    """Describe the staged and unstaged changes on top of HEAD.
+
+    git status refreshes the index first, so the `git diff HEAD` that follows
+    only reads files whose stat data changed; it is skipped altogether when no
+    tracked file changed.
+    """
+    status = await working_tree_status(cwd, exclude, remaining_time(deadline))
+    result = {
+        "staged": "".join(f"{change.name_status()}\n" for change in status.staged),
+        "unstaged": "".join(f"{change.name_status()}\n" for change in status.unstaged),
+        "untracked": status.untracked,
+        "conflicted": status.conflicted,
+        "diff": "",
+        "truncated": False
+    }
+    if not include_diff:
+        result["diff"] = "Diff not included (set include_diff=true to see full diff)"
+    elif status.staged or status.unstaged or status.conflicted:
+        parser = await _stream_diff(cwd, ["HEAD"], True, max_diff_lines, exclude, deadline=deadline)
+        result["diff"] = b"".join(parser.patch_chunks).decode("utf-8", errors="replace")
+        if parser.total_lines > max_diff_lines or parser.timed_out:
+            result["diff"] += f"\n... Output truncated. Showing {parser.kept_lines} of {parser.total_lines} lines ..."
+            result["truncated"] = True
+        if parser.timed_out:
+            result["timed_out"] = True
+    return result
+
+
+async def collect_file_changes(
+    cwd: str,
+    base_branch: str,
+    commit_range: Optional[Tuple[str, str]],
+    include_diff: bool = True,
+    max_diff_lines: int = 500,
+    max_tokens: Optional[int] = None,
+    packing: str = "path",
+    exclude: Tuple[str, ...] = (),
+    timeout: Optional[float] = None,
+    output: str = "text",
+    include_uncommitted: bool = False,
+    collapse_duplicates: bool = False
+) -> dict:
+    """Build the analyze_file_changes result for base_branch...HEAD.
+
+    Args:
+        cwd: Directory to run git in
+        base_branch: Base branch to compare against
+        commit_range: The resolved (merge-base, HEAD) pair, if known
+        include_diff: Include the diff content
+        max_diff_lines: Maximum number of diff lines to include
+        max_tokens: Token budget for the whole result as the servers send it
+            (indented JSON); when set, the diff is packed hunk by hunk instead
+            of being cut after max_diff_lines, and over_budget is set if the
+            rest of the result alone does not fit
+        packing: "path" keeps files in path order; "priority" fills the budget
+            with source changes first and generated or lock files last
+        exclude: Patterns of paths git leaves out; they are only counted
+        timeout: Seconds after which git is stopped and the partial result is
+            returned with timed_out set (default: no limit)
+        output: "text" for the unified diff, or "hunks" for parsed hunks per
+            file under "hunks", limited to max_diff_lines changed lines
+        include_uncommitted: Also describe staged, unstaged and untracked
+            changes under "uncommitted"
+        collapse_duplicates: Write hunks whose changes repeat across files
+            once, with the places they apply to (text output only)
+    """
+    if packing not in PACKING_ORDERS:
+        raise ValueError(f"Unknown packing '{packing}', expected one of {', '.join(PACKING_ORDERS)}")
+    if output not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output '{output}', expected one of {', '.join(OUTPUT_FORMATS)}")
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+
+    async def within_deadline(command):
+        # None when the command was stopped at the deadline
+        try:
+            return await command
+        except subprocess.TimeoutExpired:
+            return None
+
+    # With a resolved pair git runs on those SHAs, so the result cached under
+    # them still matches if HEAD moves while the commands run
+    head = commit_range[1] if commit_range else "HEAD"
+    commits_command = within_deadline(
+        read_oneline_log(cwd, [f"{base_branch}..{head}"], check=False, deadline=deadline)
+    )
+    # Packing and hunks work on the whole diff, kept as a snapshot that later
+    # pages share; a plain text diff only streams its first page
+    use_snapshot = include_diff and commit_range is not None and (
+        output == "hunks" or max_tokens is not None or packing == "priority" or collapse_duplicates
+    )
+    packed_output = use_snapshot and output == "text"
+
+    # Excluded paths are only named, next to the diff that skips them
+    excluded_command = within_deadline(count_excluded(
+        cwd, list(commit_range) if commit_range else [f"{base_branch}...HEAD"], exclude, timeout
+    ))
+    # Uncommitted changes are collected next to the committed ones
+    uncommitted_commands = []
+    if include_uncommitted:
+        uncommitted_commands.append(within_deadline(
+            collect_uncommitted(cwd, include_diff, max_diff_lines, exclude, deadline)
+        ))
+
+    if use_snapshot:
+        # The diff comes from the snapshot cached for this commit pair, which
+        # is updated incrementally when HEAD moves forward and also serves
+        # get_diff_page, get_file_diff, the file list and the statistics
+        snapshot, commits_result, excluded_files, *uncommitted = await asyncio.gather(
+            load_diff_snapshot(cwd, *commit_range, exclude, deadline), commits_command, excluded_command,
+            *uncommitted_commands
+        )
+        diff_analysis = DiffAnalysis(
+            files=snapshot.files,
+            patch=snapshot.lines(0, max_diff_lines),
+            total_lines=snapshot.total_lines,
+            timed_out=snapshot.timed_out
+        )
+    else:
+        # A single git diff produces the file list, statistics and patch,
+        # while the commit log runs concurrently next to it. The patch is
+        # streamed and only the first max_diff_lines lines are kept in memory.
+        diff_analysis, commits_result, excluded_files, *uncommitted = await asyncio.gather(
+            analyze_diff(
+                cwd, base_branch, include_patch=include_diff,
+                max_lines=max_diff_lines if output == "text" else DIFF_SNAPSHOT_MAX_LINES,
+                max_bytes=None if output == "text" else DIFF_SNAPSHOT_MAX_BYTES,
+                exclude=exclude, deadline=deadline, commit_range=commit_range
+            ),
+            commits_command,
+            excluded_command,
+            *uncommitted_commands
+        )
+
+    analysis = {
+        "base_branch": base_branch,
+        "files_changed": diff_analysis.name_status(),
+        "statistics": diff_analysis.stat(),
+        "commits": commits_result or "",
+        "diff": "Diff not included (set include_diff=true to see full diff)",
+        "truncated": False,
+        "next_cursor": None,
+        "total_diff_lines": diff_analysis.total_lines if include_diff else 0
+    }
+    if excluded_files:
+        analysis["excluded"] = {"files": excluded_files, "patterns": list(exclude)}
+    timed_out = diff_analysis.timed_out or commits_result is None or excluded_files is None
+    if include_uncommitted:
+        analysis["uncommitted"] = uncommitted[0]
+        timed_out = timed_out or uncommitted[0] is None or uncommitted[0].get("timed_out", False)
+    if timed_out:
+        analysis["timed_out"] = True
+    if not include_diff:
+        return analysis
+    partial_note = f"\n\n... Git did not finish within {timeout} seconds, this result is partial ..." if timed_out else ""
+
+    def add_packed(packed):
+        omitted = packed["omitted_files"] or packed["omitted_hunks"]
+        analysis["diff"] = packed["diff"]
+        analysis.pop("collapsed_hunks", None)
+        analysis.pop("omitted", None)
+        if packed["collapsed_hunks"]:
+            analysis["collapsed_hunks"] = packed["collapsed_hunks"]
+        analysis["truncated"] = bool(omitted)
+        if omitted:
+            analysis["omitted"] = omitted_listing(packed["omitted_files"], packed["omitted_hunks"])
+
+    if output == "hunks":
+        if not use_snapshot:
+            snapshot = DiffSnapshot(diff_analysis.patch.encode(), diff_analysis.total_lines, diff_analysis.files)
+        analysis["hunks"], analysis["truncated"] = structured_diff(snapshot, max_diff_lines)
+        analysis["diff"] = "Diff returned as parsed hunks (see hunks)"
+    elif packed_output:
+        if max_tokens is not None:
+            # The rest of the response is paid for first. The omitted listing
+            # is only known after packing, so the indented response is measured
+            # and packed again with the overshoot taken off; the last pass
+            # leaves the patch out entirely
+            budget = max_tokens - response_tokens({**analysis, "diff": partial_note, "estimated_tokens": max_tokens})
+            for attempt in range(BUDGET_PASSES):
+                add_packed(pack_diff(
+                    snapshot, max(budget, 0), order=packing, cost=json_tokens, collapse=collapse_duplicates
+                ))
+                total = response_tokens(
+                    {**analysis, "diff": analysis["diff"] + partial_note, "estimated_tokens": max_tokens}
+                )
+                if total <= max_tokens or budget <= 0:
+                    break
+                budget = budget - (total - max_tokens) if attempt < BUDGET_PASSES - 2 else 0
+            if total > max_tokens:
+                # files_changed, the statistics and the commits alone do not fit
+                analysis["over_budget"] = True
+            # Measured again with the figure itself in place
+            analysis["estimated_tokens"] = response_tokens(
+                {**analysis, "diff": analysis["diff"] + partial_note, "estimated_tokens": total}
+            )
+        else:
+            add_packed(pack_diff(
+                snapshot, max_diff_lines, order=packing, cost=count_lines, collapse=collapse_duplicates
+            ))
+    elif diff_analysis.total_lines > max_diff_lines:
+        diff_content = '\n'.join(diff_analysis.patch.split('\n')[:max_diff_lines])
+        diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {diff_analysis.total_lines} lines ..."
+        if commit_range:
+            analysis["next_cursor"] = first_page_cursor(cwd, commit_range, max_diff_lines, exclude)
+            diff_content += "\n... Pass next_cursor to get_diff_page to see more ..."
+        else:
+            diff_content += "\n... Use max_diff_lines parameter to see more ..."
+        analysis["diff"] = diff_content
+        analysis["truncated"] = True
+    else:
+        analysis["diff"] = diff_analysis.patch
+    if timed_out:
+        analysis["diff"] += partial_note
+        analysis["truncated"] = True
+    return analysis
+
+
+# Commits diffed at the same time by read_commit_page
+RANGE_DIFF_CONCURRENCY = 4
+
+# Tree a root commit is diffed against, by object name length
+EMPTY_TREES = {
+    40: "4b825dc642cb6eb9a060e54bf8d69288fbee4904",
+    64: "6ef19b41225c5369f1c104d45d8d85efa9b057b53b14b4b9b939dd74decc5321"
+}
+
+async def resolve_commits(cwd: str, from_ref: str, to_ref: str) -> Tuple[str, str]:
+    """Resolve both ends of a from..to range to commit SHAs, raising ValueError if one is unknown."""
+    pool = get_object_pool(cwd)
+    shas = []
+    for ref in (from_ref, to_ref):
+        sha = await pool.rev_parse(f"{ref}^{{commit}}")
+        if sha is None:
+            raise ValueError(f"Unknown revision '{ref}'")
+        shas.append(sha)
+    return shas[0], shas[1]
+
+
+async def list_range_commits(cwd: str, from_sha: str, to_sha: str, timeout: Optional[float] = None) -> List[dict]:
+    """Return the commits of from_sha..to_sha, parents before their children.
+
+    The list for a SHA pair never changes, so it is read once and then
+    served from the result cache for every later page.
+    """
+    key = ("range-commits", cwd, from_sha, to_sha)
+    commits = result_cache.get(key)
+    if commits is None:
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+        commits = []
+        size = 0
+        async for record in stream_log(cwd, ["--reverse", "--topo-order", f"{from_sha}..{to_sha}"], deadline=deadline):
+            commits.append({
+                "sha": record.sha,
+                "parents": record.parents,
+                "author": record.author,
+                "date": record.author_date,
+                "subject": record.subject
+            })
+            size += len(record.sha) * (1 + len(record.parents)) + len(record.author) + len(record.subject)
+        result_cache.put(key, commits, size)
+    return commits
+
+
+async def commit_diff(
+    cwd: str,
+    commit: dict,
+    include_patch: bool = True,
+    max_lines: int = 200,
+    exclude: Tuple[str, ...] = (),
+    deadline: Optional[float] = None
+) -> Optional[dict]:
+    """Describe one commit with its files, statistics and (limited) patch.
+
+    Merge commits are diffed against their first parent and root commits
+    against the empty tree. Returns None if git did not finish before the
+    deadline.
+    """
+    key = ("commit-diff", cwd, commit["sha"], include_patch, max_lines, exclude)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    parent = commit["parents"][0] if commit["parents"] else EMPTY_TREES[len(commit["sha"])]
+    parser = await _stream_diff(
+        cwd, [parent, commit["sha"]], include_patch, max_lines, exclude, deadline=deadline
+    )
+    if parser.timed_out:
+        return None
+    analysis = DiffAnalysis(
+        files=parser.files,
+        patch=b"".join(parser.patch_chunks).decode("utf-8", errors="replace"),
+        total_lines=parser.total_lines
+    )
+    result = {
+        **commit,
+        "files_changed": analysis.name_status(),
+        "statistics": analysis.stat()
+    }
+    if include_patch:
+        result["diff"] = analysis.patch
+        result["total_diff_lines"] = analysis.total_lines
+        result["truncated"] = analysis.total_lines > max_lines
+    result_cache.put(key, result, len(json.dumps(result)))
+    return result
+
+
+async def read_commit_page(
+    cursor: str,
+    timeout: Optional[float] = GIT_TIMEOUT,
+    on_commit: Optional[Callable[[dict, int, int], Awaitable[None]]] = None
+) -> dict:
+    """Return the next commits of a range, each with its own patch, and the cursor after them.
+
+    The commits of a page are diffed concurrently. on_commit(commit,
+    completed, total) is awaited as each one finishes, so progress can be
+    reported before the whole page is ready. Commits still running at the
+    deadline are left for the next page and timed_out is set.
+    """
+    page = decode_cursor(cursor)
+    try:
+        cwd, from_sha, to_sha = str(page["cwd"]), _cursor_object_id(page["from"]), _cursor_object_id(page["to"])
+        offset, limit, max_lines = int(page["offset"]), int(page["limit"]), int(page["lines"])
+        include_patch = bool(page.get("patch", True))
+        exclude = tuple(str(pattern) for pattern in page.get("exclude", []))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    if offset < 0 or limit <= 0 or max_lines < 0:
+        raise ValueError("Invalid cursor: bad page bounds")
+
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    commits = await list_range_commits(cwd, from_sha, to_sha, timeout)
+    selected = commits[offset:offset + limit]
+    semaphore = asyncio.Semaphore(RANGE_DIFF_CONCURRENCY)
+    completed = offset
+
+    async def describe(commit: dict) -> Optional[dict]:
+        nonlocal completed
+        async with semaphore:
+            result = await commit_diff(cwd, commit, include_patch, max_lines, exclude, deadline)
+        if result is not None:
+            completed += 1
+            if on_commit is not None:
+                await on_commit(result, completed, len(commits))
+        return result
+
+    results = await asyncio.gather(*(describe(commit) for commit in selected))
+    # Commits are returned in order, up to the first one that timed out
+    finished = []
+    for result in results:
+        if result is None:
+            break
+        finished.append(result)
+    end = offset + len(finished)
+
+    result = {
+        "from": from_sha,
+        "to": to_sha,
+        "total_commits": len(commits),
+        "start_commit": offset + 1,
+        "end_commit": end,
+        "commits": finished,
+        "next_cursor": encode_cursor(**{**page, "offset": end}) if end < len(commits) else None
+    }
+    if len(finished) < len(selected):
+        result["timed_out"] = True
+    return result
+
+
+async def analyze_commit_range(
+    cwd: str,
+    from_ref: str,
+    to_ref: str = "HEAD",
+    include_patch: bool = True,
+    max_lines: int = 200,
+    page_commits: int = 10,
+    exclude: Tuple[str, ...] = (),
+    timeout: Optional[float] = GIT_TIMEOUT,
+    on_commit: Optional[Callable[[dict, int, int], Awaitable[None]]] = None
+) -> dict:
+    """Summarize from_ref..to_ref and return its first page of commits.
+
+    The summary lists the files and statistics of the diff between the two
+    trees; the commits come from read_commit_page, and next_cursor pages
+    through the rest of them.
+
+    Args:
+        cwd: Directory to run git in
+        from_ref: Start of the range, excluded like in `git log from..to`
+        to_ref: End of the range (default: HEAD)
+        include_patch: Include each commit's patch
+        max_lines: Maximum number of patch lines per commit
+        page_commits: Commits per page
+        exclude: Patterns of paths to leave out (see DEFAULT_EXCLUDE_PATTERNS)
+        timeout: Seconds after which unfinished commits are left for the next page
+        on_commit: Awaited with (commit, completed, total) as each commit is ready
+    """
+    if page_commits <= 0:
+        raise ValueError("page_commits must be positive")
+    if max_lines < 0:
+        raise ValueError("max_lines cannot be negative")
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    from_sha, to_sha = await resolve_commits(cwd, from_ref, to_ref)
+    cursor = encode_cursor(**{
+        "cwd": cwd, "from": from_sha, "to": to_sha, "offset": 0, "limit": page_commits,
+        "lines": max_lines, "patch": include_patch, "exclude": list(exclude)
+    })
+    summary, page = await asyncio.gather(
+        _stream_diff(cwd, [from_sha, to_sha], False, None, exclude, deadline=deadline),
+        read_commit_page(cursor, timeout, on_commit)
+    )
+    range_analysis = DiffAnalysis(files=summary.files)
+    result = {
+        "from_ref": from_ref,
+        "to_ref": to_ref,
+        "files_changed": range_analysis.name_status(),
+        "statistics": range_analysis.stat(),
+        **page
+    }
+    if summary.timed_out:
+        result["timed_out"] = True
+    return result
+
+
+# Names of the file_priority ranks in change metrics
+FILE_CATEGORIES = ("source", "test", "docs", "generated")
+
+# Per-file churn percentiles reported by change_metrics
+CHURN_PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values: List[int], percent: int) -> int:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0
+    rank = max(1, -(-percent * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def change_metrics(files: List[FileChange], directory_depth: int = 1, largest: int = 5) -> dict:
+    """Aggregate numstat records into counts a status report needs.
+
+    Lines are summed per file extension and per directory (the first
+    directory_depth path components), files are classified like
+    file_priority does, and per-file churn (added plus removed lines) is
+    summarized by percentiles. Binary files count as files with no lines.
+    """
+    totals = {"files": len(files), "added": 0, "deleted": 0, "binary": 0}
+    by_extension: Dict[str, dict] = {}
+    by_directory: Dict[str, dict] = {}
+    by_category = {name: {"files": 0, "added": 0, "deleted": 0} for name in FILE_CATEGORIES}
+    churn = []
+
+    for change in files:
+        added, deleted = change.added or 0, change.deleted or 0
+        totals["added"] += added
+        totals["deleted"] += deleted
+        totals["binary"] += change.binary
+        churn.append((added + deleted, change.path))
+
+        name = change.path.rsplit("/", 1)[-1]
+        extension = os.path.splitext(name)[1].lower() or name
+        directory = "/".join(change.path.split("/")[:-1][:directory_depth]) or "."
+        category = FILE_CATEGORIES[file_priority(change)[0]]
+        for groups, key in ((by_extension, extension), (by_directory, directory), (by_category, category)):
+            group = groups.setdefault(key, {"files": 0, "added": 0, "deleted": 0})
+            group["files"] += 1
+            group["added"] += added
+            group["deleted"] += deleted
+
+    def by_size(groups: Dict[str, dict]) -> Dict[str, dict]:
+        return dict(sorted(groups.items(), key=lambda item: (-item[1]["files"], item[0])))
+
+    sizes = sorted(size for size, _ in churn)
+    source, test = by_category["source"], by_category["test"]
+    source_lines = source["added"] + source["deleted"]
+    test_lines = test["added"] + test["deleted"]
+    return {
+        "totals": totals,
+        "by_extension": by_size(by_extension),
+        "by_directory": by_size(by_directory),
+        "by_category": by_category,
+        "churn": {
+            **{f"p{percent}": percentile(sizes, percent) for percent in CHURN_PERCENTILES},
+            "max": sizes[-1] if sizes else 0
+        },
+        "test_to_source": {
+            "files": round(test["files"] / source["files"], 2) if source["files"] else None,
+            "lines": round(test_lines / source_lines, 2) if source_lines else None
+        },
+        "largest_files": [
+            {"path": path, "lines": size}
+            for size, path in sorted(churn, key=lambda item: (-item[0], item[1]))[:largest]
+        ]
+    }
+
+
+async def collect_change_metrics(
+    cwd: str,
+    base_branch: str,
+    commit_range: Optional[Tuple[str, str]],
+    directory_depth: int = 1,
+    exclude: Tuple[str, ...] = (),
+    timeout: Optional[float] = None
+) -> dict:
+    """Compute change_metrics for base_branch...HEAD from numstat alone.
+
+    No patch is produced, so this stays cheap on large diffs. Results for a
+    resolved commit pair are cached; partial results after a timeout are not.
+    """
+    if directory_depth < 1:
+        raise ValueError("directory_depth must be at least 1")
+    key = None
+    if commit_range:
+        key = ("change-metrics", cwd, *commit_range, directory_depth, exclude)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    diff_analysis = await analyze_diff(
+        cwd, base_branch, include_patch=False, exclude=exclude, deadline=deadline, commit_range=commit_range
+    )
+    metrics = {"base_branch": base_branch, **change_metrics(diff_analysis.files, directory_depth)}
+    if diff_analysis.timed_out:
+        metrics["timed_out"] = True
+        return metrics
+    result_cache.put(key, metrics, len(json.dumps(metrics)))
+    return metrics
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+File ownership index for reviewer suggestions, persisted in the git directory.
+Counts who committed to every file and directory, weighting each commit by
+how recent it is, next to the CODEOWNERS rules of HEAD. Every commit is read
+once; later updates only read the commits that are not counted yet, so a
+suggestion is a few dictionary lookups per changed file instead of a
+`git blame` run.
+"""
+
+import asyncio
+import json
+import os
+import posixpath
+import re
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from git_analysis import analyze_diff, get_object_pool, result_cache, run_git, stream_log
+
+# Bumped whenever the stored format or the weighting changes
+INDEX_VERSION = 1
+
+# Location of the index, relative to the git directory
+INDEX_PATH = "pr-agent/ownership.json"
+
+# A commit counts half as much for every HALF_LIFE_DAYS that it is older
+HALF_LIFE_DAYS = 180
+
+# Commits read when the index is first built; older ones add little after decay
+HISTORY_MAX_COMMITS = 10_000
+
+# Branch tips whose history is counted, newest first; commits reachable from
+# any of them are not read again after switching branches
+MAX_TIPS = 16
+
+# Where GitHub looks for a CODEOWNERS file, in order
+CODEOWNERS_PATHS = (".github/CODEOWNERS", "CODEOWNERS", "docs/CODEOWNERS")
+
+_HALF_LIFE_SECONDS = HALF_LIFE_DAYS * 24 * 60 * 60
+
+
+def codeowners_pattern(pattern: str) -> "re.Pattern[str]":
+    """Compile a CODEOWNERS pattern into a regex that fully matches the paths it covers.
+
+    Patterns follow gitignore rules: one with a slash before its end is
+    anchored at the root, others match at any depth; "*" stays within a
+    directory and "**" crosses them. A match also covers everything below a
+    matched directory, except for patterns ending in "/*", which only cover
+    the files directly inside.
+    """
+    anchored = "/" in pattern.rstrip("/")
+    body = pattern.strip("/")
+    parts = []
+    index = 0
+    while index < len(body):
+        if body.startswith("**/", index):
+            parts.append("(?:.*/)?")
+            index += 3
+        elif body.startswith("**", index):
+            parts.append(".*")
+            index += 2
+        else:
+            parts.append({"*": "[^/]*", "?": "[^/]"}.get(body[index], re.escape(body[index])))
+            index += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    suffix = "" if pattern.endswith("/*") else "(?:/.*)?"
+    return re.compile(prefix + "".join(parts) + suffix)
+
+
+def parse_codeowners(text: str) -> List[Tuple[str, List[str]]]:
+    """Return the (pattern, owners) rules of a CODEOWNERS file in file order."""
+    rules = []
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        owners = []
+        for owner in fields[1:]:
+            if owner.startswith("#"):
+                break
+            owners.append(owner)
+        rules.append((fields[0], owners))
+    return rules
+
+
+class OwnershipIndex:
+    """Recency-weighted commit counts per author for every path and directory.
+
+    Weights are stored relative to a fixed reference time, so commits added
+    later simply weigh more and nothing has to be decayed on update; only
+    the ratios between authors of one path are ever used.
+    """
+
+    def __init__(
+        self,
+        commit: str,
+        tips: List[str],
+        reference: float,
+        authors: Dict[str, List],
+        scores: Dict[str, Dict[str, float]],
+        commits: int = 0,
+        codeowners: Optional[dict] = None
+    ):
+        self.commit = commit
+        self.tips = tips
+        self.reference = reference
+        # Email -> [name, timestamp] of the author's newest counted commit
+        self.authors = authors
+        # File or directory path ("" for the root) -> email -> weight
+        self.scores = scores
+        self.commits = commits
+        # {"path", "sha", "rules"} of the CODEOWNERS file at commit
+        self.codeowners = codeowners or {"path": None, "sha": None, "rules": []}
+        self._patterns: Optional[List[Tuple["re.Pattern[str]", List[str]]]] = None
+
+    def add_commit(self, name: str, email: str, timestamp: float, files: List[str]) -> None:
+        """Count one commit for its files and every directory above them."""
+        email = email.lower()
+        if email not in self.authors or self.authors[email][1] < timestamp:
+            self.authors[email] = [name, timestamp]
+        weight = 2 ** ((timestamp - self.reference) / _HALF_LIFE_SECONDS)
+        prefixes = {""}
+        for path in files:
+            while path and path not in prefixes:
+                prefixes.add(path)
+                path = posixpath.dirname(path)
+        for prefix in prefixes:
+            bucket = self.scores.setdefault(prefix, {})
+            bucket[email] = bucket.get(email, 0.0) + weight
+        self.commits += 1
+
+    def owners(self, path: str, excluded: "set[str]" = frozenset()) -> Tuple[Optional[str], Dict[str, float]]:
+        """Return the deepest counted path at or above path and its weights per author.
+
+        Authors in excluded are left out. A file nobody else has touched yet
+        falls back to its directory, and so on up to the root.
+        """
+        while True:
+            weights = {
+                email: weight for email, weight in self.scores.get(path, {}).items() if email not in excluded
+            }
+            if weights:
+                return path, weights
+            if not path:
+                return None, {}
+            path = posixpath.dirname(path)
+
+    def code_owners(self, path: str) -> Optional[List[str]]:
+        """Return the CODEOWNERS owners of a path; the last matching rule wins."""
+        if self._patterns is None:
+            self._patterns = [
+                (codeowners_pattern(pattern), owners) for pattern, owners in self.codeowners["rules"]
+            ]
+        for pattern, owners in reversed(self._patterns):
+            if pattern.fullmatch(path):
+                return owners
+        return None
+
+    def suggest(self, paths: List[Tuple[str, str]], excluded: "set[str]") -> dict:
+        """Rank reviewers for changed files given as (history path, current path) pairs.
+
+        Each file contributes one point, split between the authors of its
+        deepest counted path by their share of the weight there. Authors in
+        excluded (the authors of the change) are left out.
+        """
+        totals: Dict[str, float] = {}
+        files: Dict[str, int] = {}
+        code_owners: Dict[str, List[str]] = {}
+        unowned = []
+        for history_path, path in paths:
+            owners = self.code_owners(path)
+            for owner in owners or ():
+                code_owners.setdefault(owner, []).append(path)
+            _, weights = self.owners(history_path, excluded)
+            total = sum(weights.values())
+            if not total:
+                if not owners:
+                    unowned.append(path)
+                continue
+            for email, weight in weights.items():
+                totals[email] = totals.get(email, 0.0) + weight / total
+                files[email] = files.get(email, 0) + 1
+
+        reviewers = []
+        for email in sorted(totals, key=lambda email: (-totals[email], email)):
+            name, timestamp = self.authors[email]
+            reviewers.append({
+                "name": name,
+                "email": email,
+                "score": round(totals[email], 3),
+                "files": files[email],
+                "last_commit": datetime.fromtimestamp(timestamp).date().isoformat()
+            })
+        return {
+            "reviewers": reviewers,
+            "code_owners": [
+                {"owner": owner, "files": owned}
+                for owner, owned in sorted(code_owners.items(), key=lambda item: (-len(item[1]), item[0]))
+            ],
+            "unowned_files": unowned
+        }
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "version": INDEX_VERSION,
+            "half_life_days": HALF_LIFE_DAYS,
+            "commit": self.commit,
+            "tips": self.tips,
+            "reference": self.reference,
+            "authors": self.authors,
+            "scores": self.scores,
+            "commits": self.commits,
+            "codeowners": self.codeowners
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data: str) -> Optional["OwnershipIndex"]:
+        """Load a stored index, or None if it is unreadable or was built differently."""
+        try:
+            stored = json.loads(data)
+            if stored.get("version") != INDEX_VERSION or stored.get("half_life_days") != HALF_LIFE_DAYS:
+                return None
+            return cls(
+                stored["commit"], stored["tips"], stored["reference"], stored["authors"],
+                stored["scores"], stored["commits"], stored["codeowners"]
+            )
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+
+async def _read_codeowners(cwd: str, commit: str, current: dict, timeout: Optional[float]) -> dict:
+    """Return the CODEOWNERS file of a commit, reusing current when its blob is unchanged."""
+    result = await run_git(
+        ["git", "ls-tree", "-z", "--full-tree", commit, "--", *CODEOWNERS_PATHS],
+        cwd, check=True, timeout=timeout
+    )
+    blobs = {}
+    for entry in result.stdout.split("\0"):
+        if entry:
+            meta, path = entry.split("\t", 1)
+            _, object_type, sha = meta.split(" ")
+            if object_type == "blob":
+                blobs[path] = sha
+    for path in CODEOWNERS_PATHS:
+        if path in blobs:
+            if blobs[path] == current["sha"]:
+                return current
+            found = await get_object_pool(cwd).lookup(blobs[path])
+            text = found[2].decode("utf-8", errors="replace") if found else ""
+            return {"path": path, "sha": blobs[path], "rules": parse_codeowners(text)}
+    return {"path": None, "sha": None, "rules": []}
+
+
+# One update per repository at a time, with the event loop each lock belongs to
+_locks: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Lock]] = {}
+
+
+def _update_lock(cwd: str) -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    if cwd not in _locks or _locks[cwd][0] is not loop:
+        _locks[cwd] = loop, asyncio.Lock()
+    return _locks[cwd][1]
+
+
+async def _add_commits(
+    cwd: str, index: OwnershipIndex, revisions: List[str], deadline: Optional[float]
+) -> int:
+    """Count the newest HISTORY_MAX_COMMITS non-merge commits of revisions into index.
+
+    Returns how many were read. git is killed and subprocess.TimeoutExpired
+    raised at the deadline.
+    """
+    read = 0
+    options = ["--no-merges", f"--max-count={HISTORY_MAX_COMMITS}", *revisions]
+    async for record in stream_log(cwd, options, name_only=True, deadline=deadline):
+        timestamp = datetime.fromisoformat(record.author_date).timestamp()
+        index.add_commit(record.author, record.email, timestamp, record.files)
+        read += 1
+    return read
+
+
+async def load_ownership_index(cwd: str, timeout: Optional[float] = None) -> Tuple[OwnershipIndex, dict]:
+    """Return the ownership index for HEAD and how it was obtained.
+
+    The index comes from the result cache, from the stored index, from the
+    stored index plus the commits of HEAD it does not count yet, or from the
+    last HISTORY_MAX_COMMITS commits of HEAD, in that order of preference.
+    The stored index is rebuilt when one of its tips no longer exists or
+    HEAD has HISTORY_MAX_COMMITS or more new commits. The second value
+    describes the update: {"commit", "update", "read_commits",
+    "indexed_commits", "paths"}.
+    """
+    pool = get_object_pool(cwd)
+    head = await pool.rev_parse("HEAD^{commit}")
+    if head is None:
+        raise ValueError("HEAD cannot be resolved")
+    key = ("ownership-index", cwd, head)
+
+    def describe(index: OwnershipIndex, update: str, read: int) -> dict:
+        return {
+            "commit": head, "update": update, "read_commits": read,
+            "indexed_commits": index.commits, "paths": len(index.scores)
+        }
+
+    async with _update_lock(cwd):
+        index = result_cache.get(key)
+        if index is not None:
+            return index, describe(index, "cached", 0)
+
+        git_path = await run_git(["git", "rev-parse", "--git-path", INDEX_PATH], cwd, check=True, timeout=timeout)
+        index_path = os.path.join(cwd, git_path.stdout.strip())
+        data = ""
+        try:
+            with open(index_path, encoding="utf-8") as index_file:
+                data = index_file.read()
+        except OSError:
+            pass
+        index = OwnershipIndex.from_json(data) if data else None
+
+        if index is not None and index.commit == head:
+            result_cache.put(key, index, len(data))
+            return index, describe(index, "loaded", 0)
+
+        # A tip garbage collected after a rebase can no longer be excluded, and
+        # the commits it shared with the rewritten branch would count twice
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+        update = "full"
+        if index is not None and index.tips:
+            resolved = await asyncio.gather(*(pool.rev_parse(f"{tip}^{{commit}}") for tip in index.tips))
+            if all(resolved):
+                update = "incremental"
+                read = await _add_commits(cwd, index, [head, "--not", *index.tips], deadline)
+                if read >= HISTORY_MAX_COMMITS:
+                    # Older new commits were cut off; a rebuild reads as many
+                    update = "full"
+        if update == "full":
+            index = OwnershipIndex(head, [], time.time(), {}, {})
+            read = await _add_commits(cwd, index, [head], deadline)
+        index.codeowners = await _read_codeowners(cwd, head, index.codeowners, timeout)
+        index.commit = head
+        index.tips = [head, *(tip for tip in index.tips if tip != head)][:MAX_TIPS]
+
+        data = index.to_json()
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            temporary_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as index_file:
+                index_file.write(data)
+            os.replace(temporary_path, index_path)
+        except OSError:
+            # A read-only git directory only costs the next process a rebuild
+            pass
+        result_cache.put(key, index, len(data))
+        return index, describe(index, update, read)
+
+
+async def find_reviewers(
+    cwd: str,
+    base_branch: str,
+    max_reviewers: int = 5,
+    exclude: Tuple[str, ...] = (),
+    timeout: Optional[float] = None
+) -> dict:
+    """Suggest reviewers for the files changed in base_branch...HEAD.
+
+    Reviewers are ranked by how much of the recent history of the changed
+    files (or of their directories, for new files) they wrote; the authors
+    of the change itself are left out. CODEOWNERS owners are listed
+    separately, and files with neither are listed under unowned_files.
+    """
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+
+    async def change_authors() -> "set[str]":
+        return {
+            record.email.lower()
+            async for record in stream_log(cwd, [f"{base_branch}..HEAD"], deadline=deadline)
+        }
+
+    diff_analysis, (index, info), authors = await asyncio.gather(
+        analyze_diff(cwd, base_branch, include_patch=False, exclude=exclude, deadline=deadline),
+        load_ownership_index(cwd, timeout),
+        change_authors()
+    )
+    # Renamed files are owned by whoever wrote them under their old name
+    paths = [(change.old_path or change.path, change.path) for change in diff_analysis.files]
+    suggestion = index.suggest(paths, authors)
+    result = {
+        "base_branch": base_branch,
+        "changed_files": len(paths),
+        "reviewers": suggestion["reviewers"][:max_reviewers],
+        "code_owners": suggestion["code_owners"],
+        "unowned_files": suggestion["unowned_files"],
+        "excluded_authors": sorted(authors),
+        "index": info
+    }
+    if diff_analysis.timed_out:
+        result["timed_out"] = True
+    return result
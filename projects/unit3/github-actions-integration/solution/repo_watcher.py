@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Background watcher for a repository's HEAD, refs and index.
+Runs a (debounced) callback whenever a branch is switched, a commit is made
+or files are staged, so the tool results for the new state can be
+computed before they are asked for.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from git_analysis import run_git
+
+logger = logging.getLogger(__name__)
+
+# Quiet period after the last change before the callback runs; a single
+# commit touches the index, a ref and HEAD's reflog within milliseconds
+WATCH_DEBOUNCE = 0.5
+
+# Interval of the stat-based fallback when inotify is not available
+WATCH_POLL_INTERVAL = 2.0
+
+# Set to start watching the repository on the first tool call
+WATCH_ENV_VAR = "PR_AGENT_WATCH"
+
+# Files directly inside the git directory that describe the branch state
+_STATE_FILES = ("HEAD", "index", "packed-refs")
+
+# inotify constants from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify() -> Optional[ctypes.CDLL]:
+    """Return libc if it provides inotify, otherwise None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class RepositoryWatcher:
+    """Watch a git directory and run on_change after each burst of changes.
+
+    Uses inotify when it is available and falls back to comparing the
+    modification times of the watched files every poll_interval seconds.
+    The callback never runs twice at the same time; changes that arrive
+    while it runs schedule one more run.
+    """
+
+    def __init__(
+        self,
+        git_dir: str,
+        common_dir: str,
+        on_change: Callable[[], Awaitable[None]],
+        debounce: float = WATCH_DEBOUNCE,
+        poll_interval: float = WATCH_POLL_INTERVAL,
+        use_inotify: bool = True
+    ):
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.mode: Optional[str] = None
+        self._fd = -1
+        self._watches: Dict[int, str] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._poll_task: Optional[asyncio.Task] = None
+        self._callback_task: Optional[asyncio.Task] = None
+        self._pending = False
+
+    def start(self) -> None:
+        """Start watching on the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        libc = _load_inotify() if self.use_inotify else None
+        if libc is not None:
+            try:
+                self._start_inotify(libc)
+                self.mode = "inotify"
+                return
+            except OSError as e:
+                logger.warning(f"inotify unavailable, polling instead: {e}")
+                self._close_fd()
+        self._poll_task = self.loop.create_task(self._poll())
+        self.mode = "polling"
+
+    # inotify
+
+    def _start_inotify(self, libc: ctypes.CDLL) -> None:
+        self._libc = libc
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in {self.git_dir, self.common_dir}:
+            self._add_watch(directory)
+        self._add_tree(os.path.join(self.common_dir, "refs"))
+        self.loop.add_reader(self._fd, self._read_events)
+
+    def _add_watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+        self._watches[wd] = directory
+
+    def _add_tree(self, root: str) -> None:
+        # Branch names with slashes are stored in subdirectories of refs/
+        for directory, _, _ in os.walk(root):
+            self._add_watch(directory)
+
+    def _read_events(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        changed = False
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            start = offset + _EVENT_HEADER.size
+            name = os.fsdecode(data[start:start + length].rstrip(b"\0"))
+            offset = start + length
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO) and directory not in (self.git_dir, self.common_dir):
+                    try:
+                        self._add_tree(os.path.join(directory, name))
+                    except OSError:
+                        pass
+                continue
+            changed = changed or self._relevant(directory, name)
+        if changed:
+            self._schedule()
+
+    def _relevant(self, directory: str, name: str) -> bool:
+        if name.endswith(".lock"):
+            return False
+        if directory in (self.git_dir, self.common_dir):
+            return name in _STATE_FILES
+        return True
+
+    # Polling fallback
+
+    def _state(self) -> List[Tuple[str, int, int]]:
+        paths = [os.path.join(directory, name) for directory in {self.git_dir, self.common_dir} for name in _STATE_FILES]
+        for directory, _, names in os.walk(os.path.join(self.common_dir, "refs")):
+            paths.extend(os.path.join(directory, name) for name in names if not name.endswith(".lock"))
+        state = []
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state.append((path, stat.st_mtime_ns, stat.st_size))
+        return state
+
+    async def _poll(self) -> None:
+        previous = self._state()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            current = self._state()
+            if current != previous:
+                previous = current
+                self._schedule()
+
+    # Debouncing
+
+    def _schedule(self) -> None:
+        """Run the callback once no change has been seen for debounce seconds."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(self.debounce, self._fire)
+
+    def _fire(self) -> None:
+        self._timer = None
+        if self._callback_task is not None and not self._callback_task.done():
+            self._pending = True
+            return
+        self._callback_task = self.loop.create_task(self._run_callback())
+
+    async def _run_callback(self) -> None:
+        while True:
+            self._pending = False
+            try:
+                await self.on_change()
+            except Exception as e:
+                logger.warning(f"Watcher callback for {self.git_dir} failed: {e}")
+            if not self._pending:
+                break
+
+    # Shutdown
+
+    def _close_fd(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._watches.clear()
+
+    async def aclose(self) -> None:
+        """Stop watching and wait for a running callback to finish."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._fd >= 0:
+            self.loop.remove_reader(self._fd)
+            self._close_fd()
+        tasks = [task for task in (self._poll_task, self._callback_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poll_task = self._callback_task = None
+
+
+# Active watchers by working directory
+_watchers: Dict[str, RepositoryWatcher] = {}
+
+
+async def start_watching(
+    cwd: str, on_change: Callable[[], Awaitable[None]], prefetch: bool = True, **options
+) -> RepositoryWatcher:
+    """Watch the repository at cwd, or return the watcher that already does.
+
+    With prefetch, on_change runs once right away to warm the caches for the
+    current state. A tool call that starts the watcher and then computes the
+    result itself passes prefetch=False, so git does not do the work twice.
+    """
+    watcher = _watchers.get(cwd)
+    if watcher is not None:
+        return watcher
+    result = await run_git(["git", "rev-parse", "--absolute-git-dir", "--git-common-dir"], cwd, check=True)
+    git_dir, common_dir = result.stdout.splitlines()[:2]
+    common_dir = os.path.normpath(os.path.join(cwd, common_dir))
+    if cwd in _watchers:
+        return _watchers[cwd]
+    watcher = RepositoryWatcher(git_dir, common_dir, on_change, **options)
+    watcher.start()
+    _watchers[cwd] = watcher
+    if prefetch:
+        watcher._schedule()
+    return watcher
+
+
+async def stop_watching(cwd: str) -> bool:
+    """Stop the watcher for cwd; returns False if there was none."""
+    watcher = _watchers.pop(cwd, None)
+    if watcher is None:
+        return False
+    await watcher.aclose()
+    return True
+
+
+async def stop_all_watchers() -> None:
+    """Stop every watcher; used on shutdown and between tests."""
+    for cwd in list(_watchers):
+        await stop_watching(cwd)
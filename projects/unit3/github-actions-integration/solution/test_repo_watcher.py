@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the repository watcher that prefetches tool results.
+These make real commits in a throwaway repository and wait for the callback.
+"""
+
+import asyncio
+import subprocess
+import pytest
+import pytest_asyncio
+
+from repo_watcher import _load_inotify, start_watching, stop_all_watchers, stop_watching
+
+
+def git(cwd, *args):
+    """Run a git command synchronously for test setup."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def watchers():
+    """Stop all watchers before each test's event loop closes."""
+    yield
+    await stop_all_watchers()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A repository with one commit on main."""
+    git(tmp_path, "init", "-q", "-b", "main")
+    git(tmp_path, "config", "user.email", "dev@example.com")
+    git(tmp_path, "config", "user.name", "Dev")
+    (tmp_path / "app.py").write_text("a\n")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "Initial commit")
+    return tmp_path
+
+
+class CallRecorder:
+    """Counts callback runs and lets a test wait for the next one."""
+
+    def __init__(self):
+        self.calls = 0
+        self.event = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        self.event.set()
+
+    async def wait(self, timeout=5):
+        await asyncio.wait_for(self.event.wait(), timeout)
+        self.event.clear()
+
+
+@pytest.mark.parametrize("use_inotify", [
+    pytest.param(True, marks=pytest.mark.skipif(_load_inotify() is None, reason="inotify not available")),
+    False
+])
+class TestRepositoryWatcher:
+    """Test change detection with inotify and with the polling fallback."""
+
+    @pytest.mark.asyncio
+    async def test_commit_triggers_one_debounced_callback(self, repo, use_inotify):
+        recorder = CallRecorder()
+        watcher = await start_watching(str(repo), recorder, debounce=0.05, poll_interval=0.05, use_inotify=use_inotify)
+        await recorder.wait()
+        assert watcher.mode == ("inotify" if use_inotify else "polling")
+
+        (repo / "app.py").write_text("b\n")
+        git(repo, "commit", "-q", "-am", "Change app")
+        await recorder.wait()
+        await asyncio.sleep(0.2)
+
+        assert recorder.calls == 2
+
+    @pytest.mark.asyncio
+    async def test_branch_with_slash_and_checkout(self, repo, use_inotify):
+        recorder = CallRecorder()
+        await start_watching(str(repo), recorder, debounce=0.05, poll_interval=0.05, use_inotify=use_inotify)
+        await recorder.wait()
+
+        git(repo, "checkout", "-q", "-b", "feature/watch")
+        await recorder.wait()
+        (repo / "app.py").write_text("c\n")
+        git(repo, "commit", "-q", "-am", "Change app on feature")
+        await recorder.wait()
+
+        assert recorder.calls == 3
+
+    @pytest.mark.asyncio
+    async def test_worktree_edits_are_ignored(self, repo, use_inotify):
+        recorder = CallRecorder()
+        await start_watching(str(repo), recorder, debounce=0.05, poll_interval=0.05, use_inotify=use_inotify)
+        await recorder.wait()
+
+        (repo / "app.py").write_text("unstaged\n")
+        await asyncio.sleep(0.3)
+
+        assert recorder.calls == 1
+        assert await stop_watching(str(repo))
+        assert not await stop_watching(str(repo))
+
+    @pytest.mark.asyncio
+    async def test_without_prefetch_waits_for_a_change(self, repo, use_inotify):
+        recorder = CallRecorder()
+        await start_watching(
+            str(repo), recorder, prefetch=False, debounce=0.05, poll_interval=0.05, use_inotify=use_inotify
+        )
+        await asyncio.sleep(0.3)
+        assert recorder.calls == 0
+
+        (repo / "app.py").write_text("b\n")
+        git(repo, "commit", "-q", "-am", "Change app")
+        await recorder.wait()
+
+        assert recorder.calls == 1
@@ -5,9 +5,12 @@ Unit tests for Module 1: Basic MCP Server
 
 import json
 import pytest
+import pytest_asyncio
 import asyncio
 from pathlib import Path
 from unittest.mock import patch, MagicMock, AsyncMock
+
+from git_analysis import DiffAnalysis, FileChange, close_object_pools
 from server import (
     mcp,
     analyze_file_changes,
@@ -18,18 +21,29 @@ from server import (
 )
 
 
+@pytest_asyncio.fixture(autouse=True)
+async def object_pools():
+    """Stop the shared cat-file workers before each test's event loop closes."""
+    yield
+    await close_object_pools()
+
+
 class TestAnalyzeFileChanges:
     """Test the analyze_file_changes tool."""
     
     @pytest.mark.asyncio
     async def test_analyze_with_diff(self):
         """Test analyzing changes with full diff included."""
-        mock_result = MagicMock()
-        mock_result.stdout = "M\tfile1.py\nA\tfile2.py\n"
-        mock_result.stderr = ""
-        
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = mock_result
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.return_value = DiffAnalysis(files=[
+                FileChange(status="M", path="file1.py"),
+                FileChange(status="A", path="file2.py")
+            ])
+            mock_run.return_value = MagicMock(stdout="", stderr="")  # excluded files
+            mock_log.return_value = "abc123 Add files\n"
             
             result = await analyze_file_changes("main", include_diff=True)
             
@@ -38,28 +52,34 @@ class TestAnalyzeFileChanges:
             assert data["base_branch"] == "main"
             assert "files_changed" in data
             assert "statistics" in data
-            assert "commits" in data
+            assert data["commits"] == "abc123 Add files\n"
             assert "diff" in data
     
     @pytest.mark.asyncio
     async def test_analyze_without_diff(self):
         """Test analyzing changes without diff content."""
-        mock_result = MagicMock()
-        mock_result.stdout = "M\tfile1.py\n"
-        
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = mock_result
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.return_value = DiffAnalysis(files=[FileChange(status="M", path="file1.py")])
+            mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = "abc123 Update file\n"
             
             result = await analyze_file_changes("main", include_diff=False)
             
             data = json.loads(result)
             assert "Diff not included" in data["diff"]
+            assert data["commits"] == "abc123 Update file\n"
     
     @pytest.mark.asyncio
     async def test_analyze_git_error(self):
         """Test handling git command errors."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.side_effect = Exception("Git not found")
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.side_effect = Exception("Git not found")
             
             result = await analyze_file_changes("main", True)
             
@@ -162,11 +182,16 @@ class TestIntegration:
         monkeypatch.setattr('server.TEMPLATES_DIR', tmp_path)
         
         # Mock git commands
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(
-                stdout="M\tsrc/main.py\nM\ttests/test_main.py\n",
-                stderr=""
-            )
+        with patch('server.resolve_range', new_callable=AsyncMock, return_value=None), \
+             patch('git_analysis.analyze_diff', new_callable=AsyncMock) as mock_diff, \
+             patch('git_analysis.run_git', new_callable=AsyncMock) as mock_run, \
+             patch('git_analysis.read_oneline_log', new_callable=AsyncMock) as mock_log:
+            mock_diff.return_value = DiffAnalysis(files=[
+                FileChange(status="M", path="src/main.py"),
+                FileChange(status="M", path="tests/test_main.py")
+            ])
+            mock_run.return_value = MagicMock(stdout="", stderr="")
+            mock_log.return_value = "abc123 Update main\n"
             
             # 1. Analyze changes
             analysis_result = await analyze_file_changes("main", True)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Import graph of a repository's Python modules, persisted in the git directory.
+Maps the files changed against a base branch to the test modules that import
+them, directly or through other modules. The graph is updated from the tree
+diff between the indexed commit and HEAD, so only added or modified files are
+parsed again.
+"""
+
+import ast
+import asyncio
+import fnmatch
+import json
+import os
+import posixpath
+import warnings
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from git_analysis import (
+    TEST_FILE_PATTERNS,
+    analyze_diff,
+    get_object_pool,
+    result_cache,
+    run_git
+)
+
+# Bumped whenever the stored format or the import parsing changes
+INDEX_VERSION = 1
+
+# Location of the index, relative to the git directory
+INDEX_PATH = "pr-agent/import-graph.json"
+
+# Python files at any depth, for the tree diff
+_PYTHON_PATHSPEC = ":(top,glob)**/*.py"
+
+
+def parse_imports(source: bytes) -> List[str]:
+    """Return the modules a Python file may import, as dotted names.
+
+    Relative imports keep their leading dots. For `from a import b` both
+    "a" and "a.b" are listed, because b may be a submodule. Imports inside
+    functions and try blocks count too. A file that does not parse has none.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    specs = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            specs.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            module = "." * node.level + (node.module or "")
+            specs.add(module)
+            prefix = module if module.endswith(".") else f"{module}."
+            specs.update(prefix + alias.name for alias in node.names if alias.name != "*")
+    return sorted(specs)
+
+
+def _module_files(base: str, module: str) -> Tuple[str, str]:
+    # Plain string operations; this runs for every import of every file
+    path = module.replace(".", "/")
+    if base:
+        path = f"{base}/{path}" if path else base
+    return f"{path}.py", f"{path}/__init__.py"
+
+
+def resolve_import(importer: str, spec: str, paths: "set[str]") -> Optional[str]:
+    """Find the file an import in importer refers to, or None for third-party modules.
+
+    Relative imports are resolved against the importer's package. Absolute
+    ones are looked up the way a test runner's sys.path would find them:
+    next to the importer, in each of its parent directories, and in a src/
+    directory at any of those levels.
+    """
+    directory = posixpath.dirname(importer)
+    if spec.startswith("."):
+        module = spec.lstrip(".")
+        for _ in range(len(spec) - len(module) - 1):
+            directory = posixpath.dirname(directory)
+        candidates = _module_files(directory, module)
+        if not module:
+            candidates = candidates[1:]
+        return next((path for path in candidates if path in paths), None)
+
+    while True:
+        for base in (directory, f"{directory}/src" if directory else "src"):
+            for path in _module_files(base, spec):
+                if path in paths:
+                    return path
+        if not directory:
+            return None
+        directory = posixpath.dirname(directory)
+
+
+def is_test_file(path: str) -> bool:
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in TEST_FILE_PATTERNS)
+
+
+class ImportGraph:
+    """The Python files of one commit, what they import and what that resolves to.
+
+    Imports are stored per blob SHA, so a file that moves or returns to an
+    earlier version is never parsed again. Resolved edges are stored per path
+    and only recomputed for the files that need it.
+    """
+
+    def __init__(
+        self,
+        commit: str,
+        files: Dict[str, str],
+        imports: Dict[str, List[str]],
+        edges: Optional[Dict[str, List[str]]] = None
+    ):
+        self.commit = commit
+        # Path -> blob SHA
+        self.files = files
+        # Blob SHA -> parse_imports result
+        self.imports = imports
+        # Path -> files it imports
+        self.edges = edges if edges is not None else {}
+        self._dependents: Optional[Dict[str, List[str]]] = None
+
+    def resolve(self, paths: Optional[Iterable[str]] = None) -> None:
+        """Recompute the edges of some files, or of all files when paths is None."""
+        existing = set(self.files)
+        if paths is None:
+            self.edges = {}
+            paths = self.files
+        for importer in paths:
+            targets = set()
+            for spec in self.imports.get(self.files[importer], ()):
+                target = resolve_import(importer, spec, existing)
+                if target is not None and target != importer:
+                    targets.add(target)
+            self.edges[importer] = sorted(targets)
+        self._dependents = None
+
+    @property
+    def dependents(self) -> Dict[str, List[str]]:
+        """Map each file to the files that import it (computed on first use)."""
+        if self._dependents is None:
+            dependents: Dict[str, List[str]] = {}
+            for importer, targets in self.edges.items():
+                for target in targets:
+                    dependents.setdefault(target, []).append(importer)
+            self._dependents = dependents
+        return self._dependents
+
+    def affected_tests(self, changed: List[str]) -> Dict[str, List[str]]:
+        """Return the test files that depend on the changed files.
+
+        Each test maps to the import chain from the test to a changed file.
+        A conftest.py that is reached affects every test next to or below it.
+        """
+        reached: Dict[str, Optional[str]] = {path: None for path in changed if path in self.files}
+        queue = deque(reached)
+        while queue:
+            path = queue.popleft()
+            for importer in self.dependents.get(path, ()):
+                if importer not in reached:
+                    reached[importer] = path
+                    queue.append(importer)
+
+        def chain(path: str) -> List[str]:
+            links = [path]
+            while reached[links[-1]] is not None:
+                links.append(reached[links[-1]])
+            return links
+
+        tests = {}
+        for path in reached:
+            if posixpath.basename(path) == "conftest.py":
+                prefix = posixpath.dirname(path)
+                for test in self.files:
+                    if (test.startswith(f"{prefix}/") or not prefix) and is_test_file(test) \
+                            and posixpath.basename(test) != "conftest.py":
+                        tests.setdefault(test, [test] + chain(path))
+            elif is_test_file(path):
+                tests[path] = chain(path)
+        return dict(sorted(tests.items()))
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "version": INDEX_VERSION,
+            "commit": self.commit,
+            "files": self.files,
+            "imports": self.imports,
+            "edges": self.edges
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data: str) -> Optional["ImportGraph"]:
+        """Load a stored graph, or None if it is unreadable or from another version."""
+        try:
+            stored = json.loads(data)
+            if stored.get("version") != INDEX_VERSION:
+                return None
+            return cls(stored["commit"], stored["files"], stored["imports"], stored["edges"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+
+def _parse_blobs(blobs: Dict[str, bytes]) -> Dict[str, List[str]]:
+    return {sha: parse_imports(content) for sha, content in blobs.items()}
+
+
+def _update_graph(graph: ImportGraph, blobs: Dict[str, bytes], stale: Optional[List[str]]) -> int:
+    """Parse new blobs into the graph and re-resolve the stale files; returns the blobs parsed."""
+    graph.imports.update(_parse_blobs(blobs))
+    graph.resolve(stale)
+    return len(blobs)
+
+
+async def _python_files(cwd: str, commit: str, timeout: Optional[float]) -> Dict[str, str]:
+    """List the regular Python files of a commit with their blob SHAs."""
+    result = await run_git(
+        ["git", "ls-tree", "-r", "-z", "--full-tree", commit],
+        cwd, check=True, timeout=timeout
+    )
+    files = {}
+    for entry in result.stdout.split("\0"):
+        if not entry:
+            continue
+        meta, path = entry.split("\t", 1)
+        mode, _, sha = meta.split(" ")
+        # ls-tree does not take glob pathspecs
+        if mode.startswith("100") and path.endswith(".py"):
+            files[path] = sha
+    return files
+
+
+async def _changed_python_files(
+    cwd: str, old: str, new: str, files: Dict[str, str], timeout: Optional[float]
+) -> Optional[Dict[str, str]]:
+    """Apply the tree diff between two commits to a copy of files.
+
+    Returns None when the old commit no longer exists (e.g. after a rebase
+    and garbage collection), so the caller rebuilds from scratch.
+    """
+    result = await run_git(
+        ["git", "diff", "--raw", "-z", "--no-renames", "--no-abbrev", old, new, "--", _PYTHON_PATHSPEC],
+        cwd, timeout=timeout
+    )
+    if result.returncode != 0:
+        return None
+    files = dict(files)
+    values = result.stdout.split("\0")
+    for meta, path in zip(values[::2], values[1::2]):
+        _, new_mode, _, new_sha, status = meta.split(" ")
+        if status == "D" or not new_mode.startswith("100"):
+            files.pop(path, None)
+        else:
+            files[path] = new_sha
+    return files
+
+
+# One update per repository at a time, with the event loop each lock belongs to
+_locks: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Lock]] = {}
+
+
+def _update_lock(cwd: str) -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    if cwd not in _locks or _locks[cwd][0] is not loop:
+        _locks[cwd] = loop, asyncio.Lock()
+    return _locks[cwd][1]
+
+
+async def load_import_graph(cwd: str, timeout: Optional[float] = None) -> Tuple[ImportGraph, dict]:
+    """Return the import graph for HEAD and how it was obtained.
+
+    The graph comes from the result cache, from the stored index, from the
+    stored index plus the tree diff to HEAD, or from a full scan, in that
+    order of preference. New blobs are read through the persistent object
+    pool, and parsing and resolving run off the event loop. The second
+    value describes the update: {"commit", "update", "parsed_files",
+    "python_files"}.
+    """
+    head = await get_object_pool(cwd).rev_parse("HEAD^{commit}")
+    if head is None:
+        raise ValueError("HEAD cannot be resolved")
+    key = ("import-graph", cwd, head)
+    async with _update_lock(cwd):
+        graph = result_cache.get(key)
+        if graph is not None:
+            return graph, {"commit": head, "update": "cached", "parsed_files": 0, "python_files": len(graph.files)}
+
+        git_path = await run_git(["git", "rev-parse", "--git-path", INDEX_PATH], cwd, check=True, timeout=timeout)
+        index_path = os.path.join(cwd, git_path.stdout.strip())
+        data = ""
+        try:
+            with open(index_path, encoding="utf-8") as index_file:
+                data = index_file.read()
+        except OSError:
+            pass
+        stored = ImportGraph.from_json(data) if data else None
+
+        if stored is not None and stored.commit == head:
+            result_cache.put(key, stored, len(data))
+            return stored, {"commit": head, "update": "loaded", "parsed_files": 0, "python_files": len(stored.files)}
+
+        files = None
+        if stored is not None:
+            files = await _changed_python_files(cwd, stored.commit, head, stored.files, timeout)
+        if files is None:
+            update, stale = "full", None
+            files = await _python_files(cwd, head, timeout)
+            graph = ImportGraph(head, files, {})
+        else:
+            update = "incremental"
+            # Adding or removing a module can change what any import resolves
+            # to; edits to existing files only change their own edges
+            stale = None
+            if files.keys() == stored.files.keys():
+                stale = [path for path, sha in files.items() if stored.files[path] != sha]
+            blob_shas = set(files.values())
+            imports = {sha: specs for sha, specs in stored.imports.items() if sha in blob_shas}
+            graph = ImportGraph(head, files, imports, stored.edges)
+
+        missing = sorted({sha for sha in files.values() if sha not in graph.imports})
+        pool = get_object_pool(cwd)
+        objects = await asyncio.gather(*(pool.lookup(sha) for sha in missing))
+        blobs = {sha: result[2] for sha, result in zip(missing, objects) if result is not None}
+        parsed = await asyncio.get_running_loop().run_in_executor(None, _update_graph, graph, blobs, stale)
+
+        data = graph.to_json()
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            temporary_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as index_file:
+                index_file.write(data)
+            os.replace(temporary_path, index_path)
+        except OSError:
+            # A read-only git directory only costs the next process a rebuild
+            pass
+        result_cache.put(key, graph, len(data))
+        return graph, {"commit": head, "update": update, "parsed_files": parsed, "python_files": len(files)}
+
+
+async def find_affected_tests(
+    cwd: str,
+    base_branch: str,
+    exclude: Tuple[str, ...] = (),
+    timeout: Optional[float] = None
+) -> dict:
+    """List the test files that depend on the files changed in base_branch...HEAD.
+
+    Changed test files are affected themselves. Changed files the graph
+    cannot follow (deleted files and anything that is not Python) are
+    listed under unmapped_files.
+    """
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    diff_analysis, (graph, index) = await asyncio.gather(
+        analyze_diff(cwd, base_branch, include_patch=False, exclude=exclude, deadline=deadline),
+        load_import_graph(cwd, timeout)
+    )
+    changed = [change.path for change in diff_analysis.files if change.status != "D"]
+    tests = graph.affected_tests(changed)
+    result = {
+        "base_branch": base_branch,
+        "changed_files": len(diff_analysis.files),
+        "affected_tests": [{"path": path, "because": chain} for path, chain in tests.items()],
+        "unmapped_files": [
+            change.path for change in diff_analysis.files
+            if change.status == "D" or change.path not in graph.files
+        ],
+        "index": index
+    }
+    if diff_analysis.timed_out:
+        result["timed_out"] = True
+    return result
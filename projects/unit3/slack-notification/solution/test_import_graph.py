@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the import graph that maps changed files to affected tests.
+These build the index for a throwaway repository.
+"""
+
+import subprocess
+import pytest
+import pytest_asyncio
+
+from git_analysis import close_object_pools, result_cache
+from import_graph import ImportGraph, find_affected_tests, load_import_graph, parse_imports, resolve_import
+
+
+def git(cwd, *args):
+    """Run a git command synchronously for test setup."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def object_pools():
+    """Stop the shared cat-file workers before each test's event loop closes."""
+    yield
+    await close_object_pools()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A package with two modules and tests, and a feature branch that changes the core module."""
+    git(tmp_path, "init", "-q", "-b", "main")
+    git(tmp_path, "config", "user.email", "dev@example.com")
+    git(tmp_path, "config", "user.name", "Dev")
+    files = {
+        "src/shop/__init__.py": "",
+        "src/shop/core.py": "PRICE = 1\n",
+        "src/shop/api.py": "from .core import PRICE\n",
+        "src/shop/cli.py": "import argparse\n",
+        "tests/test_api.py": "from shop.api import PRICE\n",
+        "tests/test_cli.py": "from shop import cli\n",
+        "README.md": "shop\n"
+    }
+    for path, content in files.items():
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(content)
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "Initial commit")
+    git(tmp_path, "checkout", "-q", "-b", "feature")
+    (tmp_path / "src/shop/core.py").write_text("PRICE = 2\n")
+    (tmp_path / "README.md").write_text("shop v2\n")
+    git(tmp_path, "commit", "-q", "-am", "Raise price")
+    return tmp_path
+
+
+class TestImportResolution:
+    """Test parsing and resolving imports."""
+
+    def test_parse_imports(self):
+        source = b"import os.path\nfrom . import util\nfrom ..pkg.mod import name\ntry:\n    import yaml\nexcept ImportError:\n    pass\n"
+
+        assert parse_imports(source) == [".", "..pkg.mod", "..pkg.mod.name", ".util", "os.path", "yaml"]
+        assert parse_imports(b"def broken(:\n") == []
+
+    def test_resolve_relative_absolute_and_src_layout(self):
+        paths = {"src/shop/__init__.py", "src/shop/core.py", "tools/helper.py", "tools/test_helper.py"}
+
+        assert resolve_import("src/shop/api.py", ".core", paths) == "src/shop/core.py"
+        assert resolve_import("src/shop/api.py", ".", paths) == "src/shop/__init__.py"
+        assert resolve_import("tests/test_api.py", "shop.core", paths) == "src/shop/core.py"
+        assert resolve_import("tools/test_helper.py", "helper", paths) == "tools/helper.py"
+        assert resolve_import("tests/test_api.py", "requests", paths) is None
+
+    def test_conftest_affects_tests_below_it(self):
+        graph = ImportGraph("c", {
+            "app.py": "a", "tests/conftest.py": "b", "tests/test_one.py": "c", "other/test_two.py": "d"
+        }, {"b": ["app"]})
+        graph.resolve()
+
+        tests = graph.affected_tests(["app.py"])
+
+        assert tests == {"tests/test_one.py": ["tests/test_one.py", "tests/conftest.py", "app.py"]}
+
+
+class TestAffectedTests:
+    """Test building, persisting and updating the index."""
+
+    @pytest.mark.asyncio
+    async def test_transitive_dependents_are_affected(self, repo):
+        result = await find_affected_tests(str(repo), "main")
+
+        assert result["affected_tests"] == [{
+            "path": "tests/test_api.py",
+            "because": ["tests/test_api.py", "src/shop/api.py", "src/shop/core.py"]
+        }]
+        assert result["unmapped_files"] == ["README.md"]
+        assert result["index"]["update"] == "full"
+        assert (repo / ".git" / "pr-agent" / "import-graph.json").exists()
+
+    @pytest.mark.asyncio
+    async def test_index_is_updated_incrementally(self, repo):
+        await load_import_graph(str(repo))
+        result_cache.clear()
+        (repo / "src/shop/cli.py").write_text("import argparse\nfrom .core import PRICE\n")
+        git(repo, "commit", "-q", "-am", "Show price")
+
+        result = await find_affected_tests(str(repo), "main")
+
+        assert result["index"]["update"] == "incremental"
+        assert result["index"]["parsed_files"] == 1
+        assert [test["path"] for test in result["affected_tests"]] == ["tests/test_api.py", "tests/test_cli.py"]
+
+    @pytest.mark.asyncio
+    async def test_new_module_re_resolves_other_files(self, repo):
+        await load_import_graph(str(repo))
+        result_cache.clear()
+        # tests/test_cli.py imports "shop.cli", which now resolves to a local module
+        (repo / "tests/shop").mkdir()
+        (repo / "tests/shop/cli.py").write_text("")
+        (repo / "tests/shop/__init__.py").write_text("")
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", "Shadow the package")
+
+        graph, index = await load_import_graph(str(repo))
+
+        assert index["update"] == "incremental"
+        assert graph.edges["tests/test_cli.py"] == ["tests/shop/__init__.py", "tests/shop/cli.py"]
+
+    @pytest.mark.asyncio
+    async def test_stored_index_is_reused_by_a_new_process(self, repo):
+        await load_import_graph(str(repo))
+        result_cache.clear()
+
+        _, index = await load_import_graph(str(repo))
+
+        assert index["update"] == "loaded"
+        assert index["parsed_files"] == 0